@@ -0,0 +1,250 @@
+# Copyright (C) 2021-2022 Dino Bollinger, ETH Zürich, Information Security Group
+# Released under the MIT License
+"""
+Run the analysis pipeline over many crawl databases in parallel, and summarize the results across crawls.
+Each database is analyzed by a separate worker process, which runs the selected stages of pipeline.py
+with the shared stage cache, and collects the results in a subdirectory named after the database.
+Workers are only started while the estimated memory of all running workers fits into the memory budget.
+The databases should be given in chronological order, e.g. the monthly crawls sorted by date.
+Outputs in the output directory:
+    <crawl>/: Results of each crawl, as written by pipeline.py.
+    batch_summary.json: Number of violations and sites with violations per method, for each crawl.
+    site_presence.csv: For each site and crawl, the methods that found a violation on the site,
+                       or "n/a" if the site was not part of the crawl.
+    batch_distributions.json: Summaries of the distributions of each method (e.g. violations per site),
+                              merged over all crawls.
+----------------------------------
+Required arguments:
+    <db_path>   Paths to the databases to analyze.
+Optional arguments:
+    --out_path <out_path>: Directory to store the results in (default: ./violation_stats/batch/).
+    --cache_dir <cache_dir>: Directory of the stage cache (default: ./pipeline_cache/).
+    --workers <workers>: Maximum number of databases analyzed concurrently (default: 4).
+    --memory_budget <mb>: Memory available to all workers together, in megabytes (default: 4096).
+    --stages <stages>: Comma-separated stages to run, together with their dependencies (default: all).
+    --force: Re-run the selected stages even if their artifacts are cached.
+Usage:
+    batch_analysis.py <db_path>... [--out_path <out_path>] [--cache_dir <cache_dir>] [--workers <workers>]
+                      [--memory_budget <mb>] [--stages <stages>] [--force]
+"""
+
+import csv
+import json
+import os
+import sqlite3
+import time
+import logging
+
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from docopt import docopt
+from typing import Any, Dict, List, Set
+
+from partitioned_grouping import estimate_table_rows, DEFAULT_MEMORY_BUDGET_MB
+from pipeline import STAGES, run_pipeline, collect_outputs, resolve_stages
+from utils import load_distributions, MATCHED_BYTES_PER_ROW, CONSENT_BYTES_PER_ROW
+
+logger = logging.getLogger("vd")
+
+# Peak memory of a stage is roughly a fixed interpreter overhead plus the matched cookies or consent entries it holds
+# in dictionaries, see MATCHED_BYTES_PER_ROW and CONSENT_BYTES_PER_ROW. Stages whose entries exceed the default
+# memory budget group them in partitions on disk instead, so the entries never take more than that budget.
+BASE_MEMORY_MB = 50
+
+# Outputs of each method that count as violations. For methods 7 and 8, only the
+# functionality, analytics and advertising cookies are violations.
+METHOD_OUTPUTS: Dict[str, List[str]] = {
+    "method1": ["method1_cookies.json"],
+    "method2": ["method2_cookies.json"],
+    "method3": ["method3_cookies.json"],
+    "method4": ["method4_cookies.json"],
+    "method5": ["method5_cookies.json"],
+    "method6": ["method6_cookies.json"],
+    "method7": [f"method7/method7_cookies_{c}.json" for c in ("functionality", "analytics", "advertising")],
+    "method8": [f"method8/method8_cookies_{c}.json" for c in ("functionality", "analytics", "advertising")],
+}
+
+
+def crawl_names(db_paths: List[str]) -> List[str]:
+    """ Name of the output directory of each database, the file name without extension, made unique. """
+    names = []
+    for db_path in db_paths:
+        base = os.path.splitext(os.path.basename(db_path))[0]
+        name = base
+        i = 2
+        while name in names:
+            name = f"{base}_{i}"
+            i += 1
+        names.append(name)
+    return names
+
+
+def estimate_memory_mb(db_path: str) -> float:
+    """
+    Estimated peak memory of analyzing a database, from the rows of its largest tables.
+    Stages run one at a time, so the stage holding the most entries determines the peak.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        entries_bytes = max(estimate_table_rows(conn, "javascript_cookies") * MATCHED_BYTES_PER_ROW,
+                            estimate_table_rows(conn, "consent_data") * CONSENT_BYTES_PER_ROW)
+    except sqlite3.OperationalError:
+        # not a crawl database, the stages fail before they hold any entries
+        entries_bytes = 0
+    finally:
+        conn.close()
+    return BASE_MEMORY_MB + min(entries_bytes / (1024 * 1024), DEFAULT_MEMORY_BUDGET_MB)
+
+
+def analyze_crawl(db_path: str, out_path: str, stages: Set[str], cache_dir: str, force: bool) -> Dict[str, Any]:
+    """
+    Run the pipeline for a single database in a worker process, and collect the violations per method and site.
+    @param db_path: absolute path to the database
+    @param out_path: directory to collect the results of the crawl in
+    @param stages: stages to run, including their dependencies
+    @param cache_dir: absolute path to the stage cache
+    @param force: whether to ignore cached artifacts
+    @return: counts per method, methods with violations per site, distribution summaries per method,
+             and all sites of the crawl
+    """
+    start = time.perf_counter()
+    params: Dict[str, List[str]] = {name: [] for name in STAGES}
+    completed, failed = run_pipeline(stages, db_path, params, cache_dir, 1, force)
+    collect_outputs(completed, out_path)
+
+    counts: Dict[str, Dict[str, int]] = dict()
+    site_methods: Dict[str, List[str]] = dict()
+    distributions: Dict[str, str] = dict()
+    for method, outputs in METHOD_OUTPUTS.items():
+        if method not in completed:
+            continue
+        dist_path = os.path.join(out_path, os.path.dirname(outputs[0]), f"{method}_distributions.json")
+        if os.path.exists(dist_path):
+            distributions[method] = dist_path
+        violations = 0
+        sites = set()
+        for fn in outputs:
+            with open(os.path.join(out_path, fn), 'r') as fd:
+                details = json.load(fd)
+            for site, records in details.items():
+                violations += len(records)
+                sites.add(site)
+        counts[method] = {"violations": violations, "sites": len(sites)}
+        for site in sites:
+            site_methods.setdefault(site, []).append(method)
+
+    conn = sqlite3.connect(db_path)
+    all_sites = [row[0] for row in conn.execute("SELECT DISTINCT site_url FROM site_visits")]
+    conn.close()
+
+    return {"db_path": db_path, "failed": sorted(failed), "seconds": time.perf_counter() - start,
+            "counts": counts, "site_methods": site_methods, "distributions": distributions, "sites": all_sites}
+
+
+def write_summary(names: List[str], results: Dict[str, Dict[str, Any]], out_path: str) -> None:
+    """
+    Write the counts per method and crawl, the presence of violations per site over the crawls,
+    and the distributions of each method merged over the crawls.
+    @param names: crawl names, in chronological order
+    @param results: results of analyze_crawl per crawl name, failed crawls omitted
+    @param out_path: directory to write the summary files to
+    """
+    crawls = [n for n in names if n in results]
+    summary = {"crawls": [{"name": n, "db_path": results[n]["db_path"], "sites": len(results[n]["sites"]),
+                           "failed_stages": results[n]["failed"], "seconds": results[n]["seconds"]} for n in crawls],
+               "methods": {m: {n: results[n]["counts"].get(m) for n in crawls} for m in METHOD_OUTPUTS}}
+    with open(os.path.join(out_path, "batch_summary.json"), 'w') as fd:
+        json.dump(summary, fd, indent=4)
+    logger.info(f"Summary output to: '{os.path.join(out_path, 'batch_summary.json')}'")
+
+    crawl_sites = {n: set(results[n]["sites"]) for n in crawls}
+    all_sites = sorted(set().union(*crawl_sites.values()))
+    with open(os.path.join(out_path, "site_presence.csv"), 'w', newline='') as fd:
+        writer = csv.writer(fd)
+        writer.writerow(["site_url"] + crawls)
+        for site in all_sites:
+            writer.writerow([site] + [";".join(results[n]["site_methods"].get(site, [])) if site in crawl_sites[n]
+                                      else "n/a" for n in crawls])
+    logger.info(f"Site presence output to: '{os.path.join(out_path, 'site_presence.csv')}'")
+
+    merged = dict()
+    for m in METHOD_OUTPUTS:
+        paths = [results[n]["distributions"][m] for n in crawls if m in results[n]["distributions"]]
+        if paths:
+            merged[m] = {name: s.to_dict() for name, s in load_distributions(*paths).items()}
+    with open(os.path.join(out_path, "batch_distributions.json"), 'w') as fd:
+        json.dump(merged, fd, indent=4)
+    logger.info(f"Distributions output to: '{os.path.join(out_path, 'batch_distributions.json')}'")
+
+
+def main():
+    """
+    Analyze all databases and write the cross-crawl summary.
+    @return: exit code, 0 for success
+    """
+    argv = None
+    cargs = docopt(__doc__, argv=argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    db_paths = cargs["<db_path>"]
+    for db_path in db_paths:
+        if not os.path.exists(db_path):
+            logger.error(f"Database file '{db_path}' does not exist.")
+            return 1
+
+    selected = cargs["--stages"].split(",") if cargs["--stages"] else list(STAGES.keys())
+    unknown = set(selected) - set(STAGES.keys())
+    if unknown:
+        logger.error(f"Unknown stages: {unknown}")
+        return 1
+
+    out_path = cargs["--out_path"] if cargs["--out_path"] else "./violation_stats/batch/"
+    cache_dir = os.path.abspath(cargs["--cache_dir"] if cargs["--cache_dir"] else "./pipeline_cache/")
+    workers = int(cargs["--workers"]) if cargs["--workers"] else 4
+    memory_budget = float(cargs["--memory_budget"]) if cargs["--memory_budget"] else 4096.0
+    stages = resolve_stages(selected)
+    os.makedirs(out_path, exist_ok=True)
+
+    names = crawl_names(db_paths)
+    pending = list(zip(names, db_paths))
+    running = dict()
+    reserved_mb = 0.0
+    results: Dict[str, Dict[str, Any]] = dict()
+    failed: List[str] = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            # start crawls in order while they fit into the budget, but always keep at least one running
+            while pending and len(running) < workers:
+                name, db_path = pending[0]
+                memory_mb = estimate_memory_mb(db_path)
+                if running and reserved_mb + memory_mb > memory_budget:
+                    break
+                pending.pop(0)
+                reserved_mb += memory_mb
+                logger.info(f"{name}: started, estimated memory {memory_mb:.0f} MB")
+                future = pool.submit(analyze_crawl, os.path.abspath(db_path), os.path.join(out_path, name) + "/",
+                                     stages, cache_dir, cargs["--force"])
+                running[future] = (name, memory_mb)
+
+            done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                name, memory_mb = running.pop(future)
+                reserved_mb -= memory_mb
+                try:
+                    results[name] = future.result()
+                    logger.info(f"{name}: finished in {results[name]['seconds']:.2f}s")
+                    if results[name]["failed"]:
+                        logger.error(f"{name}: failed stages {results[name]['failed']}")
+                except Exception as e:
+                    logger.error(f"{name}: {e}")
+                    failed.append(name)
+
+    write_summary(names, results, out_path)
+    logger.info(f"{len(results)} crawls analyzed, {len(failed)} failed, "
+                f"total time {time.perf_counter() - start:.2f}s")
+    return 1 if failed or any(r["failed"] for r in results.values()) else 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,286 @@
+# Copyright (C) 2021-2022 Dino Bollinger, ETH Zürich, Information Security Group
+# Released under the MIT License
+"""
+Verify that an alternative execution engine produces the same violations as the reference scripts.
+Each selected script is run twice on the same database: once as is, and once with the alternative arguments
+(e.g. "--sql"). The JSON and domain list outputs are then compared semantically: the order of the violations
+listed for a site, and of the domain lists, is ignored. Mismatches are reported per site, together with the
+speedup of the alternative. JSON outputs of other shapes, like the distribution summaries, are compared structurally,
+with floats compared up to a relative tolerance, and outputs that could not be compared at all are listed.
+The exit code is 1 if any output differs or could not be compared, such that it can gate a pipeline.
+----------------------------------
+Required arguments:
+    <db_path>   Path to the database to analyze.
+Optional arguments:
+    --alt_args <alt_args>   Arguments added to each script for the alternative engine. [default: ]
+    --methods <methods>     Comma-separated method numbers to compare, "u" for list_undetected_cookies. [default: 1,2,3,4,5,6,7,8]
+    --work_dir <work_dir>   Directory for the outputs of both engines. [default: ./work/equivalence/]
+    --max_sites <max>       Maximum number of mismatching sites to report per file. [default: 10]
+Usage:
+    check_equivalence.py <db_path> [--alt_args <alt_args>] [--methods <methods>] [--work_dir <work_dir>] [--max_sites <max>]
+"""
+
+import json
+import math
+import os
+import shlex
+import shutil
+import logging
+
+from collections import Counter
+from docopt import docopt
+from typing import Any, Dict, List, Optional, Tuple
+
+from run_benchmarks import REPO_ROOT, run_target
+
+logger = logging.getLogger("vd")
+
+# Script for each method, and whether it accepts an output path. list_undetected_cookies writes to ./violation_stats/
+METHOD_SCRIPTS: Dict[str, Tuple[str, bool]] = {
+    "1": ("method1_wrong_label.py", True),
+    "2": ("method2_majority_deviation.py", True),
+    "3": ("method3_inconsistent_expiry.py", True),
+    "4": ("method4_unclassified_cookies.py", True),
+    "5": ("method5_undeclared_cookies.py", True),
+    "6": ("method6_contradictory_labels.py", True),
+    "7": ("method7_implicit_consent.py", True),
+    "8": ("method8_ignored_choices.py", True),
+    "u": ("list_undetected_cookies.py", False),
+}
+
+# Fields of a violation record that hold lists without a meaningful order.
+UNORDERED_FIELDS = {"additional_labels"}
+
+# Floats of violation records are compared up to this many decimal places,
+# floats elsewhere up to a relative and absolute tolerance of 10^-FLOAT_PRECISION.
+FLOAT_PRECISION = 9
+
+
+def canonical_record(record: Any) -> str:
+    """
+    Bring a violation record into a canonical string representation for comparison.
+    @param record: JSON value of a single violation
+    @return: string that is equal for semantically equal records
+    """
+    def normalize(value: Any, field: str = ""):
+        if isinstance(value, float):
+            return round(value, FLOAT_PRECISION)
+        elif isinstance(value, dict):
+            return {k: normalize(v, k) for k, v in value.items()}
+        elif isinstance(value, list):
+            items = [normalize(v) for v in value]
+            if field in UNORDERED_FIELDS:
+                items.sort(key=lambda x: json.dumps(x, sort_keys=True))
+            return items
+        return value
+    return json.dumps(normalize(record), sort_keys=True)
+
+
+def is_site_shaped(value: Any) -> bool:
+    """ Whether a JSON value has the form {site_url: [violations]} of the violation files. """
+    return isinstance(value, dict) and all(isinstance(v, list) for v in value.values())
+
+
+def structural_differences(ref: Any, alt: Any, path: str = "$", field: str = "") -> List[str]:
+    """
+    Compare two JSON values by deep equality. Numbers are equal within the float tolerance, lists are compared
+    in order, except for the UNORDERED_FIELDS.
+    @param ref: value of the reference
+    @param alt: value of the alternative
+    @param path: location of the values in the file, for the report
+    @param field: name of the field holding the values
+    @return: description of each location whose values differ
+    """
+    def is_number(value: Any) -> bool:
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+    if is_number(ref) and is_number(alt):
+        tolerance = 10 ** -FLOAT_PRECISION
+        if math.isclose(ref, alt, rel_tol=tolerance, abs_tol=tolerance):
+            return []
+        return [f"{path}: {ref} != {alt}"]
+    if type(ref) != type(alt):
+        return [f"{path}: {type(ref).__name__} != {type(alt).__name__}"]
+    if isinstance(ref, dict):
+        differences = []
+        for key in sorted(set(ref.keys()) | set(alt.keys())):
+            if key not in alt:
+                differences.append(f"{path}.{key}: missing")
+            elif key not in ref:
+                differences.append(f"{path}.{key}: additional")
+            else:
+                differences.extend(structural_differences(ref[key], alt[key], f"{path}.{key}", key))
+        return differences
+    if isinstance(ref, list):
+        if field in UNORDERED_FIELDS:
+            ref, alt = sorted(ref, key=canonical_record), sorted(alt, key=canonical_record)
+        if len(ref) != len(alt):
+            return [f"{path}: {len(ref)} != {len(alt)} entries"]
+        differences = []
+        for i, (r, a) in enumerate(zip(ref, alt)):
+            differences.extend(structural_differences(r, a, f"{path}[{i}]"))
+        return differences
+    return [] if ref == alt else [f"{path}: {ref!r} != {alt!r}"]
+
+
+def load_json(path: str) -> Optional[Any]:
+    """ Content of a JSON output, None if it cannot be parsed. """
+    try:
+        with open(path, 'r') as fd:
+            return json.load(fd)
+    except ValueError as ex:
+        logger.error(f"    {path}: not valid JSON ({ex})")
+        return None
+
+
+def compare_json(ref_path: str, alt_path: str, max_sites: int) -> Tuple[Optional[int], str]:
+    """
+    Compare two violation files of the form {site_url: [violations]}, ignoring the order of violations per site.
+    JSON files of any other shape are compared structurally, see structural_differences.
+    @return: number of sites or values that differ, None if the files could not be compared, and the unit counted
+    """
+    ref = load_json(ref_path)
+    alt = load_json(alt_path)
+    if ref is None or alt is None:
+        return None, "sites"
+    if not (is_site_shaped(ref) and is_site_shaped(alt)):
+        differences = structural_differences(ref, alt)
+        for d in differences[:max_sites]:
+            logger.info(f"    {d}")
+        if len(differences) > max_sites:
+            logger.info(f"    ... and {len(differences) - max_sites} more values")
+        return len(differences), "values"
+
+    mismatches: List[str] = []
+    for site in sorted(set(ref.keys()) | set(alt.keys())):
+        ref_records = Counter(canonical_record(r) for r in ref.get(site, []))
+        alt_records = Counter(canonical_record(r) for r in alt.get(site, []))
+        if ref_records != alt_records:
+            missing = sum((ref_records - alt_records).values())
+            extra = sum((alt_records - ref_records).values())
+            mismatches.append(f"{site}: {missing} missing, {extra} additional violations")
+
+    for m in mismatches[:max_sites]:
+        logger.info(f"    {m}")
+    if len(mismatches) > max_sites:
+        logger.info(f"    ... and {len(mismatches) - max_sites} more sites")
+    return len(mismatches), "sites"
+
+
+def compare_domains(ref_path: str, alt_path: str, max_sites: int) -> int:
+    """
+    Compare two domain lists as sets.
+    @return: number of sites only present in one of the lists
+    """
+    with open(ref_path, 'r') as fd:
+        ref = set(line.strip() for line in fd if line.strip())
+    with open(alt_path, 'r') as fd:
+        alt = set(line.strip() for line in fd if line.strip())
+
+    differing = sorted(ref ^ alt)
+    for site in differing[:max_sites]:
+        logger.info(f"    {site}: {'missing' if site in ref else 'additional'}")
+    if len(differing) > max_sites:
+        logger.info(f"    ... and {len(differing) - max_sites} more sites")
+    return len(differing)
+
+
+def list_outputs(out_dir: str) -> List[str]:
+    """ Relative paths of all JSON and domain list outputs in the directory. """
+    outputs = []
+    for root, _, files in os.walk(out_dir):
+        for f in files:
+            if f.endswith(".json") or f.endswith(".txt"):
+                outputs.append(os.path.relpath(os.path.join(root, f), out_dir))
+    return sorted(outputs)
+
+
+def run_engine(method: str, db_path: str, extra_args: List[str], engine_dir: str) -> Tuple[int, float, str]:
+    """
+    Run one method script into a fresh output directory.
+    @return: exit code, wall time, output directory
+    """
+    script, has_out_path = METHOD_SCRIPTS[method]
+    shutil.rmtree(engine_dir, ignore_errors=True)
+    os.makedirs(engine_dir)
+    if has_out_path:
+        out_dir = os.path.join(engine_dir, "out") + "/"
+        args = [os.path.join(REPO_ROOT, script), db_path, "--out_path", out_dir] + extra_args
+    else:
+        out_dir = os.path.join(engine_dir, "violation_stats") + "/"
+        args = [os.path.join(REPO_ROOT, script), db_path] + extra_args
+    exit_code, seconds, _ = run_target(args, engine_dir)
+    return exit_code, seconds, out_dir
+
+
+def main():
+    """
+    Run reference and alternative engine for each method, and compare their outputs.
+    @return: exit code, 0 if all outputs are equivalent
+    """
+    argv = None
+    cargs = docopt(__doc__, argv=argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    db_path = os.path.abspath(cargs["<db_path>"])
+    if not os.path.exists(db_path):
+        logger.error("Database file does not exist.")
+        return 1
+
+    alt_args = shlex.split(cargs["--alt_args"])
+    max_sites = int(cargs["--max_sites"])
+    methods = cargs["--methods"].split(",")
+    unknown = set(methods) - set(METHOD_SCRIPTS.keys())
+    if unknown:
+        logger.error(f"Unknown methods: {unknown}")
+        return 1
+
+    all_equal = True
+    # outputs compared structurally rather than per site, and outputs that could not be compared
+    structural: List[str] = []
+    unchecked: List[str] = []
+    for method in methods:
+        method_dir = os.path.join(os.path.abspath(cargs["--work_dir"]), f"method{method}")
+        ref_code, ref_time, ref_out = run_engine(method, db_path, [], os.path.join(method_dir, "reference"))
+        alt_code, alt_time, alt_out = run_engine(method, db_path, alt_args, os.path.join(method_dir, "alternative"))
+
+        speedup = ref_time / alt_time if alt_time > 0 else float("inf")
+        logger.info(f"Method {method}: reference {ref_time:.2f}s, alternative {alt_time:.2f}s, speedup x{speedup:.2f}")
+        if ref_code != 0 or alt_code != 0:
+            logger.error(f"Method {method}: exit codes differ from 0 (reference {ref_code}, alternative {alt_code})")
+            all_equal = False
+            continue
+
+        ref_files = list_outputs(ref_out)
+        alt_files = list_outputs(alt_out)
+        for f in sorted(set(ref_files) ^ set(alt_files)):
+            logger.info(f"  {f}: only produced by the {'reference' if f in ref_files else 'alternative'}")
+            all_equal = False
+
+        for f in sorted(set(ref_files) & set(alt_files)):
+            if f.endswith(".json"):
+                differing, unit = compare_json(os.path.join(ref_out, f), os.path.join(alt_out, f), max_sites)
+            else:
+                differing, unit = compare_domains(os.path.join(ref_out, f), os.path.join(alt_out, f), max_sites), "sites"
+            if differing is None:
+                logger.info(f"  {f}: not checked")
+                unchecked.append(f)
+                all_equal = False
+                continue
+            if unit == "values":
+                structural.append(f)
+            logger.info(f"  {f}: {'equivalent' if differing == 0 else f'{differing} {unit} differ'}"
+                        f"{' (compared structurally)' if unit == 'values' else ''}")
+            all_equal = all_equal and differing == 0
+
+    if structural:
+        logger.info(f"Compared structurally, not per site: {', '.join(structural)}")
+    if unchecked:
+        logger.info(f"Not checked, as they could not be parsed: {', '.join(unchecked)}")
+    logger.info("All outputs are equivalent." if all_equal else "Outputs differ.")
+    return 0 if all_equal else 1
+
+
+if __name__ == "__main__":
+    exit(main())
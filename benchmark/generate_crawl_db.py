@@ -0,0 +1,267 @@
+# Copyright (C) 2021-2022 Dino Bollinger, ETH Zürich, Information Security Group
+# Released under the MIT License
+"""
+Generate a synthetic database with the same schema as the CookieBlock Consent Crawler, for benchmarking.
+The data is random, but reproduces the features the analysis scripts depend on: CMP types and crawl states,
+multilingual expiration strings, multiple domains per declaration, shared third-party cookies with majority
+labels, contradictory and unclassified declarations, undeclared cookies and the Cookiebot consent cookie.
+----------------------------------
+Required arguments:
+    <out_path>   Path of the database file to create. Will be overwritten if it exists.
+Optional arguments:
+    --sites <sites>           Number of websites to generate. [default: 1000]
+    --cookies <cookies>       Average number of declared cookies per site. [default: 20]
+    --updates <updates>       Maximum number of updates per observed cookie. [default: 3]
+    --cmp_mix <cmp_mix>       Relative frequency of Cookiebot, OneTrust, Termly and no CMP. [default: 0.5,0.3,0.15,0.05]
+    --seed <seed>             Seed for the random generator. [default: 0]
+Usage:
+    generate_crawl_db.py <out_path> [--sites <sites>] [--cookies <cookies>] [--updates <updates>] [--cmp_mix <cmp_mix>] [--seed <seed>]
+"""
+
+import os
+import random
+import sqlite3
+import logging
+
+from datetime import datetime, timedelta
+from docopt import docopt
+from typing import Dict, List, Tuple
+
+logger = logging.getLogger("vd")
+
+time_format = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+SCHEMA = """
+CREATE TABLE site_visits (
+    visit_id INTEGER PRIMARY KEY,
+    browser_id INTEGER NOT NULL,
+    site_url VARCHAR(500) NOT NULL,
+    site_rank INTEGER
+);
+CREATE TABLE consent_crawl_results (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    browser_id INTEGER NOT NULL,
+    visit_id INTEGER NOT NULL,
+    cmp_type INTEGER NOT NULL,
+    crawl_state INTEGER NOT NULL,
+    report TEXT
+);
+CREATE TABLE consent_data (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    browser_id INTEGER NOT NULL,
+    visit_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    domain TEXT NOT NULL,
+    cat_id INTEGER NOT NULL,
+    cat_name VARCHAR(256) NOT NULL,
+    purpose TEXT,
+    expiry TEXT,
+    type_name VARCHAR(256),
+    type_id INTEGER
+);
+CREATE TABLE javascript_cookies (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    browser_id INTEGER NOT NULL,
+    visit_id INTEGER NOT NULL,
+    extension_session_uuid TEXT,
+    event_ordinal INTEGER,
+    record_type TEXT,
+    change_cause TEXT,
+    expiry DATETIME,
+    is_http_only BOOLEAN,
+    is_host_only BOOLEAN,
+    is_session BOOLEAN,
+    host TEXT,
+    is_secure BOOLEAN,
+    name TEXT,
+    path TEXT,
+    value TEXT,
+    same_site TEXT,
+    first_party_domain TEXT,
+    store_id TEXT,
+    time_stamp DATETIME
+);
+"""
+
+# Cookiebot categories and the names used for them. 99 is social media, -1 unknown.
+CATEGORIES = [(0, "Necessary"), (1, "Preferences"), (2, "Statistics"), (3, "Marketing"),
+              (4, "Unclassified"), (99, "Social Media"), (-1, "Unknown")]
+CATEGORY_WEIGHTS = [30, 10, 20, 30, 5, 3, 2]
+# Labels used for deviating declarations. The statistics script expects social media to never occur here.
+DEVIATING_CATEGORIES = [c for c in CATEGORIES if c[0] != 99]
+UNCLASSIFIED_NAMES = ["Unclassified", "Uncategorized", "Unclassified Cookies", "No clasificados"]
+
+# Shared third-party cookies with their usual category, such that majority labels exist.
+SHARED_COOKIES = [("_ga", ".google-analytics.com", 2), ("_gid", ".google-analytics.com", 2),
+                  ("_gat", ".google-analytics.com", 2), ("_fbp", ".facebook.com", 3),
+                  ("IDE", ".doubleclick.net", 3), ("test_cookie", ".doubleclick.net", 3),
+                  ("NID", ".google.com", 3), ("__cfduid", ".cloudflare.com", 0),
+                  ("PHPSESSID", "", 0), ("CookieConsent", "", 0), ("lang", "", 1),
+                  ("_hjid", ".hotjar.com", 2), ("YSC", ".youtube.com", 99), ("bcookie", ".linkedin.com", 99)]
+
+# Expiration declarations as (string, seconds). None is a session cookie.
+EXPIRY_STRINGS = [("Session", None), ("Persistent", 3600 * 24 * 365 * 10), ("1 year", 3600 * 24 * 365),
+                  ("2 years", 3600 * 24 * 365 * 2), ("1 day", 3600 * 24), ("30 days", 3600 * 24 * 30),
+                  ("1 month", 3600 * 24 * 30), ("3 months", 3600 * 24 * 90), ("1 hour", 3600),
+                  ("1 minute", 60), ("less than 1 minute", 60), ("1 Jahr", 3600 * 24 * 365),
+                  ("14 Tage", 3600 * 24 * 14), ("6 mois", 3600 * 24 * 180), ("1 año", 3600 * 24 * 365),
+                  ("2 anni", 3600 * 24 * 365 * 2), ("13 maanden", 3600 * 24 * 390), ("1 год", 3600 * 24 * 365),
+                  ("30 дней", 3600 * 24 * 30), ("1 年", 3600 * 24 * 365), ("1 urte bat", 3600 * 24 * 365),
+                  ("1 week 2 days", 3600 * 24 * 9)]
+
+COOKIEBOT_TYPES = [(1, "HTTP"), (2, "HTML"), (3, "Pixel"), (4, "IDB")]
+
+CONSENT_VALUES = ["{stamp:'x',necessary:true,preferences:false,statistics:false,marketing:false,ver:1}",
+                  "{stamp:'x',necessary:true,preferences:true,statistics:true,marketing:true,ver:1}",
+                  "-2"]
+
+
+def format_expiry(cmp_type: int, expiry_string: str, seconds) -> str:
+    """ Expiry as declared by the given CMP. OneTrust declares the number of days. """
+    if cmp_type == 1:
+        return "Session" if seconds is None else str(seconds // (3600 * 24))
+    return expiry_string
+
+
+def generate_database(out_path: str, num_sites: int, cookies_per_site: int, max_updates: int,
+                      cmp_mix: List[float], seed: int) -> Dict[str, int]:
+    """
+    Create the synthetic crawl database.
+    @param out_path: database file to create
+    @param num_sites: number of websites
+    @param cookies_per_site: average number of declared cookies per website
+    @param max_updates: maximum number of updates per observed cookie
+    @param cmp_mix: relative frequency of Cookiebot, OneTrust, Termly and no CMP
+    @param seed: random seed, the same parameters always produce the same database
+    @return: number of rows per table
+    """
+    rng = random.Random(seed)
+    if os.path.exists(out_path):
+        os.remove(out_path)
+
+    conn = sqlite3.connect(out_path)
+    conn.executescript(SCHEMA)
+
+    start = datetime(2021, 5, 1)
+    visits: List[Tuple] = []
+    crawl_results: List[Tuple] = []
+    declarations: List[Tuple] = []
+    cookies: List[Tuple] = []
+
+    for visit_id in range(1, num_sites + 1):
+        site = f"site{visit_id}.{rng.choice(['com', 'de', 'co.uk', 'fr', 'it', 'nl'])}"
+        site_url = f"https://{'www.' if rng.random() < 0.5 else ''}{site}"
+        visits.append((visit_id, 1, site_url, visit_id))
+
+        cmp_type = rng.choices([0, 1, 2, -1], weights=cmp_mix)[0]
+        crawl_state = 0 if cmp_type != -1 and rng.random() < 0.9 else rng.choice([1, 2, 3])
+        crawl_results.append((1, visit_id, cmp_type, crawl_state))
+        if cmp_type == -1 or crawl_state != 0:
+            continue
+
+        visit_time = start + timedelta(seconds=visit_id * 30)
+        ordinal = 0
+        num_cookies = max(1, int(rng.gauss(cookies_per_site, cookies_per_site / 3)))
+        for k in range(num_cookies):
+            if rng.random() < 0.4:
+                name, domain, cat_id = rng.choice(SHARED_COOKIES)
+                domain = domain or "." + site
+                # deviate from the usual label in a few cases
+                if rng.random() < 0.1:
+                    cat_id, _ = rng.choice(DEVIATING_CATEGORIES)
+            else:
+                name = f"{rng.choice(['_pk_id', 'uid', 'sess', 'pref', 'track', 'ab_test', 'visitor'])}_{rng.randrange(50)}"
+                domain = rng.choice(["." + site, site, f"cdn{rng.randrange(20)}.tracker.net", f".ads{rng.randrange(30)}.com"])
+                cat_id = rng.choices([c for c, _ in CATEGORIES], weights=CATEGORY_WEIGHTS)[0]
+
+            cat_name = dict(CATEGORIES)[cat_id]
+            if cat_id == 4:
+                cat_name = rng.choice(UNCLASSIFIED_NAMES)
+            declared_domain = domain
+            if rng.random() < 0.05:
+                declared_domain = domain + "<br/>" + f".partner{rng.randrange(10)}.com"
+            expiry_string, expiry_seconds = rng.choice(EXPIRY_STRINGS)
+            expiry = format_expiry(cmp_type, expiry_string, expiry_seconds)
+            type_id, type_name = rng.choices(COOKIEBOT_TYPES, weights=[70, 25, 4, 1])[0] if cmp_type == 0 else (None, None)
+            declarations.append((1, visit_id, name, declared_domain, cat_id, cat_name, f"Purpose of {name}",
+                                 expiry, type_name, type_id))
+
+            # contradictory declaration of the same cookie
+            if rng.random() < 0.03:
+                other_id, other_name = rng.choice(DEVIATING_CATEGORIES)
+                declarations.append((1, visit_id, name, declared_domain, other_id, other_name, f"Purpose of {name}",
+                                     expiry, type_name, type_id))
+
+            # declared cookies that are not observed
+            if rng.random() < 0.25:
+                continue
+
+            actual_seconds = expiry_seconds
+            if actual_seconds is not None and rng.random() < 0.1:
+                actual_seconds = int(actual_seconds * rng.choice([2, 10, 100]))
+            is_session = actual_seconds is None if rng.random() > 0.05 else actual_seconds is not None
+            value = rng.choice(CONSENT_VALUES) if name == "CookieConsent" else f"{rng.getrandbits(64):x}"
+            host = domain.split("<br/>")[0]
+            for u in range(rng.randint(1, max_updates)):
+                ordinal += 1
+                ts = visit_time + timedelta(seconds=ordinal)
+                exp = ts + timedelta(seconds=actual_seconds or 3600 * 24 * 365)
+                cookies.append((1, visit_id, ordinal, "added-or-changed", "explicit", exp.strftime(time_format),
+                                rng.random() < 0.3, not host.startswith("."), is_session, host, rng.random() < 0.5,
+                                name, "/", value if u == 0 else f"{rng.getrandbits(64):x}",
+                                rng.choice(["no_restriction", "lax", "strict"]), ts.strftime(time_format)))
+            if rng.random() < 0.05:
+                ordinal += 1
+                ts = visit_time + timedelta(seconds=ordinal)
+                cookies.append((1, visit_id, ordinal, "deleted", "expired", ts.strftime(time_format), False,
+                                False, False, host, False, name, "/", "", "lax", ts.strftime(time_format)))
+
+        # cookies that are set but never declared
+        for k in range(rng.randrange(max(1, cookies_per_site // 4))):
+            ordinal += 1
+            ts = visit_time + timedelta(seconds=ordinal)
+            exp = ts + timedelta(days=rng.choice([1, 30, 365]))
+            cookies.append((1, visit_id, ordinal, "added-or-changed", "explicit", exp.strftime(time_format), False,
+                            False, False, rng.choice(["." + site, f".undeclared{rng.randrange(40)}.net"]), False,
+                            f"undeclared_{rng.randrange(100)}", "/", f"{rng.getrandbits(32):x}", "lax",
+                            ts.strftime(time_format)))
+
+    conn.executemany("INSERT INTO site_visits VALUES (?,?,?,?)", visits)
+    conn.executemany("INSERT INTO consent_crawl_results (browser_id, visit_id, cmp_type, crawl_state) VALUES (?,?,?,?)",
+                     crawl_results)
+    conn.executemany("INSERT INTO consent_data (browser_id, visit_id, name, domain, cat_id, cat_name, purpose, "
+                     "expiry, type_name, type_id) VALUES (?,?,?,?,?,?,?,?,?,?)", declarations)
+    conn.executemany("INSERT INTO javascript_cookies (browser_id, visit_id, event_ordinal, record_type, change_cause, "
+                     "expiry, is_http_only, is_host_only, is_session, host, is_secure, name, path, value, same_site, "
+                     "time_stamp) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", cookies)
+    conn.commit()
+    conn.close()
+
+    counts = {"site_visits": len(visits), "consent_crawl_results": len(crawl_results),
+              "consent_data": len(declarations), "javascript_cookies": len(cookies)}
+    logger.info(f"Generated database '{out_path}': {counts}")
+    return counts
+
+
+def main():
+    """
+    Generate a synthetic crawl database.
+    @return: exit code, 0 for success
+    """
+    argv = None
+    cargs = docopt(__doc__, argv=argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    cmp_mix = [float(x) for x in cargs["--cmp_mix"].split(",")]
+    if len(cmp_mix) != 4:
+        logger.error("CMP mix needs to specify four frequencies.")
+        return 1
+
+    generate_database(cargs["<out_path>"], int(cargs["--sites"]), int(cargs["--cookies"]),
+                      int(cargs["--updates"]), cmp_mix, int(cargs["--seed"]))
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
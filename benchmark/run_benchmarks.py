@@ -0,0 +1,188 @@
+# Copyright (C) 2021-2022 Dino Bollinger, ETH Zürich, Information Security Group
+# Released under the MIT License
+"""
+Time the analysis scripts on synthetic crawl databases of increasing size.
+For each scale, a database is generated (or reused), then every target is run in its own process.
+Wall time, throughput in database rows per second and peak memory are recorded as JSON,
+such that the results of two commits can be compared.
+----------------------------------
+Optional arguments:
+    --scales <scales>       Comma-separated list of site counts to benchmark. [default: 500,2000,5000]
+    --cookies <cookies>     Average number of declared cookies per site. [default: 20]
+    --targets <targets>     Comma-separated list of targets to run, all if not specified.
+    --repeat <repeat>       Number of runs per target, the fastest is recorded. [default: 1]
+    --work_dir <work_dir>   Directory for the generated databases and script outputs. [default: ./work/]
+    --output <output>       File to write the results to. [default: ./bench_results.json]
+    --compare <baseline>    Results file of an earlier run, to report the relative change.
+Usage:
+    run_benchmarks.py [--scales <scales>] [--cookies <cookies>] [--targets <targets>] [--repeat <repeat>]
+                      [--work_dir <work_dir>] [--output <output>] [--compare <baseline>]
+"""
+
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+import logging
+
+from datetime import datetime
+from docopt import docopt
+from typing import Any, Dict, List, Optional, Tuple
+
+from generate_crawl_db import generate_database
+
+logger = logging.getLogger("vd")
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+RETRIEVE_MATCHED_SNIPPET = """
+import sqlite3, sys
+from utils import retrieve_matched_cookies_from_DB
+conn = sqlite3.connect(sys.argv[1])
+conn.row_factory = sqlite3.Row
+retrieve_matched_cookies_from_DB(conn)
+"""
+
+# Target name, command arguments and whether the target runs inside the output directory.
+# {db} and {out} are replaced by the database path and the output directory.
+TARGETS: List[Tuple[str, List[str], bool]] = [
+    ("retrieve_matched_cookies_from_DB", ["-c", RETRIEVE_MATCHED_SNIPPET, "{db}"], False),
+    ("method1_wrong_label", ["method1_wrong_label.py", "{db}", "--out_path", "{out}"], False),
+    ("method2_majority_deviation", ["method2_majority_deviation.py", "{db}", "--out_path", "{out}"], False),
+    ("method3_inconsistent_expiry", ["method3_inconsistent_expiry.py", "{db}", "--out_path", "{out}"], False),
+    ("method4_unclassified_cookies", ["method4_unclassified_cookies.py", "{db}", "--out_path", "{out}"], False),
+    ("method5_undeclared_cookies", ["method5_undeclared_cookies.py", "{db}", "--out_path", "{out}"], False),
+    ("method6_contradictory_labels", ["method6_contradictory_labels.py", "{db}", "--out_path", "{out}"], False),
+    ("method7_implicit_consent", ["method7_implicit_consent.py", "{db}", "--out_path", "{out}"], False),
+    ("method8_ignored_choices", ["method8_ignored_choices.py", "{db}", "--out_path", "{out}"], False),
+    ("list_undetected_cookies", ["list_undetected_cookies.py", "{db}"], False),
+    # requires the outputs of all methods, hence runs last
+    ("violation_stats", ["violation_stats/violation_stats.py"], True),
+]
+
+
+def get_commit() -> Optional[str]:
+    """ Current git commit of the repository, if available. """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def count_rows(db_path: str) -> int:
+    """ Number of rows in the two tables all scripts scan. """
+    conn = sqlite3.connect(db_path)
+    total = 0
+    for table in ("consent_data", "javascript_cookies"):
+        total += conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    conn.close()
+    return total
+
+
+def run_target(args: List[str], cwd: str) -> Tuple[int, float, float]:
+    """
+    Run a single target as a child process.
+    @param args: arguments to the Python interpreter
+    @param cwd: working directory of the process
+    @return: exit code, wall time in seconds, peak RSS of the child in megabytes
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = REPO_ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable] + args, cwd=cwd, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # wait4 reports the resource usage of this child alone
+    _, status, rusage = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - start
+    return os.waitstatus_to_exitcode(status), elapsed, rusage.ru_maxrss / 1024
+
+
+def benchmark_scale(num_sites: int, cookies_per_site: int, targets: List[str], repeat: int,
+                    work_dir: str) -> List[Dict[str, Any]]:
+    """
+    Generate the database for one scale and time all selected targets on it.
+    @return: list of measurements, one per target
+    """
+    scale_dir = os.path.join(os.path.abspath(work_dir), f"sites_{num_sites}_cookies_{cookies_per_site}")
+    out_dir = os.path.join(scale_dir, "out") + "/"
+    os.makedirs(out_dir, exist_ok=True)
+    db_path = os.path.join(scale_dir, "crawl.sqlite")
+    if not os.path.exists(db_path):
+        generate_database(db_path, num_sites, cookies_per_site, 3, [0.5, 0.3, 0.15, 0.05], seed=num_sites)
+    rows = count_rows(db_path)
+
+    results = []
+    for name, args, in_out_dir in TARGETS:
+        if name not in targets:
+            continue
+        script_args = [a.format(db=db_path, out=out_dir) for a in args]
+        if script_args[0] != "-c":
+            script_args[0] = os.path.join(REPO_ROOT, script_args[0])
+
+        best: Optional[Tuple[int, float, float]] = None
+        for _ in range(repeat):
+            measurement = run_target(script_args, out_dir if in_out_dir else scale_dir)
+            if best is None or measurement[1] < best[1]:
+                best = measurement
+        exit_code, seconds, peak_rss = best
+        logger.info(f"{num_sites} sites -- {name}: {seconds:.2f}s, {peak_rss:.1f} MB, exit code {exit_code}")
+        results.append({"scale": num_sites, "cookies_per_site": cookies_per_site, "target": name,
+                        "rows": rows, "seconds": seconds, "rows_per_second": rows / seconds if seconds > 0 else None,
+                        "peak_rss_mb": peak_rss, "exit_code": exit_code})
+    return results
+
+
+def compare_results(results: List[Dict[str, Any]], baseline_path: str) -> None:
+    """ Log the relative change in time and memory against an earlier results file. """
+    with open(baseline_path, 'r') as fd:
+        baseline = json.load(fd)
+    old = {(r["scale"], r["target"]): r for r in baseline["results"]}
+    logger.info(f"Comparison against commit {baseline.get('commit')}:")
+    for r in results:
+        key = (r["scale"], r["target"])
+        if key not in old:
+            continue
+        time_ratio = r["seconds"] / old[key]["seconds"] if old[key]["seconds"] > 0 else float("nan")
+        mem_ratio = r["peak_rss_mb"] / old[key]["peak_rss_mb"] if old[key]["peak_rss_mb"] > 0 else float("nan")
+        logger.info(f"{r['scale']} sites -- {r['target']}: time x{time_ratio:.2f}, memory x{mem_ratio:.2f}")
+
+
+def main():
+    """
+    Run the benchmarks at each scale and write the results.
+    @return: exit code, 0 for success
+    """
+    argv = None
+    cargs = docopt(__doc__, argv=argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    all_targets = [t[0] for t in TARGETS]
+    targets = cargs["--targets"].split(",") if cargs["--targets"] else all_targets
+    unknown = set(targets) - set(all_targets)
+    if unknown:
+        logger.error(f"Unknown targets: {unknown}")
+        return 1
+
+    results = []
+    for scale in cargs["--scales"].split(","):
+        results.extend(benchmark_scale(int(scale), int(cargs["--cookies"]), targets,
+                                       int(cargs["--repeat"]), cargs["--work_dir"]))
+
+    report = {"commit": get_commit(), "timestamp": datetime.now().isoformat(),
+              "python": sys.version.split()[0], "results": results}
+    with open(cargs["--output"], 'w') as fd:
+        json.dump(report, fd, indent=4, sort_keys=True)
+    logger.info(f"Results written to: '{cargs['--output']}'")
+
+    if cargs["--compare"]:
+        compare_results(results, cargs["--compare"])
+
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,497 @@
+# Copyright (C) 2021-2022 Dino Bollinger, ETH Zürich, Information Security Group
+# Released under the MIT License
+"""
+Vectorized backend of the detection methods, running over a columnar export of the crawl (see crawl_columns.py).
+Instead of looping over database rows, each method is expressed as masks, group-bys and joins over whole columns.
+Strings are compared through their dictionary codes, predicates on strings are evaluated once per distinct string,
+and only the rows that end up in the outputs are decoded.
+The methods select this backend with their "--columns" option, and produce the same outputs as with the database.
+"""
+
+import os
+import logging
+
+import numpy as np
+
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from crawl_columns import CrawlColumns, ColumnTable, MANIFEST_FILE
+from utils import (get_violation_details_consent_table, canonical_domain, consent_domain_matches,
+                   time_format, metrics)
+
+logger = logging.getLogger("vd")
+
+# Columns of the consent table that make up its violation details
+CONSENT_DETAIL_COLUMNS = ["visit_id", "site_url", "cmp_type", "consent_name", "consent_domain", "purpose",
+                          "cat_id", "cat_name", "type_id", "type_name", "consent_expiry"]
+
+
+def load_columns(columns_path: str, db_path: str) -> Optional[CrawlColumns]:
+    """
+    Open the columnar export of a crawl, verifying that it is up to date with the database.
+    @param columns_path: directory written by crawl_columns.py
+    @param db_path: database the export is expected to come from
+    @return: the export, None if it is missing or out of date
+    """
+    if not os.path.exists(os.path.join(columns_path, MANIFEST_FILE)):
+        logger.error(f"'{columns_path}' is not a columnar export.")
+        return None
+    try:
+        crawl = CrawlColumns(columns_path)
+    except ValueError as e:
+        logger.error(f"{e}, export the database again.")
+        return None
+    if not crawl.matches(db_path):
+        logger.error(f"The columnar export '{columns_path}' is out of date, export the database again.")
+        return None
+    logger.info(f"Columnar export used: {columns_path}")
+    return crawl
+
+
+def string_mask(crawl: CrawlColumns, codes: np.ndarray, predicate: Callable[[str], Any]) -> np.ndarray:
+    """ Evaluate a predicate once per distinct string of a column, and expand the result to a mask over the rows. """
+    unique, inverse = np.unique(codes, return_inverse=True)
+    matches = np.array([bool(predicate(s)) for s in crawl.strings(unique)], dtype=bool)
+    return matches[inverse.reshape(-1)]
+
+
+def group_ids(*columns: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Group the rows by the combination of their values in the columns.
+    @return: group of each row, and the first row of each group. Groups are numbered in order of first occurrence.
+    """
+    keys = np.stack([np.asarray(c, dtype=np.int64) for c in columns], axis=1)
+    if len(keys) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    order = np.argsort(first, kind="stable")
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return rank[inverse.reshape(-1)], first[order]
+
+
+def key_ids(crawl: CrawlColumns, columns: List[np.ndarray], strip: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Group the rows by the key the row-based methods build by joining string columns with ";".
+    Usually, this is the same as grouping by the codes of the columns. Only if one of the strings contains
+    the separator, different combinations can build the same key, and the joined keys are compared instead.
+    @param columns: string columns making up the key
+    @param strip: whether the strings are stripped before they are joined
+    @return: group of each row, and the first row of each group, as for group_ids
+    """
+    ids = []
+    decoded = []
+    separator = False
+    for codes in columns:
+        unique, inverse = np.unique(codes, return_inverse=True)
+        strings = crawl.strings(unique)
+        if strip:
+            strings = [s.strip() for s in strings]
+        separator = separator or any(";" in s for s in strings)
+        # codes of the stripped strings, equal for strings that only differ in whitespace
+        string_ids: Dict[str, int] = dict()
+        ids.append(np.array([string_ids.setdefault(s, len(string_ids)) for s in strings],
+                            dtype=np.int64)[inverse.reshape(-1)])
+        decoded.append((strings, inverse.reshape(-1)))
+    if not separator:
+        return group_ids(*ids)
+    keys: Dict[str, int] = dict()
+    joined = [keys.setdefault(";".join(parts), len(keys))
+              for parts in zip(*([strings[i] for i in inverse.tolist()] for strings, inverse in decoded))]
+    return group_ids(np.array(joined, dtype=np.int64))
+
+
+def group_by_site(sites: List[str], records: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+    """ Records per site, in the order of the records. """
+    details: Dict[str, List[Dict[str, Any]]] = dict()
+    for site, record in zip(sites, records):
+        details.setdefault(site, []).append(record)
+    return details
+
+
+def consent_records(consent: ColumnTable, rows: np.ndarray) -> List[Dict[str, Any]]:
+    """ Violation details of the given rows of the consent table. """
+    values = [consent.values(c, rows) for c in CONSENT_DETAIL_COLUMNS]
+    return [get_violation_details_consent_table(dict(zip(CONSENT_DETAIL_COLUMNS, row))) for row in zip(*values)]
+
+
+def distinct_sites(crawl: CrawlColumns, codes: np.ndarray) -> Set[str]:
+    return set(crawl.strings(np.unique(codes)))
+
+
+def wrong_label(crawl: CrawlColumns, name_pattern: Any, domain_pattern: Any,
+                expected_label: int) -> Tuple[Dict[str, List[Dict[str, Any]]], List[int], int, Set[str]]:
+    """
+    Method 1: consent table entries matching the name and domain pattern, with a label other than the expected one.
+    @return: violations per site, violations per category, number of matching entries, sites with matching entries
+    """
+    consent = crawl["consent"]
+    matching = (string_mask(crawl, consent["consent_name"], name_pattern.match)
+                & string_mask(crawl, consent["consent_domain"], domain_pattern.search))
+    cat_id = np.asarray(consent["cat_id"])
+    rows = np.flatnonzero(matching & (cat_id != expected_label) & (cat_id != -1))
+
+    violation_cats = np.where(cat_id[rows] == 99, 5, cat_id[rows])
+    violation_counts = np.bincount(violation_cats, minlength=7).tolist()
+    details = group_by_site(consent.values("site_url", rows), consent_records(consent, rows))
+    return details, violation_counts, int(matching.sum()), distinct_sites(crawl, consent["site_url"][matching])
+
+
+def majority_deviation(crawl: CrawlColumns, threshold: int,
+                       min_ratio: float) -> Tuple[Dict[str, List[Dict[str, Any]]], int, Set[str]]:
+    """
+    Method 2: entries deviating from the majority label of their cookie. The category counts are a
+    scatter-add over the (name, domain) groups, and the majority an argmax over the count matrix.
+    @return: violations per site, number of entries analyzed, sites analyzed
+    """
+    consent = crawl["consent"]
+    # only the first entry per site, name and domain is analyzed
+    _, rows = key_ids(crawl, [consent["site_url"], consent["consent_name"], consent["consent_domain"]], strip=True)
+    rows = np.sort(rows)
+
+    ident, _ = group_ids(consent["consent_name"][rows], consent["consent_domain"][rows])
+    labels = np.asarray(consent["cat_id"][rows])
+    # position in the category counts: ne, fu, an, ad, uncat, socmedia, unknown; -1 if not counted
+    index = np.where((labels >= 0) & (labels < 5), labels, -1)
+    index[labels == 99] = 5
+    index[labels == -1] = 6
+    counted = index >= 0
+    counts = np.zeros((ident.max() + 1 if len(ident) else 0, 7), dtype=np.int64)
+    np.add.at(counts, (ident[counted], index[counted]), 1)
+
+    sum_total = counts[:, 0:6].sum(axis=1)
+    majority = counts[:, 0:6].argmax(axis=1) if len(counts) else np.zeros(0, dtype=np.int64)
+    maj_count = counts[np.arange(len(counts)), majority]
+    maj_ratio = np.where(sum_total > 0, maj_count / np.maximum(sum_total, 1), 0.0)
+    # only recognize majorities for necessary, functional, analytics, advertising and social media
+    applies = (((majority <= 3) | (majority == 5)) & (sum_total >= threshold) & (maj_ratio > min_ratio))
+
+    deviating = (labels >= 0) & (labels <= 3) & applies[ident] & (labels != majority[ident])
+    violations = rows[deviating]
+    records = consent_records(consent, violations)
+    for record, m, c, r in zip(records, majority[ident[deviating]].tolist(), maj_count[ident[deviating]].tolist(),
+                               maj_ratio[ident[deviating]].tolist()):
+        record["majority"], record["maj_count"], record["maj_ratio"] = m, c, r
+    details = group_by_site(consent.values("site_url", violations), records)
+    return details, len(rows), distinct_sites(crawl, consent["site_url"][rows])
+
+
+def unclassified_cookies(crawl: CrawlColumns, unclass_pattern: Any) -> Tuple[Dict[str, List[Dict[str, Any]]], int, Set[str]]:
+    """
+    Method 4: entries in the unclassified category, or with an unclassified category name.
+    @return: violations per site, number of entries, sites in total
+    """
+    consent = crawl["consent"]
+    mask = (np.asarray(consent["cat_id"]) == 4) | string_mask(crawl, consent["cat_name"], unclass_pattern.match)
+    rows = np.flatnonzero(mask)
+    details = group_by_site(consent.values("site_url", rows), consent_records(consent, rows))
+    return details, len(consent), distinct_sites(crawl, consent["site_url"])
+
+
+def undeclared_cookies(crawl: CrawlColumns, split_consent_domains: Callable[[str], List[str]],
+               output_fields: List[str], output_keys: List[str]) -> Tuple[Dict[str, List[Dict[str, Any]]], int, int]:
+    """
+    Method 5: anti-join of the observed cookies with the declared cookies of the same site,
+    both identified by (site, name, canonical domain).
+    @param split_consent_domains: splits the domain string of a declaration into its domains
+    @param output_fields: columns of the observed cookies in the output
+    @param output_keys: keys of these columns in the output
+    @return: violations per site, number of distinct cookies observed, number of sites observed
+    """
+    consent = crawl["consent"]
+    cookies = crawl["cookies"]
+    canon_ids: Dict[str, int] = dict()
+
+    # declared (site, name, canonical domain), one per domain listed in a declaration
+    unique, inverse = np.unique(consent["consent_domain"], return_inverse=True)
+    inverse = inverse.reshape(-1)
+    canon_lists = [[canon_ids.setdefault(canonical_domain(d.strip()), len(canon_ids)) for d in split_consent_domains(s)]
+                   for s in crawl.strings(unique)]
+    lengths = np.array([len(c) for c in canon_lists], dtype=np.int64)
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1])) if len(lengths) else lengths
+    flat = np.array([c for canon in canon_lists for c in canon], dtype=np.int64)
+    row_lengths = lengths[inverse]
+    declared_rows = np.repeat(np.arange(len(consent)), row_lengths)
+    position = np.arange(row_lengths.sum()) - np.repeat(np.cumsum(row_lengths) - row_lengths, row_lengths)
+    declared_canon = flat[np.repeat(starts[inverse], row_lengths) + position]
+    declared_site = consent["site_url"][declared_rows]
+    declared_name = consent["consent_name"][declared_rows]
+
+    # observed cookies on sites with a working CMP, ordered by site, visit, name and time
+    observed = np.flatnonzero((np.asarray(cookies["cmp_type"]) != -1) & (np.asarray(cookies["crawl_state"]) == 0))
+    observed = observed[np.lexsort((cookies["time_stamp"][observed], cookies["name"][observed],
+                                    cookies["visit_id"][observed], cookies["site_url"][observed]))]
+    unique, inverse = np.unique(cookies["cookie_domain"][observed], return_inverse=True)
+    observed_canon = np.array([canon_ids.setdefault(canonical_domain(d), len(canon_ids)) for d in crawl.strings(unique)],
+                              dtype=np.int64)[inverse.reshape(-1)]
+    observed_site = cookies["site_url"][observed]
+    observed_name = cookies["name"][observed]
+
+    # just keep the first instance of each cookie per site
+    _, first = group_ids(observed_site, observed_name, observed_canon)
+    first = np.sort(first)
+
+    # anti-join through IDs over the identities of both sides
+    ident, _ = group_ids(np.concatenate((declared_site, observed_site[first])),
+                         np.concatenate((declared_name, observed_name[first])),
+                         np.concatenate((declared_canon, observed_canon[first])))
+    is_undeclared = ~np.isin(ident[len(declared_rows):], ident[:len(declared_rows)])
+    rows = observed[first[is_undeclared]]
+
+    values = [cookies.values(f, rows) for f in output_fields]
+    records = [dict(zip(output_keys, record)) for record in zip(*values)]
+    details = group_by_site(cookies.values("site_url", rows), records)
+    return details, len(first), len(np.unique(observed_site))
+
+
+def contradictory_labels(crawl: CrawlColumns) -> Tuple[Dict[str, Dict[str, Any]], int, Set[str]]:
+    """
+    Method 6: declarations of the same cookie on the same site with more than one distinct label.
+    The details of the first declaration are kept, together with each deviating label in order.
+    @return: conflicting declarations keyed by site, name and domain, number of distinct declarations, sites in total
+    """
+    consent = crawl["consent"]
+    group, first = key_ids(crawl, [consent["site_url"], consent["consent_name"], consent["consent_domain"]])
+    labels = np.asarray(consent["cat_id"])
+    deviating = np.flatnonzero(labels != labels[first][group])
+    conflicting = np.unique(group[deviating])
+
+    records = consent_records(consent, first[conflicting])
+    additional: Dict[int, List[int]] = {g: [] for g in conflicting.tolist()}
+    for g, label in zip(group[deviating].tolist(), labels[deviating].tolist()):
+        additional[g].append(label)
+    declarations = dict()
+    for record, g in zip(records, conflicting.tolist()):
+        record["additional_labels"] = additional[g]
+        declarations[record["site_url"] + ";" + record["name"] + ";" + record["domain"]] = record
+    return declarations, len(first), distinct_sites(crawl, consent["site_url"])
+
+
+def parse_timestamps(crawl: CrawlColumns, codes: np.ndarray) -> np.ndarray:
+    """ Timestamps of a column in microseconds, each distinct string is only parsed once. """
+    unique, inverse = np.unique(codes, return_inverse=True)
+    parsed = [datetime.strptime(s, time_format) for s in crawl.strings(unique)]
+    return np.array(parsed, dtype="datetime64[us]").astype(np.int64)[inverse.reshape(-1)]
+
+
+class MatchedColumns:
+    """
+    Vectorized equivalent of retrieve_matched_cookies_from_DB, over the matched table of an export.
+    Each entry corresponds to a cookie (name, domain, path, site) of the matched cookie dictionary,
+    and each update to an element of its "variable_data".
+    """
+
+    def __init__(self, crawl: CrawlColumns):
+        self.crawl = crawl
+        self.table = table = crawl["matched"]
+        cat_id = np.asarray(table["cat_id"])
+        label = np.where(cat_id == 99, 5, np.where(cat_id == -1, 6, cat_id))
+        cmp_type = np.asarray(table["cmp_type"])
+
+        # expiration dates from the year 10000 onwards are ignored, as are cookies whose domain was not declared
+        valid = ~string_mask(crawl, table["actual_expiry"], lambda s: s.startswith("+0"))
+        pair, pair_first = group_ids(table["cookie_domain"], table["consent_domain"])
+        pair_match = np.array([consent_domain_matches(a, c) for a, c in
+                               zip(table.values("cookie_domain", pair_first), table.values("consent_domain", pair_first))],
+                              dtype=bool)
+        valid &= pair_match[pair]
+        rows = np.flatnonzero(valid)
+        logger.info(f"Encountered {len(table) - len(rows)} domain mismatches.")
+
+        # cookies whose label or CMP differs between updates are removed entirely
+        key_columns = [np.asarray(table[c][rows]) for c in ("name", "cookie_domain", "path", "site_url")]
+        entry, first = key_ids(crawl, key_columns)
+        mismatch = (label[rows] != label[rows[first]][entry]) | (cmp_type[rows] != cmp_type[rows[first]][entry])
+        for column in key_columns:
+            # only differs if the joined keys of different cookies collide
+            mismatch |= column != column[first][entry]
+        inconsistent = np.zeros(len(first), dtype=bool)
+        inconsistent[entry[mismatch]] = True
+        logger.info(f"Number of unique cookies blacklisted due to inconsistencies {int(inconsistent.sum())}")
+
+        kept = ~inconsistent[entry]
+        renumber = np.cumsum(~inconsistent) - 1
+        #: rows of the updates, entry of each update, and first row of each entry
+        self.rows = rows[kept]
+        self.entry = renumber[entry[kept]]
+        self.first = rows[first[~inconsistent]]
+        self.label = label[self.first]
+        self.site = table["site_url"][self.first]
+        self.session = np.asarray(table["is_session"][self.rows]) != 0
+        # position of each update in the "variable_data" of its entry
+        order = np.argsort(self.entry, kind="stable")
+        starts = np.concatenate(([0], np.cumsum(np.bincount(self.entry, minlength=len(self.first)))[:-1]))
+        self.position = np.empty(len(self.rows), dtype=np.int64)
+        self.position[order] = np.arange(len(self.rows)) - starts[self.entry[order]]
+
+        self.expiry = np.zeros(len(self.rows), dtype=np.int64)
+        persistent = ~self.session
+        if persistent.any():
+            end = parse_timestamps(crawl, table["actual_expiry"][self.rows[persistent]])
+            start = parse_timestamps(crawl, table["time_stamp"][self.rows[persistent]])
+            # truncated like int(timedelta.total_seconds())
+            self.expiry[persistent] = np.trunc((end - start) / 10 ** 6).astype(np.int64)
+        logger.info(f"Extracted {len(self.rows)} cookie updates.")
+        logger.info(f"Unique training data entries in dictionary: {len(self.first)}")
+        metrics.count("cookie_updates", len(self.rows))
+
+    def __len__(self) -> int:
+        return len(self.first)
+
+    def values(self, column: str, entries: np.ndarray) -> List[Any]:
+        """ Values of a column of the matched table for the given entries, taken from their first update. """
+        return self.table.values(column, self.first[entries])
+
+    def records(self, entries: Optional[np.ndarray] = None) -> List[Dict[str, Any]]:
+        """
+        Matched cookie records of the given entries, as in the dictionary of retrieve_matched_cookies_from_DB.
+        @param entries: entries to decode, in this order, all if None
+        """
+        entries = np.arange(len(self.first)) if entries is None else np.asarray(entries, dtype=np.int64)
+        columns = {c: self.values(c, entries) for c in ("visit_id", "name", "cookie_domain", "consent_domain", "path",
+                                                        "site_url", "cat_name", "cmp_type", "consent_expiry",
+                                                        "time_stamp")}
+        labels = self.label[entries].tolist()
+
+        # updates of the selected entries, in the order of the entries
+        selected = np.zeros(len(self.first), dtype=bool)
+        selected[entries] = True
+        updates = np.flatnonzero(selected[self.entry])
+        update_rows = self.rows[updates]
+        update_values = {c: self.table.values(c, update_rows) for c in ("value", "same_site")}
+        flags = {c: (np.asarray(self.table[c][update_rows]) != 0).tolist()
+                 for c in ("is_session", "is_http_only", "is_host_only", "is_secure")}
+        expiries = self.expiry[updates].tolist()
+        variable_data: Dict[int, List[Dict[str, Any]]] = {e: [] for e in entries.tolist()}
+        for i, e in enumerate(self.entry[updates].tolist()):
+            variable_data[e].append({
+                "value": update_values["value"][i],
+                "expiry": expiries[i],
+                "session": flags["is_session"][i],
+                "http_only": flags["is_http_only"][i],
+                "host_only": flags["is_host_only"][i],
+                "secure": flags["is_secure"][i],
+                "same_site": update_values["same_site"][i]
+            })
+
+        return [{"visit_id": columns["visit_id"][i],
+                 "name": columns["name"][i],
+                 "domain": columns["cookie_domain"][i],
+                 "consent_domain": columns["consent_domain"][i],
+                 "path": columns["path"][i],
+                 "site_url": columns["site_url"][i],
+                 "label": labels[i],
+                 "cat_name": columns["cat_name"][i],
+                 "cmp_type": columns["cmp_type"][i],
+                 "consent_expiry": columns["consent_expiry"][i],
+                 "timestamp": columns["time_stamp"][i],
+                 "variable_data": variable_data[e]} for i, e in enumerate(entries.tolist())]
+
+    def first_update(self, condition: np.ndarray) -> np.ndarray:
+        """
+        First update of each entry that fulfills the condition.
+        @param condition: mask over the updates
+        @return: index of the update for each entry, -1 if none of its updates fulfills the condition
+        """
+        result = np.full(len(self.first), -1, dtype=np.int64)
+        candidates = np.flatnonzero(condition)
+        entries, index = np.unique(self.entry[candidates], return_index=True)
+        result[entries] = candidates[index]
+        return result
+
+    def split_by_label(self, sites: Optional[Set[str]] = None) \
+            -> Tuple[List[Dict[str, List[Dict[str, Any]]]], List[int], List[Set[str]], int, Set[str]]:
+        """
+        Methods 7 and 8: matched cookies by label, optionally only on the given sites.
+        @param sites: sites to keep, all if None
+        @return: cookies per site for each label, counts per label, sites per label, number of cookies, sites
+        """
+        entries = np.arange(len(self.first))
+        if sites is not None:
+            codes = np.array([self.crawl.code(s) for s in sites], dtype=np.int64)
+            entries = np.flatnonzero(np.isin(self.site, codes))
+        records = self.records(entries)
+        labels = self.label[entries]
+
+        details: List[Dict[str, List[Dict[str, Any]]]] = []
+        counts = []
+        domains = []
+        for label in range(7):
+            selected = np.flatnonzero(labels == label).tolist()
+            details.append(group_by_site([records[i]["site_url"] for i in selected], [records[i] for i in selected]))
+            counts.append(len(selected))
+            domains.append(set(details[-1].keys()))
+        return details, counts, domains, len(entries), set(r["site_url"] for r in records)
+
+
+def expiry_inconsistencies(matched: MatchedColumns, convert_expiry: Callable[[str, int], int], min_diff: int) \
+        -> Tuple[List[Tuple[Dict[str, Any], Dict[str, Any], Any]], Dict[str, int], int, Set[str]]:
+    """
+    Method 3: cookies whose observed expiry contradicts the declared expiry.
+    For each cookie, the first update contradicting the declaration is found with a mask over all updates.
+    @param convert_expiry: conversion of a declared expiry to seconds, -1 if it cannot be converted
+    @param min_diff: minimum difference between declared and actual expiry to report
+    @return: (cookie, update, difference) for each inconsistency in the order of the cookies, counts per kind
+             of inconsistency, number of cookies with a declared expiry, sites of these cookies
+    """
+    crawl = matched.crawl
+    names = matched.table["name"][matched.first]
+    expiry_codes = matched.table["consent_expiry"][matched.first]
+    checked = (names != crawl.code("CookieConsent")) & (expiry_codes >= 0)
+
+    # kind of declaration, evaluated once per distinct expiry string
+    kinds = {"session": 0, "persistent": 1, "persistant": 1, "": 3}
+    unique, inverse = np.unique(expiry_codes, return_inverse=True)
+    kind = np.array([kinds.get(s.lower(), 2) if s is not None else -1 for s in crawl.strings(unique)],
+                    dtype=np.int64)[inverse.reshape(-1)]
+    kind[~checked] = -1
+    for e in np.flatnonzero(kind == 3).tolist():
+        logger.info(f"Expiry string was empty for cookie: {matched.values('name', [e])[0]};"
+                    f"{matched.values('cookie_domain', [e])[0]}")
+
+    session = matched.session
+    entry_kind = kind[matched.entry]
+
+    # the row-based loop stops at a session update, so the declared expiry is only converted
+    # for the cookies whose first update is persistent
+    converted = np.full(len(matched), -1, dtype=np.int64)
+    first_update = matched.first_update(np.ones(len(session), dtype=bool))
+    to_convert = np.flatnonzero((kind == 2) & ~session[first_update])
+    pairs = {}
+    for e, s, c in zip(to_convert.tolist(), matched.values("consent_expiry", to_convert), matched.values("cmp_type", to_convert)):
+        if (s, c) not in pairs:
+            pairs[(s, c)] = convert_expiry(s, c)
+        converted[e] = pairs[(s, c)]
+        if pairs[(s, c)] == -1:
+            logger.warning(f"Skipped because could not convert date: {s}")
+
+    entry_converted = converted[matched.entry]
+    diff = np.abs(matched.expiry - entry_converted)
+    too_long = (~session & (entry_converted != -1) & (diff >= min_diff) & (matched.expiry > entry_converted * 1.5))
+    # the loop also stops at a first update with a declared expiry that cannot be converted
+    unconvertible = np.zeros(len(matched), dtype=bool)
+    unconvertible[to_convert] = converted[to_convert] == -1
+    condition = np.where(entry_kind == 0, ~session, np.where(entry_kind == 1, session, session | too_long))
+    condition &= (entry_kind >= 0) & (entry_kind <= 2) & ~unconvertible[matched.entry]
+    found = matched.first_update(condition)
+
+    violating = np.flatnonzero(found >= 0)
+    records = matched.records(violating)
+    update_index = found[violating]
+
+    counts = {"persistent_as_session": 0, "session_as_persistent": 0, "wrong_expiry": 0}
+    inconsistencies = []
+    for record, e, u in zip(records, violating.tolist(), update_index.tolist()):
+        if kind[e] == 0:
+            d = "persistent_as_session"
+            counts["persistent_as_session"] += 1
+        elif session[u]:
+            d = "session_as_persistent"
+            counts["session_as_persistent"] += 1
+        else:
+            d = int(diff[u])
+            counts["wrong_expiry"] += 1
+        inconsistencies.append((record, record["variable_data"][matched.position[u]], d))
+    return inconsistencies, counts, int(checked.sum()), set(crawl.strings(matched.site[checked]))
+
@@ -0,0 +1,298 @@
+# Copyright (C) 2021-2022 Dino Bollinger, ETH Zürich, Information Security Group
+# Released under the MIT License
+"""
+Columnar export of the crawl data, such that analyses can run over the columns without reading the database.
+The projections of the consent table, the observed cookies and the matched cookies, each joined with the site
+visits and crawl results, are written as one NumPy .npy file per column. Strings are stored as integer codes
+into a dictionary shared by all tables, which is sorted, such that equal strings have equal codes in every table
+and codes compare like the strings. Integer columns store NULL as NULL_INT, string columns as code -1.
+The loader memory-maps the files, so loading takes no time and the operating system shares the pages between
+processes that load the same export.
+Layout of the export directory:
+    manifest.json                       Source database, row counts and column types of each table.
+    strings_offsets.npy, strings.bin    String dictionary: start offsets of each string in the UTF-8 pool.
+    <table>/<column>.npy                Column of a table.
+----------------------------------
+Commands:
+    export  Export a crawl database.
+    info    Print the tables of an export, and whether it matches its source database.
+Required arguments:
+    <db_path>       Path to the crawl database to export.
+    <columns_path>  Directory of the export, replaced if it exists.
+Optional arguments:
+    --tables <tables>: Comma-separated tables to export (default: all).
+Usage:
+    crawl_columns.py export <db_path> <columns_path> [--tables <tables>]
+    crawl_columns.py info <columns_path>
+"""
+
+import json
+import mmap
+import os
+import shutil
+import sqlite3
+import logging
+
+import numpy as np
+
+from array import array
+from datetime import datetime
+from docopt import docopt
+from typing import Any, Dict, Iterator, List, Optional
+
+from pipeline import database_fingerprint
+from utils import ORDERED_CONSENTDATA_QUERY, JAVASCRIPTCOOKIE_QUERY, MATCHED_COOKIEDATA_QUERY, metrics
+
+logger = logging.getLogger("vd")
+
+FORMAT_VERSION = 2
+MANIFEST_FILE = "manifest.json"
+
+# NULL in integer columns
+NULL_INT = np.iinfo(np.int64).min
+
+# Query and columns of each table, columns are either "int" or "str"
+TABLES: Dict[str, Any] = {
+    "consent": (ORDERED_CONSENTDATA_QUERY, {
+        "visit_id": "int", "site_url": "str", "cmp_type": "int", "crawl_state": "int",
+        "consent_name": "str", "consent_domain": "str", "purpose": "str", "cat_id": "int",
+        "cat_name": "str", "type_name": "str", "type_id": "int", "consent_expiry": "str"}),
+    "cookies": (JAVASCRIPTCOOKIE_QUERY, {
+        "visit_id": "int", "site_url": "str", "cmp_type": "int", "crawl_state": "int",
+        "name": "str", "cookie_domain": "str", "path": "str", "value": "str", "actual_expiry": "str",
+        "is_session": "int", "is_http_only": "int", "is_host_only": "int", "is_secure": "int",
+        "same_site": "str", "time_stamp": "str"}),
+    "matched": (MATCHED_COOKIEDATA_QUERY, {
+        "visit_id": "int", "site_url": "str", "cmp_type": "int", "name": "str", "cookie_domain": "str",
+        "path": "str", "consent_domain": "str", "value": "str", "purpose": "str", "cat_id": "int",
+        "cat_name": "str", "type_name": "str", "type_id": "int", "consent_expiry": "str", "actual_expiry": "str",
+        "is_session": "int", "is_http_only": "int", "is_host_only": "int", "is_secure": "int",
+        "same_site": "str", "time_stamp": "str"}),
+}
+
+# Rows fetched, and rows decoded, at once
+CHUNK_SIZE = 10000
+
+
+def export_columns(db_path: str, columns_path: str, tables: Optional[List[str]] = None) -> Dict[str, int]:
+    """
+    Export the tables of a crawl database. The export is written to a temporary directory first,
+    which then replaces the previous export, such that readers never see a partial export.
+    @param db_path: path to the crawl database
+    @param columns_path: directory to write the export to
+    @param tables: tables to export, all if None
+    @return: number of rows per table
+    """
+    tables = tables if tables is not None else list(TABLES.keys())
+    conn = sqlite3.connect(db_path)
+    string_ids: Dict[str, int] = dict()
+
+    # codes are assigned in order of appearance first, and remapped to sorted order once all strings are known
+    data: Dict[str, Dict[str, array]] = dict()
+    for table in tables:
+        query, columns = TABLES[table]
+        data[table] = {c: array('i') if t == "str" else array('q') for c, t in columns.items()}
+        appends = [(data[table][c].append, t == "str") for c, t in columns.items()]
+        with metrics.stage(f"export_{table}"):
+            cur = conn.execute(query)
+            if [d[0] for d in cur.description] != list(columns):
+                raise ValueError(f"Columns of table '{table}' do not match its query")
+            rows = 0
+            while True:
+                chunk = cur.fetchmany(CHUNK_SIZE)
+                if not chunk:
+                    break
+                for row in chunk:
+                    for (append, is_str), v in zip(appends, row):
+                        if v is None:
+                            append(-1 if is_str else NULL_INT)
+                        elif is_str:
+                            code = string_ids.get(v)
+                            if code is None:
+                                code = string_ids[v] = len(string_ids)
+                            append(code)
+                        else:
+                            append(v)
+                rows += len(chunk)
+            cur.close()
+        metrics.add_rows(f"export_{table}", rows)
+        logger.info(f"Read {rows} rows of table '{table}'")
+    fingerprint = database_fingerprint(db_path)
+    conn.close()
+
+    strings = list(string_ids)
+    del string_ids
+    order = sorted(range(len(strings)), key=strings.__getitem__)
+    remap = np.empty(len(strings) + 1, dtype=np.int32)
+    remap[order] = np.arange(len(strings), dtype=np.int32)
+    # code -1 is kept as -1 through the last entry of the remap
+    remap[-1] = -1
+
+    tmp_path = f"{columns_path.rstrip(os.sep)}.tmp{os.getpid()}"
+    os.makedirs(tmp_path)
+    encoded = [strings[i].encode("utf-8") for i in order]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    np.save(os.path.join(tmp_path, "strings_offsets.npy"), offsets)
+    with open(os.path.join(tmp_path, "strings.bin"), 'wb') as fd:
+        fd.write(b"".join(encoded))
+
+    manifest = {"version": FORMAT_VERSION, "db_path": os.path.abspath(db_path), "db_fingerprint": fingerprint,
+                "created": datetime.now().isoformat(), "strings": len(encoded), "tables": dict()}
+    for table, columns in data.items():
+        os.makedirs(os.path.join(tmp_path, table))
+        for column, values in columns.items():
+            if TABLES[table][1][column] == "str":
+                arr = remap[np.frombuffer(values, dtype=np.int32)]
+            else:
+                arr = np.frombuffer(values, dtype=np.int64)
+            np.save(os.path.join(tmp_path, table, column + ".npy"), arr)
+        rows = len(next(iter(columns.values())))
+        manifest["tables"][table] = {"rows": rows, "columns": TABLES[table][1]}
+    with open(os.path.join(tmp_path, MANIFEST_FILE), 'w') as fd:
+        json.dump(manifest, fd, indent=4)
+
+    if os.path.exists(columns_path):
+        if not os.path.exists(os.path.join(columns_path, MANIFEST_FILE)):
+            shutil.rmtree(tmp_path)
+            raise ValueError(f"'{columns_path}' exists and is not a columnar export")
+        shutil.rmtree(columns_path)
+    os.replace(tmp_path, columns_path)
+    logger.info(f"Exported {len(encoded)} strings and tables {tables} to '{columns_path}'")
+    return {t: m["rows"] for t, m in manifest["tables"].items()}
+
+
+class ColumnTable:
+    """ Columns of one table of an export, memory-mapped when first accessed. """
+
+    def __init__(self, crawl: "CrawlColumns", name: str, rows: int, columns: Dict[str, str]):
+        self.crawl = crawl
+        self.name = name
+        self.rows = rows
+        self.types = columns
+        self._columns: Dict[str, np.ndarray] = dict()
+
+    def __getitem__(self, column: str) -> np.ndarray:
+        """ Codes of a string column, or values of an integer column. """
+        if column not in self._columns:
+            if column not in self.types:
+                raise KeyError(f"Table '{self.name}' has no column '{column}'")
+            self._columns[column] = np.load(os.path.join(self.crawl.path, self.name, column + ".npy"), mmap_mode='r')
+        return self._columns[column]
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def values(self, column: str, rows: Any = slice(None)) -> List[Any]:
+        """
+        Decoded values of a column, NULL as None.
+        @param column: column to decode
+        @param rows: slice, index array or mask of the rows to decode
+        """
+        arr = self[column][rows]
+        if self.types[column] == "str":
+            return self.crawl.strings(arr)
+        return [None if v == NULL_INT else v for v in arr.tolist()]
+
+    def iter_rows(self, columns: Optional[List[str]] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Decode the rows of the table in chunks, as dictionaries with the same keys as the rows of its query.
+        @param columns: columns to decode, all if None
+        """
+        columns = columns if columns is not None else list(self.types)
+        for start in range(0, self.rows, CHUNK_SIZE):
+            chunk = slice(start, min(start + CHUNK_SIZE, self.rows))
+            decoded = [self.values(c, chunk) for c in columns]
+            for values in zip(*decoded):
+                yield dict(zip(columns, values))
+
+
+class CrawlColumns:
+    """ Read-only view of an export, with the string dictionary memory-mapped. """
+
+    def __init__(self, path: str):
+        """
+        @param path: directory written by export_columns
+        """
+        self.path = path
+        with open(os.path.join(path, MANIFEST_FILE), 'r') as fd:
+            self.manifest = json.load(fd)
+        if self.manifest["version"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported version {self.manifest['version']} of the export in '{path}'")
+        self.offsets = np.load(os.path.join(path, "strings_offsets.npy"), mmap_mode='r')
+        with open(os.path.join(path, "strings.bin"), 'rb') as fd:
+            # mmap cannot map empty files
+            self._pool = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) if self.offsets[-1] > 0 else b""
+        self.tables = {name: ColumnTable(self, name, t["rows"], t["columns"])
+                       for name, t in self.manifest["tables"].items()}
+
+    def __getitem__(self, table: str) -> ColumnTable:
+        return self.tables[table]
+
+    def string(self, code: int) -> Optional[str]:
+        """ String of a code, None for -1. """
+        if code < 0:
+            return None
+        return self._pool[self.offsets[code]:self.offsets[code + 1]].decode("utf-8")
+
+    def strings(self, codes: np.ndarray) -> List[Optional[str]]:
+        """ Strings of an array of codes, each distinct code is only decoded once. """
+        unique, inverse = np.unique(codes, return_inverse=True)
+        decoded = [self.string(c) for c in unique.tolist()]
+        return [decoded[i] for i in inverse.tolist()]
+
+    def code(self, s: str) -> int:
+        """ Code of a string, by binary search over the sorted dictionary. -1 if the string does not occur. """
+        lo, hi = 0, len(self.offsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.string(mid) < s:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < len(self.offsets) - 1 and self.string(lo) == s else -1
+
+    def matches(self, db_path: str) -> bool:
+        """ Whether the export is up to date with the database. """
+        return database_fingerprint(db_path) == self.manifest["db_fingerprint"]
+
+
+def main():
+    """
+    Export a crawl, or describe an export.
+    @return: exit code, 0 for success
+    """
+    argv = None
+    cargs = docopt(__doc__, argv=argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    columns_path = cargs["<columns_path>"]
+    if cargs["export"]:
+        if not os.path.exists(cargs["<db_path>"]):
+            logger.error("Database file does not exist.")
+            return 1
+        tables = cargs["--tables"].split(",") if cargs["--tables"] else None
+        unknown = set(tables or []) - set(TABLES.keys())
+        if unknown:
+            logger.error(f"Unknown tables: {unknown}")
+            return 1
+        export_columns(cargs["<db_path>"], columns_path, tables)
+
+    if not os.path.exists(os.path.join(columns_path, MANIFEST_FILE)):
+        logger.error(f"'{columns_path}' is not a columnar export.")
+        return 1
+    crawl = CrawlColumns(columns_path)
+    for name, table in crawl.tables.items():
+        logger.info(f"{name}: {table.rows} rows, columns {list(table.types)}")
+    source = crawl.manifest["db_path"]
+    if not os.path.exists(source):
+        logger.info(f"{crawl.manifest['strings']} strings, source database '{source}' no longer exists.")
+    else:
+        state = "up to date" if crawl.matches(source) else "changed since the export"
+        logger.info(f"{crawl.manifest['strings']} strings, source database '{source}' is {state}.")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
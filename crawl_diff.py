@@ -0,0 +1,183 @@
+# Copyright (C) 2021-2022 Dino Bollinger, ETH Zürich, Information Security Group
+# Released under the MIT License
+"""
+Compare the violations of two crawls, and list which violations are new, fixed or persistent.
+A violation is identified by (site_url, name, domain, method). Both sides can be the output directory of an
+earlier run (of the method scripts, pipeline.py or batch_analysis.py), or a database, which is then analyzed
+with the stage cache of pipeline.py first.
+The outputs are written with sorted sites, so both sides are streamed site by site and joined with a sorted merge,
+holding the violations of only one site per method in memory.
+Outputs in the output directory:
+    violation_diff.csv: One row per violation, with its status (new, fixed, persistent), method, site, name and domain.
+    violation_diff_summary.json: Number of violations and sites per status, for each method.
+----------------------------------
+Required arguments:
+    <old>   Output directory or database of the earlier crawl.
+    <new>   Output directory or database of the later crawl.
+Optional arguments:
+    --out_path <out_path>: Directory to store the results in (default: ./violation_stats/).
+    --methods <methods>: Comma-separated methods to compare (default: all).
+    --changes_only: Omit the persistent violations from the CSV, they are still counted in the summary.
+    --cache_dir <cache_dir>: Directory of the stage cache, when analyzing databases (default: ./pipeline_cache/).
+    --workers <workers>: Maximum number of stages running concurrently, when analyzing databases (default: 4).
+Usage:
+    crawl_diff.py <old> <new> [--out_path <out_path>] [--methods <methods>] [--changes_only]
+                  [--cache_dir <cache_dir>] [--workers <workers>]
+"""
+
+import csv
+import heapq
+import json
+import os
+import time
+import logging
+
+from docopt import docopt
+from itertools import groupby
+from operator import itemgetter
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from batch_analysis import METHOD_OUTPUTS
+from pipeline import STAGES, run_pipeline, resolve_stages
+from utils import iter_violations
+
+logger = logging.getLogger("vd")
+
+STATUSES = ["new", "fixed", "persistent"]
+
+
+def method_directories(source: str, methods: List[str], cache_dir: str, workers: int) -> Optional[Dict[str, str]]:
+    """
+    Directory holding the outputs of each method. For a database, the methods are run through the stage cache.
+    @param source: output directory or database
+    @param methods: methods to compare
+    @return: directory per method, None if a method could not be run
+    """
+    if os.path.isdir(source):
+        return {m: source for m in methods}
+
+    logger.info(f"Analyzing database '{source}'")
+    params: Dict[str, List[str]] = {name: [] for name in STAGES}
+    completed, failed = run_pipeline(resolve_stages(methods), os.path.abspath(source), params,
+                                     cache_dir, workers, False)
+    if failed:
+        logger.error(f"Stages failed for '{source}': {sorted(failed)}")
+        return None
+    return {m: completed[m]["path"] for m in methods}
+
+
+def iter_method_sites(directory: str, method: str) -> Iterator[Tuple[str, Set[Tuple[str, str]]]]:
+    """
+    Stream the violations of a method site by site, as (name, domain) keys.
+    The outputs of methods with several files are merged by site.
+    @param directory: directory holding the outputs of the method
+    @param method: method name
+    @return: iterator over (site, violation keys), in sorted site order
+    """
+    streams = [iter_violations(fn, directory) for fn in METHOD_OUTPUTS[method]]
+    previous = None
+    for site, group in groupby(heapq.merge(*streams, key=itemgetter(0)), key=itemgetter(0)):
+        if previous is not None and site <= previous:
+            raise ValueError(f"Outputs of {method} in '{directory}' are not sorted by site")
+        previous = site
+        keys = set()
+        for _, records in group:
+            keys.update((r["name"], r["domain"]) for r in records)
+        yield site, keys
+
+
+def diff_method(old_dir: str, new_dir: str, method: str) -> Iterator[Tuple[str, str, str, str]]:
+    """
+    Sorted merge of the violations of a method in two crawls.
+    @return: iterator over (status, site, name, domain)
+    """
+    old_sites = iter_method_sites(old_dir, method)
+    new_sites = iter_method_sites(new_dir, method)
+    old = next(old_sites, None)
+    new = next(new_sites, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            for name, domain in sorted(old[1]):
+                yield "fixed", old[0], name, domain
+            old = next(old_sites, None)
+        elif old is None or new[0] < old[0]:
+            for name, domain in sorted(new[1]):
+                yield "new", new[0], name, domain
+            new = next(new_sites, None)
+        else:
+            for name, domain in sorted(old[1] | new[1]):
+                if (name, domain) not in old[1]:
+                    status = "new"
+                elif (name, domain) not in new[1]:
+                    status = "fixed"
+                else:
+                    status = "persistent"
+                yield status, new[0], name, domain
+            old = next(old_sites, None)
+            new = next(new_sites, None)
+
+
+def main():
+    """
+    Compare the violations of two crawls.
+    @return: exit code, 0 for success
+    """
+    argv = None
+    cargs = docopt(__doc__, argv=argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    for source in (cargs["<old>"], cargs["<new>"]):
+        if not os.path.exists(source):
+            logger.error(f"'{source}' does not exist.")
+            return 1
+
+    methods = cargs["--methods"].split(",") if cargs["--methods"] else list(METHOD_OUTPUTS.keys())
+    unknown = set(methods) - set(METHOD_OUTPUTS.keys())
+    if unknown:
+        logger.error(f"Unknown methods: {unknown}")
+        return 1
+
+    if cargs["--out_path"]:
+        out_path = cargs["--out_path"]
+    else:
+        out_path = "./violation_stats/"
+    cache_dir = os.path.abspath(cargs["--cache_dir"] if cargs["--cache_dir"] else "./pipeline_cache/")
+    workers = int(cargs["--workers"]) if cargs["--workers"] else 4
+
+    old_dirs = method_directories(cargs["<old>"], methods, cache_dir, workers)
+    new_dirs = method_directories(cargs["<new>"], methods, cache_dir, workers)
+    if old_dirs is None or new_dirs is None:
+        return 1
+
+    os.makedirs(out_path, exist_ok=True)
+    csv_path = os.path.join(out_path, "violation_diff.csv")
+    summary = dict()
+    start = time.perf_counter()
+    with open(csv_path, 'w', newline='') as fd:
+        writer = csv.writer(fd)
+        writer.writerow(["status", "method", "site_url", "name", "domain"])
+        for method in methods:
+            counts = {s: 0 for s in STATUSES}
+            sites = {s: 0 for s in STATUSES}
+            last_site = {s: None for s in STATUSES}
+            for status, site, name, domain in diff_method(old_dirs[method], new_dirs[method], method):
+                counts[status] += 1
+                if last_site[status] != site:
+                    sites[status] += 1
+                    last_site[status] = site
+                if status != "persistent" or not cargs["--changes_only"]:
+                    writer.writerow([status, method, site, name, domain])
+            summary[method] = {s: {"violations": counts[s], "sites": sites[s]} for s in STATUSES}
+            logger.info(f"{method}: {counts['new']} new, {counts['fixed']} fixed, {counts['persistent']} persistent")
+    logger.info(f"Diff output to: '{csv_path}' in {time.perf_counter() - start:.2f}s")
+
+    summary_path = os.path.join(out_path, "violation_diff_summary.json")
+    with open(summary_path, 'w') as fd:
+        json.dump(summary, fd, indent=4)
+    logger.info(f"Summary output to: '{summary_path}'")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
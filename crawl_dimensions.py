@@ -0,0 +1,245 @@
+# Copyright (C) 2021-2022 Dino Bollinger, ETH Zürich, Information Security Group
+# Released under the MIT License
+"""
+Dimension tables of a crawl, which assign dense integer IDs to the sites, cookie names, raw domains and canonical
+domains, and fact tables that store the consent table and the observed cookies as tuples of these IDs.
+The string operations the methods repeat for every row, like canonicalizing domains and splitting the domain lists
+of declarations, are performed once per distinct string when the tables are built. The methods then attach the
+tables with "--dimensions <dim_path>", and join, group and deduplicate on the integer IDs, only reading the strings
+of the cookies they report. IDs are assigned in the order of the strings, such that they compare like the strings.
+The tables are written to a separate SQLite database, the crawl database itself is only read.
+Tables of the dimension database:
+    meta(key, value)                                    Source database and its fingerprint.
+    sites(id, site_url)                                 Sites of the crawl.
+    visits(visit_id, site_id)                           Site of each visit.
+    names(id, name)                                     Names of declared and observed cookies.
+    canonical_domains(id, domain)                       Domains in the form of canonical_domain.
+    domains(id, domain, canonical_id)                   Declared and observed domains as stored in the crawl.
+    consent_domains(domain_id, canonical_id)            Canonical domains in the domain list of a declaration.
+    consent_facts(row_id, visit_id, site_id, name_id, domain_id)   Rows of the consent table, by row ID.
+    cookie_facts(row_id, visit_id, site_id, name_id, domain_id)    Rows of the observed cookie table, by row ID.
+----------------------------------
+Commands:
+    build   Build the dimension tables of a crawl database.
+    info    Print the sizes of the dimension tables, and whether they match their source database.
+Required arguments:
+    <db_path>   Path to the crawl database.
+    <dim_path>  Path to the dimension database, replaced if it exists.
+Usage:
+    crawl_dimensions.py build <db_path> <dim_path>
+    crawl_dimensions.py info <dim_path>
+"""
+
+import os
+import sqlite3
+import logging
+
+from datetime import datetime
+from docopt import docopt
+from typing import Dict, Optional
+
+from pipeline import database_fingerprint
+from utils import canonical_domain, split_consent_domains, metrics
+
+logger = logging.getLogger("vd")
+
+FORMAT_VERSION = 1
+
+# Name under which the methods attach the dimension database
+ATTACHED_NAME = "dims"
+
+# Tables of the dimension database, besides meta
+DIMENSION_TABLES = ("sites", "visits", "names", "canonical_domains", "domains",
+                    "consent_domains", "consent_facts", "cookie_facts")
+
+DIMENSIONS_SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE sites (id INTEGER PRIMARY KEY, site_url TEXT UNIQUE);
+CREATE TABLE visits (visit_id INTEGER PRIMARY KEY, site_id INTEGER);
+CREATE TABLE names (id INTEGER PRIMARY KEY, name TEXT UNIQUE);
+CREATE TABLE canonical_domains (id INTEGER PRIMARY KEY, domain TEXT UNIQUE);
+CREATE TABLE domains (id INTEGER PRIMARY KEY, domain TEXT UNIQUE, canonical_id INTEGER);
+CREATE TABLE consent_domains (domain_id INTEGER, canonical_id INTEGER, PRIMARY KEY (domain_id, canonical_id)) WITHOUT ROWID;
+CREATE TABLE consent_facts (row_id INTEGER PRIMARY KEY, visit_id INTEGER, site_id INTEGER, name_id INTEGER, domain_id INTEGER);
+CREATE TABLE cookie_facts (row_id INTEGER PRIMARY KEY, visit_id INTEGER, site_id INTEGER, name_id INTEGER, domain_id INTEGER);
+"""
+
+# Strings of each dimension, inserted in sorted order such that the IDs compare like the strings
+DIMENSION_QUERIES = {
+    "sites": """
+INSERT INTO sites (site_url)
+SELECT DISTINCT site_url FROM crawl.site_visits WHERE site_url IS NOT NULL ORDER BY site_url
+""",
+    "names": """
+INSERT INTO names (name)
+SELECT name FROM crawl.consent_data WHERE name IS NOT NULL
+UNION SELECT name FROM crawl.javascript_cookies WHERE name IS NOT NULL
+ORDER BY 1
+""",
+    "domains": """
+INSERT INTO domains (domain)
+SELECT domain FROM crawl.consent_data WHERE domain IS NOT NULL
+UNION SELECT host FROM crawl.javascript_cookies WHERE host IS NOT NULL
+ORDER BY 1
+""",
+}
+
+VISITS_QUERY = """
+INSERT OR IGNORE INTO visits
+SELECT v.visit_id, s.id FROM crawl.site_visits v JOIN sites s ON s.site_url == v.site_url
+"""
+
+# Every row of the crawl gets a fact, such that joining on the row ID never drops rows; missing strings become NULL.
+FACT_QUERIES = {
+    "consent_facts": """
+INSERT INTO consent_facts
+SELECT c.rowid, c.visit_id, v.site_id, n.id, d.id
+FROM crawl.consent_data c
+LEFT JOIN visits v ON v.visit_id == c.visit_id
+LEFT JOIN names n ON n.name == c.name
+LEFT JOIN domains d ON d.domain == c.domain
+""",
+    "cookie_facts": """
+INSERT INTO cookie_facts
+SELECT j.rowid, j.visit_id, v.site_id, n.id, d.id
+FROM crawl.javascript_cookies j
+LEFT JOIN visits v ON v.visit_id == j.visit_id
+LEFT JOIN names n ON n.name == j.name
+LEFT JOIN domains d ON d.domain == j.host
+""",
+}
+
+
+def build_dimensions(db_path: str, dim_path: str) -> Dict[str, int]:
+    """
+    Build the dimension and fact tables of a crawl database. The tables are written to a temporary file first,
+    which then replaces the previous dimension database, such that readers never see partial tables.
+    @param db_path: path to the crawl database
+    @param dim_path: path of the dimension database
+    @return: number of rows of each table
+    """
+    tmp_path = f"{dim_path}.tmp{os.getpid()}"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.executescript(DIMENSIONS_SCHEMA)
+        conn.execute("ATTACH DATABASE ? AS crawl", (db_path,))
+        with conn, metrics.stage("build_dimensions"):
+            for query in DIMENSION_QUERIES.values():
+                conn.execute(query)
+            conn.execute(VISITS_QUERY)
+
+            # canonical forms of the raw domains, and of each entry in the domain lists of the declarations
+            canonical_ids: Dict[str, int] = dict()
+            domains = conn.execute("SELECT id, domain FROM domains").fetchall()
+            declared = set(r[0] for r in conn.execute("SELECT id FROM domains WHERE domain IN "
+                                                      "(SELECT domain FROM crawl.consent_data)"))
+            canonical_of = [(domain_id, canonical_domain(domain)) for domain_id, domain in domains]
+            entries_of = [(domain_id, set(canonical_domain(d.strip()) for d in split_consent_domains(domain)))
+                          for domain_id, domain in domains if domain_id in declared]
+            for canon in sorted(set(c for _, c in canonical_of).union(*(e for _, e in entries_of))):
+                canonical_ids[canon] = len(canonical_ids) + 1
+            conn.executemany("INSERT INTO canonical_domains VALUES (?, ?)",
+                             ((i, c) for c, i in canonical_ids.items()))
+            conn.executemany("UPDATE domains SET canonical_id = ? WHERE id == ?",
+                             ((canonical_ids[c], domain_id) for domain_id, c in canonical_of))
+            conn.executemany("INSERT INTO consent_domains VALUES (?, ?)",
+                             ((domain_id, canonical_ids[c]) for domain_id, entries in entries_of for c in entries))
+
+            for query in FACT_QUERIES.values():
+                conn.execute(query)
+        conn.execute("DETACH DATABASE crawl")
+
+        rows = table_rows(conn)
+        with conn:
+            conn.executemany("INSERT INTO meta VALUES (?, ?)", [
+                ("version", str(FORMAT_VERSION)), ("db_path", os.path.abspath(db_path)),
+                ("db_fingerprint", database_fingerprint(db_path)), ("created", datetime.now().isoformat())])
+    finally:
+        conn.close()
+
+    os.replace(tmp_path, dim_path)
+    logger.info(f"Built the dimension tables of '{db_path}' in '{dim_path}'")
+    return rows
+
+
+def table_rows(conn: sqlite3.Connection) -> Dict[str, int]:
+    """ Number of rows of each table of a dimension database. """
+    return {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in DIMENSION_TABLES}
+
+
+def read_meta(dim_path: str) -> Optional[Dict[str, str]]:
+    """ Metadata of a dimension database, None if the file is not one. """
+    if not os.path.exists(dim_path):
+        return None
+    try:
+        conn = sqlite3.connect(dim_path)
+        try:
+            return dict(conn.execute("SELECT key, value FROM meta").fetchall())
+        finally:
+            conn.close()
+    except sqlite3.DatabaseError:
+        return None
+
+
+def attach_dimensions(conn: sqlite3.Connection, dim_path: str, db_path: str) -> bool:
+    """
+    Attach the dimension tables to a connection to the crawl database, as schema ATTACHED_NAME,
+    verifying that they are up to date with the database.
+    @param conn: connection to the crawl database
+    @param dim_path: dimension database written by crawl_dimensions.py
+    @param db_path: database the dimension tables are expected to come from
+    @return: True if the tables were attached, False if they are missing or out of date
+    """
+    meta = read_meta(dim_path)
+    if meta is None:
+        logger.error(f"'{dim_path}' is not a dimension database.")
+        return False
+    if meta.get("db_fingerprint") != database_fingerprint(db_path):
+        logger.error(f"The dimension tables '{dim_path}' are out of date, build them again.")
+        return False
+    conn.execute(f"ATTACH DATABASE ? AS {ATTACHED_NAME}", (dim_path,))
+    logger.info(f"Dimension tables used: {dim_path}")
+    return True
+
+
+def main():
+    """
+    Build the dimension tables of a crawl, or describe them.
+    @return: exit code, 0 for success
+    """
+    argv = None
+    cargs = docopt(__doc__, argv=argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    dim_path = cargs["<dim_path>"]
+    if cargs["build"]:
+        if not os.path.exists(cargs["<db_path>"]):
+            logger.error("Database file does not exist.")
+            return 1
+        if os.path.exists(dim_path) and read_meta(dim_path) is None:
+            logger.error(f"'{dim_path}' exists and is not a dimension database.")
+            return 1
+        build_dimensions(cargs["<db_path>"], dim_path)
+
+    meta = read_meta(dim_path)
+    if meta is None:
+        logger.error(f"'{dim_path}' is not a dimension database.")
+        return 1
+    conn = sqlite3.connect(dim_path)
+    for table, rows in table_rows(conn).items():
+        logger.info(f"{table}: {rows} rows")
+    conn.close()
+    source = meta["db_path"]
+    if not os.path.exists(source):
+        logger.info(f"Source database '{source}' no longer exists.")
+    else:
+        state = "up to date" if database_fingerprint(source) == meta["db_fingerprint"] else "changed since the build"
+        logger.info(f"Source database '{source}' is {state}.")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,262 @@
+# Copyright (C) 2021-2022 Dino Bollinger, ETH Zürich, Information Security Group
+# Released under the MIT License
+"""
+Optional DuckDB engine for the queries of the detection methods.
+DuckDB runs in-process, attaches the crawl database read-only through its sqlite extension, and executes the joins,
+DISTINCTs and GROUP BYs of the method queries vectorized and on all cores, instead of row by row as SQLite does.
+DuckDBConnection provides the subset of sqlite3.Connection that the methods use, with rows accessible by column name
+and by index, such that the methods process its results unchanged.
+Queries are written for SQLite. Those whose row order matters have a DuckDB equivalent registered through
+register_equivalent, which reproduces the order of SQLite: DISTINCT keeps the first row of each group, ordered by
+the row IDs of the table scanned. Other queries only get their string literals brought into DuckDB's dialect.
+Requires the "duckdb" package, which is not installed by default.
+"""
+
+import re
+import sqlite3
+import logging
+
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+from utils import CONSENTDATA_QUERY, ORDERED_CONSENTDATA_QUERY, MATCHED_COOKIEDATA_QUERY
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+logger = logging.getLogger("vd")
+
+# Rows fetched from DuckDB at once while iterating over a result.
+FETCH_SIZE = 10000
+
+# Name under which the crawl database is attached.
+ATTACHED_NAME = "crawl"
+
+# Equivalent of CONSENTDATA_QUERY and ORDERED_CONSENTDATA_QUERY, whose order it reproduces in any case.
+# All columns are read as text from SQLite, integers are cast back.
+# first_row orders the rows as SQLite scans them, it is kept in the results such that queries can wrap this one.
+CONSENTDATA_QUERY_DUCKDB = """
+SELECT * FROM (
+    SELECT CAST(c.visit_id AS BIGINT) as visit_id,
+            s.site_url,
+            CAST(ccr.cmp_type AS INTEGER) as cmp_type,
+            CAST(ccr.crawl_state AS INTEGER) as crawl_state,
+            c.name as consent_name,
+            c.domain as consent_domain,
+            c.purpose,
+            CAST(c.cat_id AS INTEGER) as cat_id,
+            c.cat_name,
+            c.type_name,
+            CAST(c.type_id AS INTEGER) as type_id,
+            c.expiry as consent_expiry,
+            MIN(CAST(c.id AS BIGINT)) as first_row
+    FROM consent_data c
+    JOIN site_visits s ON s.visit_id == c.visit_id
+    JOIN consent_crawl_results ccr ON ccr.visit_id == c.visit_id
+    GROUP BY ALL
+)
+ORDER BY first_row
+"""
+
+# Equivalent of MATCHED_COOKIEDATA_QUERY, ties are broken by the first row of the observed cookie.
+MATCHED_COOKIEDATA_QUERY_DUCKDB = """
+SELECT * EXCLUDE (first_row) FROM (
+    SELECT CAST(j.visit_id AS BIGINT) as visit_id,
+            s.site_url,
+            CAST(ccr.cmp_type AS INTEGER) as cmp_type,
+            j.name,
+            j.host as cookie_domain,
+            j.path,
+            c.domain as consent_domain,
+            j.value,
+            c.purpose,
+            CAST(c.cat_id AS INTEGER) as cat_id,
+            c.cat_name,
+            c.type_name,
+            CAST(c.type_id AS INTEGER) as type_id,
+            c.expiry as consent_expiry,
+            j.expiry as actual_expiry,
+            CAST(j.is_session AS INTEGER) as is_session,
+            CAST(j.is_http_only AS INTEGER) as is_http_only,
+            CAST(j.is_host_only AS INTEGER) as is_host_only,
+            CAST(j.is_secure AS INTEGER) as is_secure,
+            j.same_site,
+            j.time_stamp,
+            MIN(CAST(j.id AS BIGINT)) as first_row
+    FROM consent_data c
+    JOIN javascript_cookies j ON c.visit_id == j.visit_id and c.name == j.name
+    JOIN site_visits s ON s.visit_id == c.visit_id
+    JOIN consent_crawl_results ccr ON ccr.visit_id == c.visit_id
+    WHERE j.record_type <> 'deleted'
+    GROUP BY ALL
+)
+ORDER BY visit_id, name, time_stamp ASC,
+         consent_domain, cat_id, cat_name, purpose, consent_expiry, type_name, type_id, first_row;
+"""
+
+# DuckDB equivalents of SQLite queries, see register_equivalent
+_equivalents: Dict[str, str] = {
+    MATCHED_COOKIEDATA_QUERY: MATCHED_COOKIEDATA_QUERY_DUCKDB,
+    CONSENTDATA_QUERY: CONSENTDATA_QUERY_DUCKDB,
+    ORDERED_CONSENTDATA_QUERY: CONSENTDATA_QUERY_DUCKDB,
+}
+
+# String literals in double quotes, which DuckDB reads as identifiers
+_double_quoted = re.compile(r'"([^"]*)"')
+_like = re.compile(r"\blike\b", re.IGNORECASE)
+
+
+def register_equivalent(sqlite_query: str, duckdb_query: str) -> None:
+    """
+    Register the DuckDB equivalent of a query. Also replaces the query where it is nested inside another one.
+    @param sqlite_query: query as executed on SQLite
+    @param duckdb_query: query to execute on DuckDB instead
+    """
+    _equivalents[sqlite_query] = duckdb_query
+
+
+def translate_query(query: str) -> str:
+    """
+    Bring a query written for SQLite into DuckDB's dialect.
+    Registered equivalents are substituted, longest first, then double-quoted string literals are quoted singly,
+    and LIKE becomes ILIKE, as LIKE ignores the case of ASCII characters in SQLite.
+    @param query: SQLite query
+    @return: DuckDB query
+    """
+    for sqlite_query in sorted(_equivalents, key=len, reverse=True):
+        if sqlite_query in query:
+            query = query.replace(sqlite_query, _equivalents[sqlite_query])
+    query = _double_quoted.sub(lambda m: "'" + m.group(1).replace("'", "''") + "'", query)
+    return _like.sub("ILIKE", query)
+
+
+class DuckDBRow(tuple):
+    """ Result row that can be indexed by position or by column name, like sqlite3.Row. """
+
+    def __new__(cls, values: Sequence[Any], index: Dict[str, int]):
+        row = super().__new__(cls, values)
+        row._index = index
+        return row
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return tuple.__getitem__(self, self._index[key])
+        return tuple.__getitem__(self, key)
+
+    def keys(self) -> List[str]:
+        return list(self._index.keys())
+
+
+class DuckDBCursor:
+    """ Cursor over the results of a DuckDB query, streamed in batches of FETCH_SIZE rows. """
+
+    def __init__(self, connection: Any):
+        self._cursor = connection.cursor()
+        self._index: Dict[str, int] = dict()
+        self._executed = False
+
+    def execute(self, query: str, parameters: Sequence[Any] = ()) -> "DuckDBCursor":
+        if query.lstrip().upper().startswith("CREATE INDEX"):
+            # the crawl database is attached read-only, and DuckDB does not use its indexes
+            logger.debug(f"Skipped index creation on DuckDB: {query.strip()}")
+            self._executed = False
+            return self
+        try:
+            self._cursor.execute(translate_query(query), list(parameters))
+        except duckdb.Error as e:
+            # raised as the SQLite error, such that the error handling of the methods applies
+            raise sqlite3.OperationalError(str(e)) from e
+        self._index = {d[0]: i for i, d in enumerate(self._cursor.description or [])}
+        self._executed = True
+        return self
+
+    def fetchone(self) -> Optional[DuckDBRow]:
+        if not self._executed:
+            return None
+        row = self._cursor.fetchone()
+        return DuckDBRow(row, self._index) if row is not None else None
+
+    def fetchall(self) -> List[DuckDBRow]:
+        return list(self)
+
+    def __iter__(self) -> Iterator[DuckDBRow]:
+        while self._executed:
+            rows = self._cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield DuckDBRow(row, self._index)
+
+    def close(self) -> None:
+        self._cursor.close()
+
+
+class DuckDBConnection:
+    """
+    The subset of sqlite3.Connection used by the methods, over an in-memory DuckDB database
+    that has the crawl database attached read-only.
+    """
+
+    def __init__(self, connection: Any):
+        self._connection = connection
+
+    def cursor(self) -> DuckDBCursor:
+        return DuckDBCursor(self._connection)
+
+    def execute(self, query: str, parameters: Sequence[Any] = ()) -> DuckDBCursor:
+        return self.cursor().execute(query, parameters)
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __enter__(self) -> "DuckDBConnection":
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb) -> bool:
+        # nothing to commit, the crawl database is read-only
+        return False
+
+
+def connect_duckdb(db_path: str, threads: Optional[int] = None) -> Optional[DuckDBConnection]:
+    """
+    Attach the crawl database read-only to an in-memory DuckDB database.
+    @param db_path: path to the SQLite crawl database
+    @param threads: number of threads DuckDB may use, all cores if None
+    @return: the connection, None if DuckDB or its sqlite extension is not available
+    """
+    if duckdb is None:
+        logger.error("DuckDB is not installed, install the 'duckdb' package to use it as engine.")
+        return None
+    try:
+        con = duckdb.connect(":memory:")
+        con.execute("INSTALL sqlite")
+        con.execute("LOAD sqlite")
+        # columns are read as text, as SQLite does not enforce the declared types (e.g. expiry dates past year 9999)
+        con.execute("SET sqlite_all_varchar = true")
+        # sort NULL before any value, as SQLite does
+        con.execute("SET default_null_order = 'nulls_first'")
+        if threads is not None:
+            con.execute(f"SET threads = {int(threads)}")
+        db_literal = db_path.replace("'", "''")
+        con.execute(f"ATTACH '{db_literal}' AS {ATTACHED_NAME} (TYPE sqlite, READ_ONLY)")
+        con.execute(f"USE {ATTACHED_NAME}")
+    except duckdb.Error as e:
+        logger.error(f"Could not attach the database with DuckDB: {e}")
+        return None
+    logger.info(f"DuckDB {duckdb.__version__} attached the database read-only.")
+    return DuckDBConnection(con)
+
+
+def open_database(db_path: str, use_duckdb: bool = False) -> Optional[Any]:
+    """
+    Connect to the crawl database, rows of both engines are accessible by column name.
+    @param db_path: path to the SQLite crawl database
+    @param use_duckdb: whether to run the queries in DuckDB instead of SQLite
+    @return: the connection, None if DuckDB was requested but is not available
+    """
+    if use_duckdb:
+        return connect_duckdb(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    return conn
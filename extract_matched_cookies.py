@@ -0,0 +1,97 @@
+# Copyright (C) 2021-2022 Dino Bollinger, ETH Zürich, Information Security Group
+# Released under the MIT License
+"""
+Extract the cookies found in both the javascript cookies table and the consent table, and write them to a JSON file.
+Methods 3, 7 and 8 can load this file through their "--matched" option instead of repeating the extraction.
+With "--snapshot", the cookies are written as a snapshot instead (see matched_snapshot.py), which methods running
+in parallel memory-map and share, rather than each loading its own copy.
+----------------------------------
+Required arguments:
+    <db_path>   Path to database to analyze.
+    <out_file>  JSON file to write the matched cookies to.
+Optional arguments:
+    --metrics <metrics_path>: Write timings, row counts and peak memory of the run to this JSON file.
+    --site <site_url>: Only extract the cookies of this site.
+    --snapshot: Write a memory-mappable snapshot instead of JSON.
+    --memory_budget <mb>: Memory available for grouping the cookies, in megabytes. Larger crawls are grouped
+                          in partitions on disk (default: 4096).
+    --duckdb: Run the queries in DuckDB, which attaches the database read-only (requires the duckdb package).
+    --create_indexes: Add the indexes of single-site runs to the database if they are missing, which speeds up
+                      these runs, but modifies the database file.
+Usage:
+    extract_matched_cookies.py <db_path> <out_file> [--metrics <metrics_path>] [--site <site_url> | --duckdb] [--snapshot]
+                               [--memory_budget <mb>] [--create_indexes]
+"""
+
+import json
+import os
+import logging
+
+from docopt import docopt
+from typing import Any, Dict, Mapping, TextIO
+from matched_snapshot import write_snapshot
+from utils import setupLogger, retrieve_matched_cookies_from_DB, metrics
+from duckdb_engine import open_database
+
+logger = logging.getLogger("vd")
+
+
+def write_matched_json(cookies: Mapping[str, Dict[str, Any]], fd: TextIO) -> None:
+    """
+    Write the matched cookies as a JSON object, one cookie at a time, such that a partitioned extraction
+    (see retrieve_matched_cookies_from_DB) is not loaded into memory. The output is the same as with json.dump.
+    @param cookies: matched cookies
+    @param fd: file to write to
+    """
+    fd.write("{")
+    for i, (key, val) in enumerate(cookies.items()):
+        if i > 0:
+            fd.write(", ")
+        fd.write(json.dumps(key) + ": " + json.dumps(val))
+    fd.write("}")
+
+
+def main():
+    """
+    Run the matched cookie extraction once and store its result.
+    @return: exit code, 0 for success
+    """
+    argv = None
+    cargs = docopt(__doc__, argv=argv)
+
+    setupLogger(".", logging.INFO)
+    if cargs["--metrics"]:
+        metrics.enable("extract_matched_cookies")
+
+    database_path = cargs["<db_path>"]
+    if not os.path.exists(database_path):
+        logger.error("Database file does not exist.")
+        return 1
+    logger.info(f"Database used: {database_path}")
+
+    conn = open_database(database_path, cargs["--duckdb"])
+    if conn is None:
+        return 1
+
+    logger.info("Extract cookies from database...")
+    cookies_dict, _ = retrieve_matched_cookies_from_DB(conn, cargs["--site"], cargs["--memory_budget"], cargs["--create_indexes"])
+    conn.close()
+
+    out_file = cargs["<out_file>"]
+    out_dir = os.path.dirname(out_file)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    if cargs["--snapshot"]:
+        with metrics.stage("write_output"):
+            write_snapshot(cookies_dict, out_file)
+    else:
+        with open(out_file, 'w') as fd, metrics.stage("write_output"):
+            write_matched_json(cookies_dict, fd)
+        logger.info(f"Matched cookies output to: '{out_file}'")
+
+    metrics.write(cargs["--metrics"])
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
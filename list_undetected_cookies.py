@@ -6,22 +6,116 @@ have been declared but not been found by the crawler.
 ----------------------------------
 Required arguments:
     <db_path>   Path to database to analyze.
+Optional arguments:
+    --merge: Walk observed and declared cookies site by site in lockstep, holding only one site's cookies in memory.
+    --metrics <metrics_path>: Write timings, row counts and peak memory of the run to this JSON file.
 Usage:
-    list_undetected_cookies.py <db_path>
+    list_undetected_cookies.py <db_path> [--merge] [--metrics <metrics_path>]
 """
 
 from docopt import docopt
 import os
 import sqlite3
 import traceback
+import time
 import numpy as np
 
 import logging
+from itertools import groupby
+from typing import Dict, Set, Tuple, Iterator
 from utils import (setupLogger, CONSENTDATA_QUERY, get_violation_details_consent_table,
-                                       JAVASCRIPTCOOKIE_QUERY, write_json, write_vdomains, canonical_domain)
+                                       JAVASCRIPTCOOKIE_QUERY, write_json, write_vdomains, canonical_domain, metrics,
+                                       ProgressReporter, count_visits, CMP_VISITS_CONDITION, CONSENT_VISITS_CONDITION)
 
 logger = logging.getLogger("vd")
 
+# Observed cookie identities on sites with a working CMP, in site order.
+OBSERVED_BY_SITE_QUERY = f"""
+SELECT DISTINCT s.site_url, j.name, j.host as cookie_domain
+FROM javascript_cookies j
+JOIN site_visits s ON s.visit_id == j.visit_id
+JOIN consent_crawl_results ccr ON ccr.visit_id == j.visit_id
+WHERE j.record_type <> "deleted" and {CMP_VISITS_CONDITION}
+ORDER BY s.site_url;
+"""
+
+# Declared cookies in site order, keeping table order within each site.
+DECLARED_BY_SITE_QUERY = CONSENTDATA_QUERY + """
+ORDER BY s.site_url, c.rowid;
+"""
+
+
+def get_observed_cookies(conn: sqlite3.Connection) -> Dict[str, Set[Tuple[str, str]]]:
+    """
+    Retrieve the (name, canonical domain) identities of all observed cookies, per site.
+    @param conn: Database connection
+    @return: Set of observed cookie identities for each site URL
+    """
+    javascript_cookies = dict()
+    progress = ProgressReporter("Observed cookie scan", count_visits(conn, CMP_VISITS_CONDITION))
+    with conn:
+        cur = conn.cursor()
+        cur.execute(JAVASCRIPTCOOKIE_QUERY)
+        for row in cur:
+            if row["cmp_type"] == -1 or row["crawl_state"] != 0:
+                # logger.info(f"No CMP found on domain {row['site_url']}, skipping...")
+                continue
+            progress.update(row["visit_id"])
+            fpd = row["site_url"]
+            if fpd not in javascript_cookies:
+                javascript_cookies[fpd] = set()
+            ident = (row["name"], canonical_domain(row["cookie_domain"]))
+            javascript_cookies[fpd].add(ident)
+        cur.close()
+    return javascript_cookies
+
+
+def iterate_declarations(conn: sqlite3.Connection) -> Iterator[Tuple[sqlite3.Row, Set[Tuple[str, str]]]]:
+    """
+    Yield each declared cookie together with the identities observed on its site.
+    All observed cookies are loaded into memory first.
+    @param conn: Database connection
+    """
+    javascript_cookies = get_observed_cookies(conn)
+    empty: Set[Tuple[str, str]] = set()
+    with conn:
+        cur = conn.cursor()
+        cur.execute(CONSENTDATA_QUERY)
+        for row in cur:
+            yield row, javascript_cookies.get(row["site_url"], empty)
+        cur.close()
+
+
+def iterate_declarations_merged(conn: sqlite3.Connection) -> Iterator[Tuple[sqlite3.Row, Set[Tuple[str, str]]]]:
+    """
+    Yield each declared cookie together with the identities observed on its site.
+    Both tables are walked in site order in lockstep, such that only one site's observed cookies are kept.
+    @param conn: Database connection
+    """
+    empty: Set[Tuple[str, str]] = set()
+    with conn:
+        ocur = conn.cursor()
+        ocur.execute(OBSERVED_BY_SITE_QUERY)
+        observed_groups = groupby(ocur, key=lambda r: r["site_url"])
+        observed_site, observed_rows = next(observed_groups, (None, iter(())))
+
+        dcur = conn.cursor()
+        dcur.execute(DECLARED_BY_SITE_QUERY)
+        for declared_site, declared_rows in groupby(dcur, key=lambda r: r["site_url"]):
+            # SQLite sorts text by UTF-8 bytes, which is the same order as Python's string comparison
+            while observed_site is not None and observed_site < declared_site:
+                observed_site, observed_rows = next(observed_groups, (None, iter(())))
+
+            if observed_site == declared_site:
+                observed = set((r["name"], canonical_domain(r["cookie_domain"])) for r in observed_rows)
+            else:
+                observed = empty
+
+            for row in declared_rows:
+                yield row, observed
+        dcur.close()
+        ocur.close()
+
 
 def main():
     """
@@ -32,6 +126,8 @@ def main():
     cargs = docopt(__doc__, argv=argv)
 
     setupLogger(".", logging.INFO)
+    if cargs["--metrics"]:
+        metrics.enable("list_undetected_cookies")
 
     logger.info("Listing out undetected cookies...")
 
@@ -46,28 +142,6 @@ def main():
     conn = sqlite3.connect(database_path)
     conn.row_factory = sqlite3.Row
 
-    javascript_cookies = dict()
-
-    # Retrieve data from Javascript Cookies table
-    try:
-        with conn:
-            cur = conn.cursor()
-            cur.execute(JAVASCRIPTCOOKIE_QUERY)
-            for row in cur:
-                if row["cmp_type"] == -1 or row["crawl_state"] != 0:
-                    # logger.info(f"No CMP found on domain {row['site_url']}, skipping...")
-                    continue
-                fpd = row["site_url"]
-                if fpd not in javascript_cookies:
-                    javascript_cookies[fpd] = set()
-                ident = (row["name"], canonical_domain(row["cookie_domain"]))
-                javascript_cookies[fpd].add(ident)
-            cur.close()
-    except (sqlite3.OperationalError, sqlite3.IntegrityError):
-        logger.error("A database error occurred:")
-        logger.error(traceback.format_exc())
-        return -1
-
     undetected_details = dict()
     undetected_sites = set()
     total_sites = set()
@@ -75,11 +149,19 @@ def main():
     undetected_count = [0,0,0,0,0,0,0]
     total_count = 0
 
+    if cargs["--merge"]:
+        declarations = iterate_declarations_merged(conn)
+    else:
+        declarations = iterate_declarations(conn)
+
     # Compare to data in Consent table. May have multiple domains listed
-    with conn:
-        cur = conn.cursor()
-        cur.execute(CONSENTDATA_QUERY)
-        for row in cur:
+    row_count = 0
+    compare_start = time.perf_counter()
+    try:
+        progress = ProgressReporter("Declared cookie comparison", count_visits(conn, CONSENT_VISITS_CONDITION))
+        for row, observed in declarations:
+            row_count += 1
+            progress.update(row["visit_id"])
             # Only count HTTP and HTML cookie types
             if row["type_id"] and (int(row["type_id"]) not in {1, 2}):
                 continue
@@ -87,12 +169,11 @@ def main():
             total_sites.add(vdomain)
             total_count += 1
 
-            fpd = row["site_url"]
             consent_domains = row["consent_domain"].split("<br/>")
             found_any = False
             for domain_entry in consent_domains:
                 ident = (row["consent_name"], canonical_domain(domain_entry))
-                if fpd in javascript_cookies and ident in javascript_cookies[fpd]:
+                if ident in observed:
                     found_any = True
 
             label = int(row["cat_id"])
@@ -118,7 +199,13 @@ def main():
                     detected_count[5] += 1
                 else:
                     detected_count[label] += 1
+    except (sqlite3.OperationalError, sqlite3.IntegrityError):
+        logger.error("A database error occurred:")
+        logger.error(traceback.format_exc())
+        return -1
 
+    metrics.add_time("comparison", compare_start)
+    metrics.add_rows("comparison", row_count)
     conn.close()
 
     logger.info(f"Total cookies declared: {total_count}")
@@ -142,6 +229,7 @@ def main():
 
     write_json(undetected_details, "undetected_cookies.json")
     write_vdomains(undetected_sites, "undetected_cookie_domains.txt")
+    metrics.write(cargs["--metrics"])
 
 
     return 0
@@ -0,0 +1,305 @@
+# Copyright (C) 2021-2022 Dino Bollinger, ETH Zürich, Information Security Group
+# Released under the MIT License
+"""
+Persistent knowledge base of the category counts per cookie, identified by (name, domain),
+accumulated over many crawl databases. Method 2 can score a new crawl against the accumulated
+majority opinion with its "--kb" option, which helps for small crawls where most cookies
+occur fewer times than the majority threshold.
+Each crawl is only added once, recognized by a hash over its site visits and consent table entries, such that
+repeated crawls of the same sites are told apart by their declarations. The hash of a database file is remembered
+by its fingerprint, such that an unchanged file is recognized without reading it again.
+----------------------------------
+Commands:
+    add     Add the category counts of one or more crawl databases to the knowledge base.
+    lookup  Print the accumulated category counts of a cookie.
+    info    Print the number of crawls and cookies in the knowledge base.
+Required arguments:
+    <kb_path>   Path to the knowledge base, created if it does not exist.
+    <db_path>   Path to a crawl database to add.
+    <name>      Cookie name to look up.
+    <domain>    Cookie domain to look up, as declared in the consent table.
+Usage:
+    majority_kb.py add <kb_path> <db_path>...
+    majority_kb.py lookup <kb_path> <name> <domain>
+    majority_kb.py info <kb_path>
+"""
+
+import hashlib
+import os
+import sqlite3
+import logging
+
+from datetime import datetime
+from docopt import docopt
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from pipeline import database_fingerprint
+from utils import CONSENTDATA_QUERY, CONSENT_VISITS_CONDITION, ProgressReporter, count_visits, metrics
+
+logger = logging.getLogger("vd")
+
+# Order of the category counts: ne, fu, an, ad, uncat, socmedia, unknown
+CATEGORY_COLUMNS = ["necessary", "functional", "analytics", "advertising", "uncategorized", "social_media", "unknown"]
+
+# Version of the crawl hash, knowledge bases with crawls hashed otherwise need to be rebuilt
+CRAWL_HASH_VERSION = 2
+
+KB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS crawls (
+    crawl_hash TEXT PRIMARY KEY,
+    db_path TEXT,
+    entries INTEGER,
+    added TEXT
+);
+CREATE TABLE IF NOT EXISTS crawl_files (
+    db_fingerprint TEXT PRIMARY KEY,
+    crawl_hash TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def category_index(cat_id: int) -> Optional[int]:
+    """
+    Position of a consent table category in the list of category counts.
+    @param cat_id: category ID of the consent table
+    @return: index into the category counts, None for categories that are not counted
+    """
+    if 0 <= cat_id < 5:
+        return cat_id
+    elif cat_id == -1:
+        return 6
+    elif cat_id == 99:
+        return 5
+    return None
+
+
+class CategoryCountTable:
+    """
+    Category counts per (name, domain), stored in a table of a SQLite database.
+    Changes are not committed here, such that they can be committed together with other state.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, table: str):
+        """
+        @param conn: Connection to the database holding the table, which is created if needed
+        @param table: Name of the table
+        """
+        self.conn = conn
+        self.table = table
+        columns = ", ".join(c + " INTEGER NOT NULL" for c in CATEGORY_COLUMNS)
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {table} "
+                     f"(name TEXT NOT NULL, domain TEXT NOT NULL, {columns}, PRIMARY KEY (name, domain)) WITHOUT ROWID")
+        self._select = f"SELECT {', '.join(CATEGORY_COLUMNS)} FROM {table} WHERE name == ? AND domain == ?"
+        self._upsert = (f"INSERT INTO {table} VALUES (?, ?, {', '.join('?' * len(CATEGORY_COLUMNS))}) "
+                        f"ON CONFLICT (name, domain) DO UPDATE SET "
+                        + ", ".join(f"{c} = {c} + excluded.{c}" for c in CATEGORY_COLUMNS))
+
+    def get(self, key: Tuple[str, str]) -> Optional[List[int]]:
+        """ Category counts of a cookie, None if it was never counted. """
+        row = self.conn.execute(self._select, key).fetchone()
+        return list(row) if row is not None else None
+
+    def add(self, counts: Dict[Tuple[str, str], List[int]]) -> None:
+        """ Add category counts to the stored counts of each cookie. """
+        self.conn.executemany(self._upsert, ((*key, *cat_list) for key, cat_list in counts.items()))
+
+    def clear(self) -> None:
+        """ Remove all counts. """
+        self.conn.execute(f"DELETE FROM {self.table}")
+
+    def __len__(self) -> int:
+        return self.conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+
+def crawl_hash(conn: sqlite3.Connection) -> str:
+    """
+    Hash over the site visits and the consent table entries of a crawl, identifies the crawl independent of the
+    file location. Crawls of the same sites share their visits, but differ in the declarations that are counted.
+    """
+    h = hashlib.sha256()
+    for row in conn.execute("SELECT visit_id, site_url FROM site_visits ORDER BY visit_id"):
+        h.update(f"{row[0]};{row[1]}\n".encode())
+    h.update(b"--\n")
+    for row in conn.execute("SELECT visit_id, name, domain, cat_id FROM consent_data ORDER BY rowid"):
+        h.update(f"{row[0]};{row[1]};{row[2]};{row[3]}\n".encode())
+    return h.hexdigest()
+
+
+def count_categories(conn: sqlite3.Connection) -> Tuple[Dict[Tuple[str, str], List[int]], int]:
+    """
+    Count the categories assigned to each cookie in a crawl, in a single pass over the consent table.
+    Like method 2, only the first entry per site, name and domain is counted.
+    @param conn: Connection to the crawl database
+    @return: category counts per (name, domain), number of entries counted
+    """
+    counts: Dict[Tuple[str, str], List[int]] = dict()
+    seen = set()
+    progress = ProgressReporter("Category count scan", count_visits(conn, CONSENT_VISITS_CONDITION))
+    cur = conn.execute(CONSENTDATA_QUERY)
+    for row in cur:
+        progress.update(row["visit_id"])
+        key = row["site_url"].strip() + ";" + row["consent_name"].strip() + ";" + row["consent_domain"].strip()
+        if key in seen:
+            continue
+        seen.add(key)
+
+        ident = (row["consent_name"], row["consent_domain"])
+        if ident not in counts:
+            counts[ident] = [0, 0, 0, 0, 0, 0, 0]
+        index = category_index(int(row["cat_id"]))
+        if index is not None:
+            counts[ident][index] += 1
+    cur.close()
+    return counts, len(seen)
+
+
+class MajorityKnowledgeBase:
+    """
+    Category counts per cookie accumulated over many crawls, stored in a SQLite database indexed by (name, domain).
+    Lookups are cached for the lifetime of the object, as the same cookies recur on many sites.
+    """
+
+    def __init__(self, kb_path: str):
+        """
+        @param kb_path: Path to the knowledge base, created if it does not exist
+        """
+        self.path = kb_path
+        self.conn = sqlite3.connect(kb_path, timeout=60)
+        with self.conn:
+            self.conn.executescript(KB_SCHEMA)
+            self.counts = CategoryCountTable(self.conn, "category_counts")
+            version = self.conn.execute("SELECT value FROM meta WHERE key == 'crawl_hash_version'").fetchone()
+            outdated = version is None and self.num_crawls() > 0
+            if not outdated:
+                self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('crawl_hash_version', ?)",
+                                  (str(CRAWL_HASH_VERSION),))
+        if outdated:
+            self.conn.close()
+            raise ValueError(f"The knowledge base '{kb_path}' identifies its crawls by their site visits only, "
+                             f"which does not tell repeated crawls of the same sites apart. Rebuild it")
+        self._cache: Dict[Tuple[str, str], Optional[List[int]]] = dict()
+
+    def lookup(self, name: str, domain: str) -> Optional[List[int]]:
+        """
+        Accumulated category counts of a cookie.
+        @param name: cookie name, as declared in the consent table
+        @param domain: cookie domain, as declared in the consent table
+        @return: counts in the order of CATEGORY_COLUMNS, None if the cookie was never seen
+        """
+        key = (name, domain)
+        if key not in self._cache:
+            self._cache[key] = self.counts.get(key)
+        return self._cache[key]
+
+    def lookup_many(self, keys: Iterable[Tuple[str, str]]) -> Dict[Tuple[str, str], List[int]]:
+        """ Accumulated category counts of several cookies, omitting those never seen. """
+        result = dict()
+        for name, domain in keys:
+            cat_list = self.lookup(name, domain)
+            if cat_list is not None:
+                result[(name, domain)] = cat_list
+        return result
+
+    def identify_crawl(self, conn: sqlite3.Connection, db_path: str) -> str:
+        """
+        Hash of a crawl database, see crawl_hash. Only computed once for each state of the database file.
+        @param conn: connection to the crawl database
+        @param db_path: path to the crawl database
+        @return: hash of the crawl
+        """
+        fingerprint = database_fingerprint(db_path)
+        row = self.conn.execute("SELECT crawl_hash FROM crawl_files WHERE db_fingerprint == ?", (fingerprint,)).fetchone()
+        if row is not None:
+            return row[0]
+        c_hash = crawl_hash(conn)
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO crawl_files VALUES (?, ?)", (fingerprint, c_hash))
+        return c_hash
+
+    def contains_crawl(self, conn: sqlite3.Connection, db_path: str) -> bool:
+        """ Whether the counts of the crawl were already added. """
+        c_hash = self.identify_crawl(conn, db_path)
+        return self.conn.execute("SELECT 1 FROM crawls WHERE crawl_hash == ?", (c_hash,)).fetchone() is not None
+
+    def add_crawl(self, db_path: str) -> bool:
+        """
+        Add the category counts of a crawl database, unless it was added before.
+        @param db_path: path to the crawl database
+        @return: True if the crawl was added
+        """
+        conn = sqlite3.connect(db_path)
+        conn.row_factory = sqlite3.Row
+        c_hash = self.identify_crawl(conn, db_path)
+        if self.conn.execute("SELECT 1 FROM crawls WHERE crawl_hash == ?", (c_hash,)).fetchone() is not None:
+            logger.info(f"Crawl '{db_path}' is already part of the knowledge base.")
+            conn.close()
+            return False
+
+        with metrics.stage("category_counts"):
+            counts, entries = count_categories(conn)
+        conn.close()
+
+        with self.conn:
+            self.counts.add(counts)
+            self.conn.execute("INSERT INTO crawls VALUES (?, ?, ?, ?)",
+                              (c_hash, os.path.abspath(db_path), entries, datetime.now().isoformat()))
+        self._cache.clear()
+        logger.info(f"Added {entries} entries of {len(counts)} cookies from '{db_path}'")
+        return True
+
+    def clear(self) -> None:
+        """ Remove all crawls and counts. """
+        with self.conn:
+            self.counts.clear()
+            self.conn.execute("DELETE FROM crawls")
+            self.conn.execute("DELETE FROM crawl_files")
+        self._cache.clear()
+
+    def num_crawls(self) -> int:
+        """ Number of crawls added so far. """
+        return self.conn.execute("SELECT COUNT(*) FROM crawls").fetchone()[0]
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def main():
+    """
+    Maintain and query the knowledge base.
+    @return: exit code, 0 for success
+    """
+    argv = None
+    cargs = docopt(__doc__, argv=argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    try:
+        kb = MajorityKnowledgeBase(cargs["<kb_path>"])
+    except ValueError as e:
+        logger.error(f"{e}.")
+        return 1
+    if cargs["add"]:
+        for db_path in cargs["<db_path>"]:
+            if not os.path.exists(db_path):
+                logger.error(f"Database file '{db_path}' does not exist.")
+                kb.close()
+                return 1
+            kb.add_crawl(db_path)
+    elif cargs["lookup"]:
+        cat_list = kb.lookup(cargs["<name>"], cargs["<domain>"])
+        if cat_list is None:
+            logger.info("Cookie not found in the knowledge base.")
+        else:
+            logger.info(", ".join(f"{c}: {n}" for c, n in zip(CATEGORY_COLUMNS, cat_list)))
+
+    logger.info(f"Knowledge base contains {kb.num_crawls()} crawls and {len(kb.counts)} cookies.")
+    kb.close()
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,292 @@
+# Copyright (C) 2021-2022 Dino Bollinger, ETH Zürich, Information Security Group
+# Released under the MIT License
+"""
+Snapshot of the matched cookies in a single file that worker processes can memory-map, instead of each
+worker loading its own copy of the JSON output of extract_matched_cookies.py.
+The file contains a pool of unique strings and fixed-width record arrays that refer to the strings by index.
+Workers attach to it read-only and decode each record only while they iterate over it, such that the
+operating system shares a single copy of the data between all of them. Placing the snapshot on a tmpfs
+like /dev/shm keeps it in shared memory.
+Layout, all sections aligned to 8 bytes:
+    magic (8 bytes) | header length (8 bytes) | JSON header | records | variable data | string offsets | string pool
+"""
+
+import json
+import mmap
+import os
+import shutil
+import logging
+
+import numpy as np
+
+from array import array
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger("vd")
+
+SNAPSHOT_MAGIC = b"VDSNAP01"
+
+# String fields of a matched cookie, stored as index into the string pool, -1 for None
+RECORD_STRINGS = ["key", "name", "domain", "consent_domain", "path", "site_url", "cat_name", "consent_expiry", "timestamp"]
+RECORD_DTYPE = np.dtype([(f, "<i4") for f in RECORD_STRINGS] +
+                        [("visit_id", "<i8"), ("var_start", "<i8"), ("var_count", "<i4"), ("label", "i1"), ("cmp_type", "i1")])
+
+# One entry per cookie update in "variable_data"
+VARIABLE_FLAGS = ["session", "http_only", "host_only", "secure"]
+VARIABLE_DTYPE = np.dtype([("value", "<i4"), ("same_site", "<i4"), ("expiry", "<i8")] + [(f, "u1") for f in VARIABLE_FLAGS])
+
+# Records decoded at once while iterating, and buffered while writing
+CHUNK_SIZE = 4096
+
+# Sections of the file following the header, in this order
+SECTION_NAMES = ["records", "variables", "string_offsets", "string_pool"]
+
+
+def _aligned(n: int) -> int:
+    return (n + 7) & ~7
+
+
+def is_snapshot(path: str) -> bool:
+    """ Whether the file is a matched cookie snapshot, rather than JSON. """
+    with open(path, 'rb') as fd:
+        return fd.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+
+
+class SnapshotWriter:
+    """
+    Writes a snapshot incrementally, such that the matched cookies do not need to be in memory all at once.
+    The sections are appended to temporary files next to the snapshot while records are added, and assembled
+    into the snapshot when the writer is closed.
+    """
+
+    def __init__(self, path: str, max_strings: Optional[int] = None):
+        """
+        @param path: file to write the snapshot to
+        @param max_strings: maximum number of distinct strings remembered for deduplication, unlimited if None.
+                            Once exceeded, strings seen earlier are added to the pool again.
+        """
+        self.path = path
+        self.max_strings = max_strings
+        self._parts_dir = f"{path}.parts{os.getpid()}"
+        os.makedirs(self._parts_dir, exist_ok=True)
+        self._parts = {name: open(os.path.join(self._parts_dir, name), 'wb') for name in SECTION_NAMES}
+        self._string_ids: Dict[str, int] = dict()
+        self._num_strings = 0
+        self._pool_size = 0
+        self._offsets = array("q", [0])
+        self._rec_columns: Dict[str, List[int]] = {f: [] for f in RECORD_DTYPE.names}
+        self._var_columns: Dict[str, List[int]] = {f: [] for f in VARIABLE_DTYPE.names}
+        self._num_records = 0
+        self._num_variables = 0
+
+    def _intern(self, s: Optional[str]) -> int:
+        if s is None:
+            return -1
+        i = self._string_ids.get(s)
+        if i is None:
+            if self.max_strings is not None and len(self._string_ids) >= self.max_strings:
+                self._string_ids.clear()
+            i = self._num_strings
+            self._string_ids[s] = i
+            self._num_strings += 1
+            encoded = s.encode("utf-8")
+            self._parts["string_pool"].write(encoded)
+            self._pool_size += len(encoded)
+            self._offsets.append(self._pool_size)
+        return i
+
+    def add(self, key: str, val: Dict[str, Any]) -> None:
+        """
+        Append a matched cookie.
+        @param key: key of the cookie in the matched cookie dictionary
+        @param val: matched cookie, as in the dictionary of retrieve_matched_cookies_from_DB
+        """
+        rec_columns, var_columns = self._rec_columns, self._var_columns
+        rec_columns["key"].append(self._intern(key))
+        for f in RECORD_STRINGS[1:]:
+            rec_columns[f].append(self._intern(val[f]))
+        for f in ("visit_id", "label", "cmp_type"):
+            rec_columns[f].append(val[f])
+        rec_columns["var_start"].append(self._num_variables)
+        rec_columns["var_count"].append(len(val["variable_data"]))
+        for v in val["variable_data"]:
+            var_columns["value"].append(self._intern(v["value"]))
+            var_columns["same_site"].append(self._intern(v["same_site"]))
+            var_columns["expiry"].append(v["expiry"])
+            for f in VARIABLE_FLAGS:
+                var_columns[f].append(v[f])
+        self._num_records += 1
+        self._num_variables += len(val["variable_data"])
+        if len(rec_columns["key"]) >= CHUNK_SIZE:
+            self._flush()
+
+    def _flush(self) -> None:
+        """ Write the buffered records, variable data and string offsets to their section files. """
+        records = np.zeros(len(self._rec_columns["key"]), dtype=RECORD_DTYPE)
+        for f, column in self._rec_columns.items():
+            records[f] = column
+            column.clear()
+        variables = np.zeros(len(self._var_columns["value"]), dtype=VARIABLE_DTYPE)
+        for f, column in self._var_columns.items():
+            variables[f] = column
+            column.clear()
+        self._parts["records"].write(records.tobytes())
+        self._parts["variables"].write(variables.tobytes())
+        self._parts["string_offsets"].write(self._offsets.tobytes())
+        self._offsets = array("q")
+
+    def close(self) -> None:
+        """
+        Assemble the snapshot. It is written under a temporary name and renamed once complete,
+        such that workers never attach to a partially written snapshot.
+        """
+        self._flush()
+        for fd in self._parts.values():
+            fd.close()
+        sizes = {name: os.path.getsize(os.path.join(self._parts_dir, name)) for name in SECTION_NAMES}
+
+        header = {"records": self._num_records, "variables": self._num_variables, "strings": self._num_strings,
+                  "sections": dict()}
+        # the header contains the offsets of the sections, which depend on the header length
+        header_len = 0
+        while True:
+            offset = _aligned(16 + header_len)
+            for name in SECTION_NAMES:
+                header["sections"][name] = [offset, sizes[name]]
+                offset = _aligned(offset + sizes[name])
+            header_bytes = json.dumps(header).encode()
+            if len(header_bytes) == header_len:
+                break
+            header_len = len(header_bytes)
+
+        tmp_path = f"{self.path}.tmp{os.getpid()}"
+        with open(tmp_path, 'wb') as fd:
+            fd.write(SNAPSHOT_MAGIC)
+            fd.write(len(header_bytes).to_bytes(8, "little"))
+            fd.write(header_bytes)
+            for name in SECTION_NAMES:
+                fd.seek(header["sections"][name][0])
+                with open(os.path.join(self._parts_dir, name), 'rb') as part:
+                    shutil.copyfileobj(part, fd)
+        os.replace(tmp_path, self.path)
+        shutil.rmtree(self._parts_dir, ignore_errors=True)
+        logger.info(f"Snapshot of {self._num_records} matched cookies and {self._num_strings} strings "
+                    f"written to '{self.path}'")
+
+
+def write_snapshot(cookies: Mapping, path: str) -> None:
+    """
+    Write the matched cookies into a snapshot.
+    @param cookies: matched cookies, as returned by retrieve_matched_cookies_from_DB
+    @param path: file to write the snapshot to
+    """
+    writer = SnapshotWriter(path)
+    for key, val in cookies.items():
+        writer.add(key, val)
+    writer.close()
+
+
+class MatchedSnapshot(Mapping):
+    """
+    Read-only mapping over a memory-mapped snapshot, with the same keys and values as the matched cookie dictionary.
+    Values are decoded on access, so each returned record is a new dictionary.
+    """
+
+    def __init__(self, path: str):
+        """
+        @param path: snapshot written by write_snapshot
+        """
+        self.path = path
+        with open(path, 'rb') as fd:
+            self._mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError(f"'{path}' is not a matched cookie snapshot")
+        header_len = int.from_bytes(self._mm[8:16], "little")
+        header = json.loads(self._mm[16:16 + header_len])
+        sections = header["sections"]
+
+        def view(name: str, dtype: Any, count: int) -> np.ndarray:
+            return np.frombuffer(self._mm, dtype=dtype, count=count, offset=sections[name][0])
+
+        self._records = view("records", RECORD_DTYPE, header["records"])
+        self._variables = view("variables", VARIABLE_DTYPE, header["variables"])
+        self._offsets = view("string_offsets", "<i8", header["strings"] + 1)
+        self._pool_start = sections["string_pool"][0]
+        self._key_index: Optional[Dict[str, int]] = None
+
+    def _strings(self, ids: np.ndarray) -> List[Optional[str]]:
+        """ Decode strings from the pool, None for index -1. """
+        safe = np.maximum(ids, 0)
+        starts = (self._offsets[safe] + self._pool_start).tolist()
+        ends = (self._offsets[safe + 1] + self._pool_start).tolist()
+        mm = self._mm
+        return [mm[a:b].decode("utf-8") if i >= 0 else None for i, a, b in zip(ids.tolist(), starts, ends)]
+
+    def _decode(self, start: int, stop: int) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """ Decode the records in [start, stop), column by column. """
+        recs = self._records[start:stop]
+        columns = {f: self._strings(recs[f]) for f in RECORD_STRINGS}
+        visit_ids = recs["visit_id"].tolist()
+        labels = recs["label"].tolist()
+        cmp_types = recs["cmp_type"].tolist()
+        var_starts = recs["var_start"].tolist()
+        var_counts = recs["var_count"].tolist()
+
+        first = var_starts[0] if var_starts else 0
+        last = var_starts[-1] + var_counts[-1] if var_starts else 0
+        variables = self._variables[first:last]
+        values = self._strings(variables["value"])
+        same_sites = self._strings(variables["same_site"])
+        expiries = variables["expiry"].tolist()
+        flags = {f: variables[f].astype(bool).tolist() for f in VARIABLE_FLAGS}
+
+        for i in range(len(recs)):
+            var_data = []
+            for j in range(var_starts[i] - first, var_starts[i] - first + var_counts[i]):
+                var_data.append({"value": values[j], "expiry": expiries[j], "session": flags["session"][j],
+                                 "http_only": flags["http_only"][j], "host_only": flags["host_only"][j],
+                                 "secure": flags["secure"][j], "same_site": same_sites[j]})
+            yield columns["key"][i], {
+                "visit_id": visit_ids[i],
+                "name": columns["name"][i],
+                "domain": columns["domain"][i],
+                "consent_domain": columns["consent_domain"][i],
+                "path": columns["path"][i],
+                "site_url": columns["site_url"][i],
+                "label": labels[i],
+                "cat_name": columns["cat_name"][i],
+                "cmp_type": cmp_types[i],
+                "consent_expiry": columns["consent_expiry"][i],
+                "timestamp": columns["timestamp"][i],
+                "variable_data": var_data
+            }
+
+    def items(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        for start in range(0, len(self._records), CHUNK_SIZE):
+            yield from self._decode(start, min(start + CHUNK_SIZE, len(self._records)))
+
+    def values(self) -> Iterator[Dict[str, Any]]:
+        for _, val in self.items():
+            yield val
+
+    def __iter__(self) -> Iterator[str]:
+        for start in range(0, len(self._records), CHUNK_SIZE):
+            yield from self._strings(self._records["key"][start:start + CHUNK_SIZE])
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __getitem__(self, key: str) -> Dict[str, Any]:
+        # the index of the keys is only built for random access, iteration does not need it
+        if self._key_index is None:
+            self._key_index = {k: i for i, k in enumerate(self)}
+        i = self._key_index[key]
+        return next(self._decode(i, i + 1))[1]
+
+    def __contains__(self, key: object) -> bool:
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
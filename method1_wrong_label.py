@@ -11,56 +11,51 @@ Optional arguments:
     <domain_pattern>: Specifies the regex pattern for the cookie domain.
     <expected_label>: Expected label for the cookie.
     --out_path <out_path>: Directory to store the resutls.
+    --metrics <metrics_path>: Write timings, row counts and peak memory of the run to this JSON file.
+    --top <k>: Write the k cookies (by name and canonical domain) with the most violations across sites
+               to method1_top_cookies.json, counted with a heavy-hitter sketch of bounded memory.
+    --verify_top: Count the violations of the top cookies exactly, in a second pass over the violations.
+    --incremental: Only analyze the visits added since the last incremental run, and merge them into the outputs.
+    --site <site_url>: Only analyze the visits of this site, e.g. to re-check it after a fix.
+    --sample <fraction>: Only analyze a reproducible sample of this fraction of the visits of each CMP type,
+                         and estimate the share of sites with violations in the whole crawl.
+    --seed <seed>: Seed of the sample, the same seed draws the same visits (default: 0).
+    --columns <columns_path>: Run the vectorized backend over this columnar export of the database (see crawl_columns.py).
+    --create_indexes: Add the indexes of single-site runs to the database if they are missing, which speeds up
+                      these runs, but modifies the database file.
 Usage:
-    method1_wrong_label.py <db_path> [<name_pattern> <domain_pattern> <expected_label> --out_path <out_path>]
+    method1_wrong_label.py <db_path> [<name_pattern> <domain_pattern> <expected_label> --out_path <out_path>] [--metrics <metrics_path>] [--top <k> [--verify_top]]
+                           [--incremental | --site <site_url> | --sample <fraction> | --columns <columns_path>] [--seed <seed>] [--create_indexes]
 """
 
 from docopt import docopt
-import os
-import sqlite3
 import re
 
 import logging
-from utils import (setupLogger, CONSENTDATA_QUERY, write_json,
-                   get_violation_details_consent_table, write_vdomains)
+from utils import CONSENTDATA_QUERY, get_violation_details_consent_table, metrics
+from method_run import MethodRun, run_method
+from columnar_backend import wrong_label
 
 logger = logging.getLogger("vd")
 
+# Default check: Google Analytics cookies, which are always analytics cookies
+DEFAULT_NAME_PATTERN = "(^_ga$|^_gat$|^_gid$|^_gat_gtag_UA_[0-9]+_[0-9]+|^_gat_UA-[0-9]+-[0-9]+)"
+DEFAULT_DOMAIN_PATTERN = ".*"
+DEFAULT_EXPECTED_LABEL = 2
 
-def main():
+
+def detect_wrong_labels(run: MethodRun, name_pattern: re.Pattern, domain_pattern: re.Pattern,
+                        expected_label: int) -> int:
     """
-    Try to detect potential violations by analyzing the category of specific cookies.
+    Find the entries of cookies matching the patterns, whose label differs from the expected label.
+    @param run: Run of the method, see method_run.py
+    @param name_pattern: Pattern of the cookie names to check
+    @param domain_pattern: Pattern of the cookie domains to check
+    @param expected_label: Label the matching cookies should have
     @return: exit code, 0 for success
     """
-    argv = None
-    cargs = docopt(__doc__, argv=argv)
-
-    setupLogger(".", logging.INFO)
-
-    logger.info("Running method 01: Wrong Label for Known Cookie")
-
-    # Specify name, domain patter and expected label by input, or
-    if cargs["<name_pattern>"]:
-        name_pattern = re.compile(cargs["<name_pattern>"])
-        domain_pattern = re.compile(cargs["<domain_pattern>"])
-        expected_label = int(cargs["<expected_label>"])
-    else:
+    if not run.cargs["<name_pattern>"]:
         logger.info("Using default GA check:")
-        name_pattern = re.compile("(^_ga$|^_gat$|^_gid$|^_gat_gtag_UA_[0-9]+_[0-9]+|^_gat_UA-[0-9]+-[0-9]+)")
-        domain_pattern = re.compile(".*")
-        expected_label = 2
-
-    # Verify that database exists
-    database_path = cargs["<db_path>"]
-    if not os.path.exists(database_path):
-        logger.error("Database file does not exist.")
-        return 1
-
-    logger.info(f"Database used: {database_path}")
-
-    # enable dictionary access by column name, access database
-    conn = sqlite3.connect(database_path)
-    conn.row_factory = sqlite3.Row
 
     # some variables to collect violation details with
     violation_details = dict()
@@ -69,45 +64,65 @@ def main():
     total_domains = set()
     total_matching_cookies = 0
 
-    logger.info("Extracting info from database...")
-
-    with conn:
-        cur = conn.cursor()
-        cur.execute(CONSENTDATA_QUERY)
-        for row in cur:
-
-            # Duplicate check, not necessary anymore
-            #transform = {**row}
-            #if transform.values() in duplicate_reject:
-            #    logger.info("Skipped exact duplicate entry")
-            #    continue
-            #duplicate_reject.add(transform.values())
-
-            if name_pattern.match(row["consent_name"]) and domain_pattern.search(row["consent_domain"]):
-                total_domains.add(row["site_url"])
-                total_matching_cookies += 1
-                if row["cat_id"] != expected_label and row["cat_id"] != -1:
-                    #logger.info(f"Potential Violation on website: {row['site_url']} for cookie entry: {row['consent_name']};{row['consent_domain']}")
-                    #logger.info(f"Entry matches pattern, but given label was {row['cat_id']}")
-
-                    cat_id = row["cat_id"]
-                    if cat_id == 99:
-                        cat_id = 5
-
-                    vdomain = row["site_url"]
-                    violation_domains.add(vdomain)
-                    violation_counts[cat_id] += 1
-
-                    if vdomain not in violation_details:
-                        violation_details[vdomain] = list()
-                    violation_details[vdomain].append(get_violation_details_consent_table(row))
-
-    conn.close()
+    crawl = None
+    if run.cargs["--columns"]:
+        crawl = run.load_columns()
+        if crawl is None:
+            return 1
+    else:
+        logger.info("Extracting info from database...")
+
+    row_count = 0
+    if crawl:
+        with metrics.stage("vectorized_scan"):
+            violation_details, violation_counts, total_matching_cookies, total_domains = \
+                wrong_label(crawl, name_pattern, domain_pattern, expected_label)
+        run.summaries.add_details(violation_details)
+        violation_domains = set(violation_details.keys())
+        row_count = len(crawl["consent"])
+    else:
+        with run.conn, metrics.stage("consent_scan"):
+            cur = run.conn.cursor()
+            cur.execute(CONSENTDATA_QUERY)
+            for row in cur:
+                row_count += 1
+
+                # Duplicate check, not necessary anymore
+                #transform = {**row}
+                #if transform.values() in duplicate_reject:
+                #    logger.info("Skipped exact duplicate entry")
+                #    continue
+                #duplicate_reject.add(transform.values())
+
+                if name_pattern.match(row["consent_name"]) and domain_pattern.search(row["consent_domain"]):
+                    total_domains.add(row["site_url"])
+                    total_matching_cookies += 1
+                    if row["cat_id"] != expected_label and row["cat_id"] != -1:
+                        #logger.info(f"Potential Violation on website: {row['site_url']} for cookie entry: {row['consent_name']};{row['consent_domain']}")
+                        #logger.info(f"Entry matches pattern, but given label was {row['cat_id']}")
+
+                        cat_id = row["cat_id"]
+                        if cat_id == 99:
+                            cat_id = 5
+
+                        vdomain = row["site_url"]
+                        violation_domains.add(vdomain)
+                        violation_counts[cat_id] += 1
+
+                        if vdomain not in violation_details:
+                            violation_details[vdomain] = list()
+                        record = get_violation_details_consent_table(row)
+                        violation_details[vdomain].append(record)
+                        run.summaries.add_record(vdomain, record)
+
+    metrics.add_rows("consent_scan", row_count)
     logger.info(f"Total matching cookies found: {total_matching_cookies}")
     logger.info(f"Number of potential violations: {violation_counts}")
     logger.info(f"Number of sites that have the cookie in total: {len(total_domains)}")
     logger.info(f"Number of sites with potential violations: {len(violation_domains)}")
 
+    violation_details, violation_domains = run.merge(violation_details, violation_domains)
+
     v_per_cmp = [0, 0, 0]
     for url, violating_cookies in violation_details.items():
         for c in violating_cookies:
@@ -116,14 +131,35 @@ def main():
 
     logger.info(f"Potential Violations per CMP Type: {v_per_cmp}")
 
-    if cargs["--out_path"]:
-        out_path = cargs["--out_path"]
-    else:
-        out_path = "./violation_stats/"
-    write_json(violation_details, "method1_cookies.json", out_path)
-    write_vdomains(violation_domains, "method1_domains.txt", out_path)
+    run.write(violation_details, violation_domains)
+    return run.finish(violation_domains, [violation_details],
+                      {"total_matching_cookies": total_matching_cookies, "total_sites": len(total_domains)})
+
+
+def main():
+    """
+    Try to detect potential violations by analyzing the category of specific cookies.
+    @return: exit code, 0 for success
+    """
+    argv = None
+    cargs = docopt(__doc__, argv=argv)
 
-    return 0
+    # Specify name, domain patter and expected label by input, or use the default GA check
+    if cargs["<name_pattern>"]:
+        name_pattern = re.compile(cargs["<name_pattern>"])
+        domain_pattern = re.compile(cargs["<domain_pattern>"])
+        expected_label = int(cargs["<expected_label>"])
+    else:
+        name_pattern = re.compile(DEFAULT_NAME_PATTERN)
+        domain_pattern = re.compile(DEFAULT_DOMAIN_PATTERN)
+        expected_label = DEFAULT_EXPECTED_LABEL
+
+    return run_method(cargs, "method1_wrong_label", "Running method 01: Wrong Label for Known Cookie",
+                      lambda run: detect_wrong_labels(run, name_pattern, domain_pattern, expected_label),
+                      "method1_cookies.json",
+                      {"name_pattern": name_pattern.pattern, "domain_pattern": domain_pattern.pattern,
+                       "expected_label": expected_label},
+                      log_level=logging.INFO)
 
 
 if __name__ == '__main__':
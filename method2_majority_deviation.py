@@ -9,21 +9,50 @@ Required arguments:
     <db_path>   Path to database to analyze.
 Optional arguments:
     --out_path <out_path>: Directory to store the resutls.
+    --metrics <metrics_path>: Write timings, row counts and peak memory of the run to this JSON file.
+    --top <k>: Write the k cookies (by name and canonical domain) with the most violations across sites
+               to method2_top_cookies.json, counted with a heavy-hitter sketch of bounded memory.
+    --verify_top: Count the violations of the top cookies exactly, in a second pass over the violations.
+    --threshold <threshold>: Minimum number of occurrences needed to apply the majority (default: 10).
+    --min_ratio <min_ratio>: Minimal size of the majority opinion, as a ratio (default: 0.667).
+    --incremental: Only analyze the visits added since the last incremental run, and merge them into the outputs.
+                   The category counts are kept in a table, and earlier entries are only re-evaluated for
+                   cookies whose majority opinion changed.
+    --site <site_url>: Only analyze the visits of this site, e.g. to re-check it after a fix. The majority opinions
+                       are read from the category counts of the whole crawl, which are counted once and stored
+                       in the output directory, unless a knowledge base is given.
+    --sample <fraction>: Only analyze a reproducible sample of this fraction of the visits of each CMP type,
+                         and estimate the share of sites with violations in the whole crawl.
+    --seed <seed>: Seed of the sample, the same seed draws the same visits (default: 0).
+    --kb <kb_path>: Compare against the majority opinion accumulated over many crawls in the knowledge base
+                    (see majority_kb.py), instead of the majority within this crawl.
+    --columns <columns_path>: Run the vectorized backend over this columnar export of the database (see crawl_columns.py).
+    --memory_budget <mb>: Memory available for grouping the cookies, in megabytes. Larger crawls are grouped
+                          in partitions on disk (default: 4096).
+    --create_indexes: Add the indexes of single-site runs to the database if they are missing, which speeds up
+                      these runs, but modifies the database file.
 Usage:
-    method2_majority_deviation.py <db_path> [--out_path <out_path>]
+    method2_majority_deviation.py <db_path> [--out_path <out_path>] [--metrics <metrics_path>] [--top <k> [--verify_top]]
+                                  [--threshold <threshold>] [--min_ratio <min_ratio>] [--memory_budget <mb>]
+                                  [--incremental | --site <site_url> | --sample <fraction> | --columns <columns_path>] [--seed <seed>] [--kb <kb_path>] [--create_indexes]
 """
 
 import os
 import sqlite3
 import logging
 import re
+import time
 
 from docopt import docopt
 from numpy import argmax
-from typing import Dict, List, Any, Tuple
+from typing import Dict, List, Any, Optional, Set, Tuple
 
-from utils import (setupLogger, write_json, CONSENTDATA_QUERY,
-                   write_vdomains, get_violation_details_consent_table)
+from utils import (CONSENTDATA_QUERY, CONSENT_BYTES_PER_ROW, get_violation_details_consent_table, metrics,
+                   load_violations)
+from method_run import MethodRun, IncrementalState, ViolationSummaries, run_method
+from partitioned_grouping import HashPartitions, partitions_needed, estimate_table_rows
+from majority_kb import MajorityKnowledgeBase, CategoryCountTable, category_index
+from columnar_backend import majority_deviation
 
 logger = logging.getLogger("vd")
 
@@ -35,6 +64,30 @@ threshold = 10
 # Minimal size the majority opinion needs to be in order for a cookie to be recongized as misclassified
 min_ratio = (2.0/3.0)
 
+# Category counts of the whole crawl, used to analyze a single site
+CRAWL_COUNTS_FILE = "method2_crawl_counts.sqlite"
+
+# Knowledge base the entries are scored against, given with --kb or counted from the whole crawl for --site
+knowledge_base: Optional[MajorityKnowledgeBase] = None
+
+# Consent table entries of the sites analyzed by earlier incremental runs, for the cookies in the temporary
+# table of changed keys. Reads the complete site_visits table, which is shadowed by the sites with new visits
+# otherwise. The sites with new visits are analyzed again as a whole, so their earlier entries are left out.
+PREVIOUS_ENTRIES_QUERY = CONSENTDATA_QUERY.replace("JOIN site_visits s", "JOIN main.site_visits s") + """
+JOIN temp.changed_keys k ON k.name == c.name AND k.domain == c.domain
+WHERE c.visit_id <= ?
+  AND s.site_url IN (SELECT site_url FROM incremental_state.analyzed_sites WHERE method == ?)
+  AND s.site_url NOT IN (SELECT site_url FROM temp.site_visits)
+"""
+
+# Consent table entries counted by earlier incremental runs for the sites that are analyzed again,
+# which are taken out of the stored counts before the entries of all their visits are added.
+REANALYZED_ENTRIES_QUERY = CONSENTDATA_QUERY.replace("JOIN site_visits s", "JOIN main.site_visits s") + """
+WHERE c.visit_id <= ?
+  AND s.site_url IN (SELECT site_url FROM incremental_state.analyzed_sites WHERE method == ?)
+  AND s.site_url IN (SELECT site_url FROM temp.site_visits)
+"""
+
 
 def get_category_counts(cookie_data: Dict[str, Dict[str, Any]]) -> Dict[Tuple[str,str], List[int]]:
     """
@@ -59,101 +112,377 @@ def get_category_counts(cookie_data: Dict[str, Dict[str, Any]]) -> Dict[Tuple[st
             label_by_ident_dict[key] = cat_list
 
         # increment the counters
-        cat_id = int(c_cat)
-        if 0 <= cat_id < 5:
-            cat_list[cat_id] += 1
-        elif cat_id == -1:
-            cat_list[6] += 1
-        elif cat_id == 99:
-            cat_list[5] += 1
+        index = category_index(int(c_cat))
+        if index is not None:
+            cat_list[index] += 1
 
     return label_by_ident_dict
 
 
 
-def main():
+def entry_key(row: sqlite3.Row) -> str:
+    """ Key of a consent table entry, only the first entry per site, name and domain is analyzed. """
+    return row["site_url"].strip() + ";" + row['consent_name'].strip() + ";" + row["consent_domain"].strip()
+
+
+def get_consent_entries(conn: sqlite3.Connection, query: str, params: Tuple = ()) -> Dict[str, Dict[str, Any]]:
     """
-    Script that finds potential GDPR violations by outputting all deviations from the majority
-    opinion for a cookie identified by name and domain.
-    @return: exit code, 0 for success
+    Retrieve the consent table entries, keeping only the first entry per site, name and domain.
+    @param conn: Database connection
+    @param query: Query returning the columns of CONSENTDATA_QUERY
+    @param params: Query parameters
+    @return: Entries keyed by site, name and domain
     """
-    argv = None
-    cargs = docopt(__doc__, argv=argv)
+    cookies_dict = dict()
+    row_count = 0
+    cur = conn.cursor()
+    cur.execute(query, params)
+    for row in cur:
+        row_count += 1
+        key = entry_key(row)
+        if key in cookies_dict:
+            # logger.warning(f"Duplicate found: {key}")
+            continue
 
-    setupLogger(".")
+        cookies_dict[key] = get_violation_details_consent_table(row)
+    cur.close()
+    metrics.add_rows("consent_scan", row_count)
+    return cookies_dict
 
-    logger.info("Running method 02: Identifying Outlier Labels")
 
-    database_path = cargs["<db_path>"]
-    if not os.path.exists(database_path):
-        logger.error("Database file does not exist.")
-        return 1
+def majority_opinion(cat_list: List[int]) -> Optional[Tuple[int, int, float]]:
+    """
+    Determine the majority label of a cookie, if it is decisive enough to flag deviating labels.
+    @param cat_list: Category counts of the cookie, as computed by get_category_counts
+    @return: majority label, number of occurrences and ratio of the majority, or None if no majority applies
+    """
+    sum_total = sum(cat_list[0:6])
+    expected_label = int(argmax(cat_list[0:6]))
 
-    logger.info(f"Database used: {database_path}")
+    # Only recognize majorities for necessary, functional, analytics, advertising and social media
+    if (expected_label < 0 or expected_label > 3) and expected_label != 5:
+        return None
 
-    # enable dictionary access by column name
-    conn = sqlite3.connect(database_path)
-    conn.row_factory = sqlite3.Row
+    maj_ratio = cat_list[expected_label] / sum_total if sum_total > 0 else 0
+    if sum_total >= threshold and maj_ratio > min_ratio:
+        return expected_label, cat_list[expected_label], maj_ratio
+    return None
 
-    cookies_dict = dict()
-    logger.info("Extracting consent data entries from database...")
+
+def check_majority(val: Dict[str, Any], cat_list: List[int]) -> Optional[Dict[str, Any]]:
+    """
+    Compare the label of a consent table entry to the majority opinion for its cookie.
+    @param val: Entry, as retrieved by get_consent_entries
+    @param cat_list: Category counts of the cookie
+    @return: violation details if the label deviates from the majority, else None
+    """
+    # only consider main 4 categories
+    if val["label"] < 0 or val["label"] > 3:
+        return None
+
+    # do not consider unknown category cookies
+    # if val["label"] == -1 or val["label"] == 6:
+    #    return None
+
+    majority = majority_opinion(cat_list)
+    if majority is None or int(val["label"]) == majority[0]:
+        return None
+
+    dat = val.copy()
+    dat["majority"], dat["maj_count"], dat["maj_ratio"] = majority
+    return dat
+
+
+def update_category_counts(count_table: CategoryCountTable, new_counts: Dict[Tuple[str, str], List[int]],
+                           removed_counts: Optional[Dict[Tuple[str, str], List[int]]] = None) \
+        -> Tuple[Dict[Tuple[str, str], List[int]], Set[Tuple[str, str]]]:
+    """
+    Add the category counts of the analyzed visits to the stored count table.
+    The changes are committed together with the rest of the incremental state.
+    @param count_table: Counts accumulated over the earlier incremental runs
+    @param new_counts: Category counts of the analyzed entries, keys being (name, domain)
+    @param removed_counts: Category counts of the earlier entries of the sites analyzed again, taken out of the table
+    @return: accumulated counts for the cookies of the analyzed entries, cookies whose majority opinion changed
+    """
+    if removed_counts:
+        new_counts = dict(new_counts)
+        for key, cat_list in removed_counts.items():
+            new_counts[key] = [a - b for a, b in zip(new_counts.get(key, [0] * len(cat_list)), cat_list)]
+    total_counts: Dict[Tuple[str, str], List[int]] = dict()
+    changed_keys: Set[Tuple[str, str]] = set()
+    for key, cat_list in new_counts.items():
+        previous = count_table.get(key)
+        if previous is None:
+            total = list(cat_list)
+        else:
+            total = [a + b for a, b in zip(previous, cat_list)]
+            if majority_opinion(previous) != majority_opinion(total):
+                changed_keys.add(key)
+        total_counts[key] = total
+    count_table.add(new_counts)
+    return total_counts, changed_keys
+
+
+def get_previous_entries(conn: sqlite3.Connection, state: IncrementalState,
+                         changed_keys: Set[Tuple[str, str]]) -> Dict[str, Dict[str, Any]]:
+    """
+    Retrieve the entries analyzed by earlier incremental runs, for the cookies whose majority opinion changed.
+    @param conn: Connection to the crawl database, restricted to the new visits by the incremental state
+    @param state: Incremental state of this method
+    @param changed_keys: Cookies to retrieve, as (name, domain)
+    @return: Entries keyed by site, name and domain
+    """
+    if not changed_keys or not state.has_previous_run:
+        return dict()
     with conn:
-        cur = conn.cursor()
-        cur.execute(CONSENTDATA_QUERY)
-        for row in cur:
-            key = row["site_url"].strip() + ";" + row['consent_name'].strip() + ";" + row["consent_domain"].strip()
-            if key in cookies_dict:
-                # logger.warning(f"Duplicate found: {key}")
-                continue
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS changed_keys (name TEXT, domain TEXT)")
+        conn.execute("DELETE FROM temp.changed_keys")
+        conn.executemany("INSERT INTO temp.changed_keys VALUES (?, ?)", changed_keys)
+    return get_consent_entries(conn, PREVIOUS_ENTRIES_QUERY, (state.watermark, state.method))
+
+
+def analyze_crawl_partitioned(conn: sqlite3.Connection, num_partitions: int,
+                              summaries: ViolationSummaries) -> Tuple[Dict[str, List[Dict[str, Any]]], int, Set[str]]:
+    """
+    Out-of-core variant of analyze_crawl, for crawls whose entries do not fit into memory.
+    The consent table entries are partitioned on disk by cookie, such that the entries and category counts
+    of a cookie are in the same partition, and the majority check runs one partition at a time.
+    The violations are put back into the order of the entries, as in the in-memory analysis.
+    @param conn: Database connection
+    @param num_partitions: number of partitions
+    @param summaries: summaries of the violations, updated with each violation found
+    @return: violations per site, number of entries analyzed, sites analyzed
+    """
+    violations: List[Tuple[int, Dict[str, Any]]] = []
+    total_domains = set()
+    total_cookies = 0
+    with HashPartitions(num_partitions) as partitions:
+        logger.info("Extracting consent data entries from database...")
+        row_count = 0
+        with conn, metrics.stage("consent_scan"):
+            cur = conn.cursor()
+            cur.execute(CONSENTDATA_QUERY)
+            for row in cur:
+                row_count += 1
+                partitions.add((row["consent_name"].strip(), row["consent_domain"].strip()), dict(row))
+            cur.close()
+        metrics.add_rows("consent_scan", row_count)
+
+        check_start = time.perf_counter()
+        for bucket in partitions.buckets():
+            # first entry per site, name and domain, with the number of the row it came from
+            entries: Dict[str, Tuple[int, Dict[str, Any]]] = dict()
+            for seq, _, row in bucket:
+                key = entry_key(row)
+                if key not in entries:
+                    entries[key] = (seq, get_violation_details_consent_table(row))
+            l_ident = get_category_counts({key: val for key, (_, val) in entries.items()})
+
+            for seq, val in entries.values():
+                total_cookies += 1
+                total_domains.add(val["site_url"])
+                dat = check_majority(val, l_ident[(val["name"], val["domain"])])
+                if dat is not None:
+                    violations.append((seq, dat))
+                    summaries.add_record(dat["site_url"], dat)
+        metrics.add_time("majority_check", check_start)
+        metrics.add_rows("majority_check", total_cookies)
+
+    violations.sort(key=lambda v: v[0])
+    violation_details = dict()
+    for _, dat in violations:
+        violation_details.setdefault(dat["site_url"], []).append(dat)
+    return violation_details, total_cookies, total_domains
 
-            cookies_dict[key] = get_violation_details_consent_table(row)
 
-    l_ident = get_category_counts(cookies_dict)
+def analyze_crawl(conn: sqlite3.Connection, state: Optional[IncrementalState], out_path: str,
+                  summaries: ViolationSummaries,
+                  memory_budget_mb: Optional[float] = None) -> Tuple[Dict[str, List[Dict[str, Any]]], int, Set[str]]:
+    """
+    Compute the majority opinion for each cookie from the crawl itself, and find the entries deviating from it.
+    In an incremental run, the counts are accumulated in the stored count table, and the violations of the
+    earlier runs are merged in, re-evaluated for the cookies whose majority opinion changed.
+    Otherwise, crawls estimated to exceed the memory budget are analyzed with analyze_crawl_partitioned.
+    @param conn: Database connection
+    @param state: Incremental state, if only new visits are analyzed
+    @param out_path: Directory of the outputs, holding the violations of earlier incremental runs
+    @param summaries: summaries of the violations, updated with each violation found or kept
+    @param memory_budget_mb: Memory available for the entries, see partitioned_grouping.py
+    @return: violations per site, number of entries analyzed, sites analyzed
+    """
+    if state is None:
+        num_partitions = partitions_needed(estimate_table_rows(conn, "consent_data"),
+                                           CONSENT_BYTES_PER_ROW, memory_budget_mb)
+        if num_partitions > 1:
+            return analyze_crawl_partitioned(conn, num_partitions, summaries)
+
+    logger.info("Extracting consent data entries from database...")
+    with conn, metrics.stage("consent_scan"):
+        cookies_dict = get_consent_entries(conn, CONSENTDATA_QUERY)
+
+    with metrics.stage("category_counts"):
+        l_ident = get_category_counts(cookies_dict)
+
+    changed_keys = set()
+    if state:
+        with metrics.stage("count_table_update"):
+            count_table = CategoryCountTable(state.conn, "method2_category_counts")
+            removed_counts = None
+            if not state.has_previous_run:
+                count_table.clear()
+            else:
+                with conn:
+                    removed_counts = get_category_counts(get_consent_entries(conn, REANALYZED_ENTRIES_QUERY,
+                                                                             (state.watermark, state.method)))
+            l_ident, changed_keys = update_category_counts(count_table, l_ident, removed_counts)
+        logger.info(f"Cookies whose majority opinion changed: {len(changed_keys)}")
 
-    violation_count = 0
     violation_details = dict()
-    violation_domains = set()
     total_domains = set()
     total_cookies = 0
+    check_start = time.perf_counter()
     for k_item, val in cookies_dict.items():
 
         total_cookies += 1
         total_domains.add(val["site_url"])
 
-        # only consider main 4 categories
-        if val["label"] < 0 or val["label"] > 3:
-            continue
-
-        # do not consider unknown category cookies
-        # if val["label"] == -1 or val["label"] == 6:
-        #    continue
-
-        key = (val["name"], val["domain"])
-        sum_total = sum(l_ident[key][0:6])
-        expected_label = int(argmax(l_ident[key][0:6]))
-
-        # Only recognize majorities for necessary, functional, analytics, advertising and social media
-        if (expected_label < 0 or expected_label > 3) and expected_label != 5:
-            continue
-
-        maj_ratio = l_ident[key][expected_label] / sum_total if sum_total > 0 else 0
-        if sum_total >= threshold and maj_ratio > min_ratio and int(val["label"]) != expected_label:
+        dat = check_majority(val, l_ident[(val["name"], val["domain"])])
+        if dat is not None:
             #logger.info(f"Potential Violation found for cookie {val['name']}, {val['domain']}, {val['site_url']}"
-            #            + f" -- actual label {val['label']} -- majority label: {expected_label}")
+            #            + f" -- actual label {val['label']} -- majority label: {dat['majority']}")
 
             vdomain = val["site_url"]
             if vdomain not in violation_details:
                 violation_details[vdomain] = list()
-            dat = val.copy()
-            dat["majority"] = int(expected_label)
-            dat["maj_count"] = l_ident[key][expected_label]
-            dat["maj_ratio"] = maj_ratio
             violation_details[vdomain].append(dat)
+            summaries.add_record(vdomain, dat)
+    metrics.add_time("majority_check", check_start)
+    metrics.add_rows("majority_check", total_cookies)
+
+    if state:
+        # entries of earlier runs are only re-evaluated for the cookies whose majority opinion changed
+        with metrics.stage("reevaluation"):
+            previous = load_violations("method2_cookies.json", out_path) if state.has_previous_run else dict()
+            previous_entries = get_previous_entries(conn, state, changed_keys)
+        for site, records in previous.items():
+            if site in state.new_sites:
+                # analyzed again as a whole above
+                continue
+            kept = [r for r in records if (r["name"], r["domain"]) not in changed_keys]
+            if kept:
+                violation_details.setdefault(site, []).extend(kept)
+                summaries.add_details({site: kept})
+        for val in previous_entries.values():
+            dat = check_majority(val, l_ident[(val["name"], val["domain"])])
+            if dat is not None:
+                violation_details.setdefault(val["site_url"], []).append(dat)
+                summaries.add_record(val["site_url"], dat)
+    return violation_details, total_cookies, total_domains
+
+
+def score_against_kb(conn: sqlite3.Connection, kb: MajorityKnowledgeBase,
+                     summaries: ViolationSummaries) -> Tuple[Dict[str, List[Dict[str, Any]]], int, Set[str]]:
+    """
+    Compare each entry to the majority opinion accumulated in the knowledge base, in a single pass
+    over the consent table. Only the keys of the entries seen so far are kept in memory.
+    @param conn: Database connection
+    @param kb: Knowledge base of category counts
+    @param summaries: summaries of the violations, updated with each violation found
+    @return: violations per site, number of entries analyzed, sites analyzed
+    """
+    violation_details = dict()
+    total_domains = set()
+    seen = set()
+    cur = conn.cursor()
+    cur.execute(CONSENTDATA_QUERY)
+    for row in cur:
+        key = entry_key(row)
+        if key in seen:
+            continue
+        seen.add(key)
+        total_domains.add(row["site_url"])
+
+        cat_list = kb.lookup(row["consent_name"], row["consent_domain"])
+        if cat_list is None:
+            continue
+        dat = check_majority(get_violation_details_consent_table(row), cat_list)
+        if dat is not None:
+            violation_details.setdefault(dat["site_url"], []).append(dat)
+            summaries.add_record(dat["site_url"], dat)
+    cur.close()
+    metrics.add_rows("kb_scoring", len(seen))
+    return violation_details, len(seen), total_domains
+
 
-            violation_domains.add(vdomain)
-            violation_count += 1
+def prepare_knowledge_base(run: MethodRun) -> bool:
+    """
+    Open the knowledge base given with --kb, or the category counts of the whole crawl for a single site,
+    which are counted before the crawl database is restricted to the site.
+    @param run: Run of the method, see method_run.py
+    @return: False if the run cannot proceed
+    """
+    global knowledge_base
+    cargs = run.cargs
+    logger.info(f"Majority threshold: {threshold}, minimum ratio: {min_ratio:.3f}")
+
+    if cargs["--kb"] and cargs["--incremental"]:
+        logger.error("The knowledge base cannot be combined with an incremental run.")
+        return False
+    if cargs["--kb"] and cargs["--columns"]:
+        logger.error("The knowledge base cannot be combined with the columnar export.")
+        return False
+
+    if cargs["--kb"]:
+        try:
+            knowledge_base = MajorityKnowledgeBase(cargs["--kb"])
+        except ValueError as e:
+            logger.error(f"{e}.")
+            return False
+        logger.info(f"Scoring against the majority of {knowledge_base.num_crawls()} crawls in '{cargs['--kb']}'")
+        if not knowledge_base.contains_crawl(run.conn, run.database_path):
+            logger.info("Note: this crawl is not part of the knowledge base.")
+    elif cargs["--site"]:
+        # the majority opinions still need the whole crawl, which is only counted again if the crawl changed
+        os.makedirs(run.out_path, exist_ok=True)
+        counts_path = os.path.join(run.out_path, CRAWL_COUNTS_FILE)
+        try:
+            knowledge_base = MajorityKnowledgeBase(counts_path)
+        except ValueError:
+            # counted by an earlier version, the counts are only a cache of the crawl
+            os.remove(counts_path)
+            knowledge_base = MajorityKnowledgeBase(counts_path)
+        if not knowledge_base.contains_crawl(run.conn, run.database_path):
+            logger.info("Counting the categories of the whole crawl...")
+            knowledge_base.clear()
+            knowledge_base.add_crawl(run.database_path)
+    return True
+
+
+def detect_majority_deviation(run: MethodRun) -> int:
+    """
+    Find the entries deviating from the majority opinion of their cookie.
+    @param run: Run of the method, see method_run.py
+    @return: exit code, 0 for success
+    """
+    conn = run.conn
+    if knowledge_base:
+        with conn, metrics.stage("kb_scoring"):
+            violation_details, total_cookies, total_domains = score_against_kb(conn, knowledge_base, run.summaries)
+        knowledge_base.close()
+    elif run.cargs["--columns"]:
+        crawl = run.load_columns()
+        if crawl is None:
+            return 1
+        with metrics.stage("vectorized_scan"):
+            violation_details, total_cookies, total_domains = majority_deviation(crawl, threshold, min_ratio)
+        run.summaries.add_details(violation_details)
+    else:
+        # the violations of earlier incremental runs are merged in by analyze_crawl
+        violation_details, total_cookies, total_domains = analyze_crawl(conn, run.state, run.out_path, run.summaries,
+                                                                        run.cargs["--memory_budget"])
+    violation_domains = set(violation_details.keys())
+    violation_count = sum(len(v) for v in violation_details.values())
 
-    conn.close()
     logger.info(f"Total cookies analyzed: {total_cookies}")
     logger.info(f"Number of potential violations: {violation_count}")
     logger.info(f"Number of sites in total: {len(total_domains)}")
@@ -180,14 +509,29 @@ def main():
 
     logger.info(f"Potential Violations per CMP Type: {v_per_cmp}")
 
-    if cargs["--out_path"]:
-        out_path = cargs["--out_path"]
-    else:
-        out_path = "./violation_stats/"
-    write_json(violation_details, "method2_cookies.json", out_path)
-    write_vdomains(violation_domains, "method2_domains.txt", out_path)
+    run.write(violation_details, violation_domains)
+    return run.finish(violation_domains, [violation_details],
+                      {"total_cookies": total_cookies, "total_sites": len(total_domains)})
+
+
+def main():
+    """
+    Script that finds potential GDPR violations by outputting all deviations from the majority
+    opinion for a cookie identified by name and domain.
+    @return: exit code, 0 for success
+    """
+    global threshold, min_ratio
+    argv = None
+    cargs = docopt(__doc__, argv=argv)
+
+    if cargs["--threshold"]:
+        threshold = int(cargs["--threshold"])
+    if cargs["--min_ratio"]:
+        min_ratio = float(cargs["--min_ratio"])
 
-    return 0
+    return run_method(cargs, "method2_majority_deviation", "Running method 02: Identifying Outlier Labels",
+                      detect_majority_deviation, "method2_cookies.json",
+                      {"threshold": threshold, "min_ratio": min_ratio}, prepare=prepare_knowledge_base)
 
 
 if __name__ == '__main__':
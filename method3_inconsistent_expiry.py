@@ -8,21 +8,41 @@ Required arguments:
     <db_path>  Path to database to analyze.
 Optional arguments:
     --out_path <out_path>: Directory to store the resutls.
+    --metrics <metrics_path>: Write timings, row counts and peak memory of the run to this JSON file.
+    --top <k>: Write the k cookies (by name and canonical domain) with the most violations across sites
+               to method3_top_cookies.json, counted with a heavy-hitter sketch of bounded memory.
+    --verify_top: Count the violations of the top cookies exactly, in a second pass over the violations.
+    --matched <matched_path>: Load the matched cookies written by extract_matched_cookies.py (JSON or snapshot)
+                              instead of extracting them.
+    --min_diff <seconds>: Minimum difference between declared and actual expiry to report (default: 86400).
+    --incremental: Only analyze the visits added since the last incremental run, and merge them into the outputs.
+    --site <site_url>: Only analyze the visits of this site, e.g. to re-check it after a fix.
+    --sample <fraction>: Only analyze a reproducible sample of this fraction of the visits of each CMP type,
+                         and estimate the share of sites with violations in the whole crawl.
+    --seed <seed>: Seed of the sample, the same seed draws the same visits (default: 0).
+    --columns <columns_path>: Run the vectorized backend over this columnar export of the database (see crawl_columns.py).
+    --memory_budget <mb>: Memory available for grouping the cookies, in megabytes. Larger crawls are grouped
+                          in partitions on disk (default: 4096).
+    --duckdb: Run the queries in DuckDB, which attaches the database read-only (requires the duckdb package).
+    --create_indexes: Add the indexes of single-site runs to the database if they are missing, which speeds up
+                      these runs, but modifies the database file.
 Usage:
-    method3_inconsistent_expiry.py <db_path> [--out_path <out_path>]
+    method3_inconsistent_expiry.py <db_path> [--out_path <out_path>] [--metrics <metrics_path>] [--top <k> [--verify_top]]
+                                   [--matched <matched_path>] [--memory_budget <mb>] [--min_diff <seconds>]
+                                   [--incremental | --site <site_url> | --sample <fraction> | --columns <columns_path> | --duckdb] [--seed <seed>] [--create_indexes]
 """
 
 
-import os
-import sqlite3
 import re
 import datetime
 import traceback
 import logging
+import time
 
 from docopt import docopt
-from utils import (setupLogger, retrieve_matched_cookies_from_DB,
-                                       write_json, write_vdomains)
+from utils import metrics
+from method_run import MethodRun, run_method
+from columnar_backend import expiry_inconsistencies
 
 logger = logging.getLogger("vd")
 
@@ -107,7 +127,7 @@ def found_inconsistency(key, full_cookie_data, update, diff):
     """
     Add inconsistency record to the dictionary.
     """
-    global inconsistency_details, inconsistency_domains, inconsistency_count
+    global inconsistency_details, inconsistency_domains, inconsistency_count, summaries
 
     diffseconds = None
     if diff != "persistent_as_session" and diff != "session_as_persistent":
@@ -132,46 +152,37 @@ def found_inconsistency(key, full_cookie_data, update, diff):
     if vdomain not in inconsistency_details:
         inconsistency_details[vdomain] = list()
 
-    inconsistency_details[vdomain].append({
+    record = {
         **full_cookie_data,
         "consent_expiry_str": consent_expiry_str,
         "true_expiry_str": actual_expiry_str,
         "expiry_diff": diff_expiry_str,
         "expiry_diff_seconds": None if type(diff) is str else diff,
         "expiry_ratio": None if not diffseconds else update['expiry'] / diffseconds
-    })
+    }
+    inconsistency_details[vdomain].append(record)
+    summaries.add_record(vdomain, record)
 
 
 
-def main():
+def detect_inconsistencies(run: MethodRun) -> int:
     """
-      Determine expiration date inconsistencies between actual cookie, and declared cookie.
-      @return: exit code, 0 for success
+    Find the matched cookies whose actual expiry is inconsistent with the declared expiry.
+    @param run: Run of the method, see method_run.py
+    @return: exit code, 0 for success
     """
-    global inconsistency_details, inconsistency_domains, inconsistency_count
-    argv = None
-    cargs = docopt(__doc__, argv=argv)
-
-    setupLogger(".", logging.INFO)
-    logger.info("Running method 03: Incorrect Retention Period")
-
-    database_path = cargs["<db_path>"]
-    if not os.path.exists(database_path):
-        logger.error("Database file does not exist.")
-        return 1
-    logger.info(f"Database used: {database_path}")
-
-    # enable dictionary access by column name
-    conn = sqlite3.connect(database_path)
-    conn.row_factory = sqlite3.Row
+    global inconsistency_details, inconsistency_domains, inconsistency_count, summaries
 
     logger.info("Extract cookies from database...")
-    cookies_dict, _ = retrieve_matched_cookies_from_DB(conn)
+    matched, cookies_dict = run.matched_cookies()
+    if matched is None and cookies_dict is None:
+        return 1
 
     total_domains = set()
     inconsistency_details = dict()
     inconsistency_domains = set()
     inconsistency_count = 0
+    summaries = run.summaries
     total_cookies = 0
 
     # number of persistent cookies declared as session cookies
@@ -183,53 +194,66 @@ def main():
     # number of persistent cookies with wrong expiration date
     wrong_expiry = 0
 
-    for key, val in cookies_dict.items():
-        # In the dataset collected from November 2020, this cookie always had an inconsistency.
-        # It was set with an empty value before the user chose any consent, with an expiration time of around 40 years.
-        # After it is updated, the expiration time is corrected.
-        if val["name"] == "CookieConsent" or val["consent_expiry"] is None:
-            continue
-        total_cookies += 1
-        total_domains.add(val["site_url"])
-
-        if val["consent_expiry"].lower() == "session":
-            for v in val["variable_data"]:
-                if not v["session"]:
-                    found_inconsistency(key, val, v, "persistent_as_session")
-                    pers_as_session_count += 1
-                    break
-        elif val["consent_expiry"].lower() in ["persistent", "persistant"]:
-            for v in val["variable_data"]:
-                if v["session"]:
-                    found_inconsistency(key, val, v, "session_as_persistent")
-                    sess_as_persistent += 1
-                    break
-        elif val["consent_expiry"]:
-            for v in val["variable_data"]:
-                if v["session"]:
-                    found_inconsistency(key, val, v, "session_as_persistent")
-                    sess_as_persistent += 1
-                    break
-                else:
-                    converted = convert_consent_expiry_to_seconds(val["consent_expiry"], val["cmp_type"])
-                    if converted != -1:
-                        diff = abs(v["expiry"] - converted)
-                        if diff >= min_diff and v["expiry"] > converted * 1.5:
-                            found_inconsistency(key, val, v, diff)
-                            wrong_expiry += 1
-                            break
-                    else:
-                        logger.warning(f"Skipped because could not convert date: {val['consent_expiry']}")
+    check_start = time.perf_counter()
+    if matched is not None:
+        inconsistencies, counts, total_cookies, total_domains = \
+            expiry_inconsistencies(matched, convert_consent_expiry_to_seconds, min_diff)
+        for record, update, diff in inconsistencies:
+            found_inconsistency(None, record, update, diff)
+        pers_as_session_count = counts["persistent_as_session"]
+        sess_as_persistent = counts["session_as_persistent"]
+        wrong_expiry = counts["wrong_expiry"]
+    else:
+        for key, val in cookies_dict.items():
+            # In the dataset collected from November 2020, this cookie always had an inconsistency.
+            # It was set with an empty value before the user chose any consent, with an expiration time of around 40 years.
+            # After it is updated, the expiration time is corrected.
+            if val["name"] == "CookieConsent" or val["consent_expiry"] is None:
+                continue
+            total_cookies += 1
+            total_domains.add(val["site_url"])
+
+            if val["consent_expiry"].lower() == "session":
+                for v in val["variable_data"]:
+                    if not v["session"]:
+                        found_inconsistency(key, val, v, "persistent_as_session")
+                        pers_as_session_count += 1
                         break
-        else:
-            logger.info(f"Expiry string was empty for cookie: {val['name']};{val['domain']}")
-    conn.close()
+            elif val["consent_expiry"].lower() in ["persistent", "persistant"]:
+                for v in val["variable_data"]:
+                    if v["session"]:
+                        found_inconsistency(key, val, v, "session_as_persistent")
+                        sess_as_persistent += 1
+                        break
+            elif val["consent_expiry"]:
+                for v in val["variable_data"]:
+                    if v["session"]:
+                        found_inconsistency(key, val, v, "session_as_persistent")
+                        sess_as_persistent += 1
+                        break
+                    else:
+                        converted = convert_consent_expiry_to_seconds(val["consent_expiry"], val["cmp_type"])
+                        if converted != -1:
+                            diff = abs(v["expiry"] - converted)
+                            if diff >= min_diff and v["expiry"] > converted * 1.5:
+                                found_inconsistency(key, val, v, diff)
+                                wrong_expiry += 1
+                                break
+                        else:
+                            logger.warning(f"Skipped because could not convert date: {val['consent_expiry']}")
+                            break
+            else:
+                logger.info(f"Expiry string was empty for cookie: {val['name']};{val['domain']}")
+    metrics.add_time("expiry_check", check_start)
+    metrics.add_rows("expiry_check", len(matched) if matched is not None else len(cookies_dict))
 
     logger.info(f"Number of cookies with expiries: {total_cookies}")
     logger.info(f"Number of inconsistencies: {inconsistency_count}")
     logger.info(f"Total number of domains that specified an expiration date: {len(total_domains)}")
     logger.info(f"Number of sites with inconsistencies: {len(inconsistency_domains)}")
 
+    inconsistency_details, inconsistency_domains = run.merge(inconsistency_details, inconsistency_domains)
+
     v_per_cmp = [0, 0, 0]
     for url, violating_cookies in inconsistency_details.items():
         for c in violating_cookies:
@@ -241,14 +265,26 @@ def main():
     logger.info(f"Number of session cookies declared as persistent cookies: {sess_as_persistent}")
     logger.info(f"Number of persistent cookies with wrong expiration date: {wrong_expiry}")
 
-    if cargs["--out_path"]:
-        out_path = cargs["--out_path"]
-    else:
-        out_path = "./violation_stats/"
-    write_json(inconsistency_details, "method3_cookies.json", out_path)
-    write_vdomains(inconsistency_domains, "method3_domains.txt", out_path)
+    run.write(inconsistency_details, inconsistency_domains)
+    return run.finish(inconsistency_domains, [inconsistency_details],
+                      {"total_cookies": total_cookies, "total_sites": len(total_domains)})
+
+
+def main():
+    """
+      Determine expiration date inconsistencies between actual cookie, and declared cookie.
+      @return: exit code, 0 for success
+    """
+    global min_diff
+    argv = None
+    cargs = docopt(__doc__, argv=argv)
+
+    if cargs["--min_diff"]:
+        min_diff = int(cargs["--min_diff"])
 
-    return 0
+    return run_method(cargs, "method3_inconsistent_expiry", "Running method 03: Incorrect Retention Period",
+                      detect_inconsistencies, "method3_cookies.json", {"min_diff": min_diff},
+                      fields=("expiry_ratio",), log_level=logging.INFO)
 
 
 if __name__ == '__main__':
@@ -8,44 +8,143 @@ Required arguments:
     <db_path>  Path to database to analyze.
 Optional arguments:
     --out_path <out_path>: Directory to store the resutls.
+    --metrics <metrics_path>: Write timings, row counts and peak memory of the run to this JSON file.
+    --top <k>: Write the k cookies (by name and canonical domain) with the most violations across sites
+               to method4_top_cookies.json, counted with a heavy-hitter sketch of bounded memory.
+    --verify_top: Count the violations of the top cookies exactly, in a second pass over the violations.
+    --sql: Evaluate the category filter and the counts in SQL, only retrieving unclassified entries.
+    --incremental: Only analyze the visits added since the last incremental run, and merge them into the outputs.
+    --site <site_url>: Only analyze the visits of this site, e.g. to re-check it after a fix.
+    --sample <fraction>: Only analyze a reproducible sample of this fraction of the visits of each CMP type,
+                         and estimate the share of sites with violations in the whole crawl.
+    --seed <seed>: Seed of the sample, the same seed draws the same visits (default: 0).
+    --columns <columns_path>: Run the vectorized backend over this columnar export of the database (see crawl_columns.py).
+    --duckdb: Run the queries in DuckDB, which attaches the database read-only (requires the duckdb package).
+    --create_indexes: Add the indexes of single-site runs to the database if they are missing, which speeds up
+                      these runs, but modifies the database file.
 Usage:
-    method4_unclassified_cookies.py <db_path> [--out_path <out_path>]
+    method4_unclassified_cookies.py <db_path> [--out_path <out_path>] [--sql] [--metrics <metrics_path>] [--top <k> [--verify_top]]
+                                    [--incremental | --site <site_url> | --sample <fraction> | --columns <columns_path> | --duckdb] [--seed <seed>] [--create_indexes]
 """
 
 from docopt import docopt
-import os
 import sqlite3
 import re
 
 import logging
-from utils import (setupLogger, CONSENTDATA_QUERY, write_json,
-                                       write_vdomains, get_violation_details_consent_table)
+from typing import List, Tuple
+from utils import CONSENTDATA_QUERY, get_violation_details_consent_table, metrics
+from method_run import MethodRun, run_method
+from columnar_backend import unclassified_cookies
 
 logger = logging.getLogger("vd")
 unclass_pattern = re.compile("(unclassified|uncategorized|Unclassified Cookies|no clasificados)", re.IGNORECASE)
 
-def main():
+CATEGORY_NAMES_QUERY = "SELECT DISTINCT cat_name FROM consent_data WHERE cat_name IS NOT NULL"
+
+# Filter applied to the consent table query, cat_name list is filled in at runtime.
+UNCLASSIFIED_FILTER = "cat_id == 4 OR cat_name IN ({})"
+
+
+def get_unclassified_query(cat_names: List[str]) -> str:
+    """ consent table query restricted to unclassified entries, with one parameter per category name """
+    placeholders = ",".join("?" * len(cat_names))
+    return f"SELECT * FROM ({CONSENTDATA_QUERY}) WHERE {UNCLASSIFIED_FILTER.format(placeholders)}"
+
+
+def get_unclassified_category_names(conn: sqlite3.Connection) -> List[str]:
     """
-      Detect potential violations by extracting all cookies that are unclassified.
-      @return: exit code, 0 for success
+    Match each distinct category name against the unclassified pattern once, instead of once per row.
+    @param conn: Database connection
+    @return: List of category names that count as unclassified
     """
-    argv = None
-    cargs = docopt(__doc__, argv=argv)
+    with conn:
+        cur = conn.cursor()
+        cur.execute(CATEGORY_NAMES_QUERY)
+        cat_names = [row["cat_name"] for row in cur if unclass_pattern.match(row["cat_name"])]
+        cur.close()
+    return cat_names
 
-    setupLogger(".")
 
-    logger.info("Running method 04: Unclassified Cookies")
+def get_unclassified_aggregates(conn: sqlite3.Connection, cat_names: List[str]) -> Tuple[int, int, List[Tuple[str, int]], List[int]]:
+    """
+    Compute the totals, per-site and per-CMP counts of unclassified cookies with GROUP BY queries.
+    @param conn: Database connection
+    @param cat_names: Category names that count as unclassified
+    @return: total cookie count, total site count, (site, count) pairs and violations per CMP type
+    """
+    unclassified_rows = get_unclassified_query(cat_names)
+    with conn:
+        cur = conn.cursor()
+        cur.execute(f"SELECT COUNT(*) as total, COUNT(DISTINCT site_url) as sites FROM ({CONSENTDATA_QUERY})")
+        row = cur.fetchone()
+        total_count, total_sites = row["total"], row["sites"]
+
+        cur.execute(f"SELECT site_url, COUNT(*) as count FROM ({unclassified_rows}) GROUP BY site_url", cat_names)
+        per_site = [(r["site_url"], r["count"]) for r in cur]
+
+        v_per_cmp = [0, 0, 0]
+        cur.execute(f"SELECT cmp_type, COUNT(*) as count FROM ({unclassified_rows}) GROUP BY cmp_type", cat_names)
+        for r in cur:
+            assert (r["cmp_type"] >= 0)
+            v_per_cmp[r["cmp_type"]] += r["count"]
+        cur.close()
+    return total_count, total_sites, per_site, v_per_cmp
 
-    database_path = cargs["<db_path>"]
-    if not os.path.exists(database_path):
-        logger.error("Database file does not exist.")
-        return 1
 
-    logger.info(f"Database used: {database_path}")
+def sql_main(run: MethodRun) -> int:
+    """
+    Variant of the detection that evaluates the filter and the counts in the database.
+    Only the violating rows are materialized, to produce the output files.
+    @param run: Run of the method, see method_run.py
+    @return: exit code, 0 for success
+    """
+    conn = run.conn
+    with metrics.stage("category_names"):
+        cat_names = get_unclassified_category_names(conn)
+    logger.info(f"Category names matched as unclassified: {cat_names}")
+
+    with metrics.stage("aggregate_queries"):
+        total_count, total_sites, per_site, v_per_cmp = get_unclassified_aggregates(conn, cat_names)
 
-    # enable dictionary access by column name
-    conn = sqlite3.connect(database_path)
-    conn.row_factory = sqlite3.Row
+    violation_details = dict()
+    with conn, metrics.stage("violation_scan"):
+        cur = conn.cursor()
+        cur.execute(get_unclassified_query(cat_names), cat_names)
+        for row in cur:
+            vdomain = row["site_url"]
+            if vdomain not in violation_details:
+                violation_details[vdomain] = list()
+            record = get_violation_details_consent_table(row)
+            violation_details[vdomain].append(record)
+            run.summaries.add_record(vdomain, record)
+        cur.close()
+
+    violation_domains = set(site for site, _ in per_site)
+    violation_count = sum(count for _, count in per_site)
+    metrics.add_rows("violation_scan", violation_count)
+
+    logger.info(f"Total number of cookies: {total_count}")
+    logger.info(f"Number of unclassified cookies: {violation_count}")
+
+    logger.info(f"Number of sites in total: {total_sites}")
+    logger.info(f"Number of sites with unclassified cookies: {len(violation_domains)}")
+    logger.info(f"Potential Violations per CMP Type: {v_per_cmp}")
+
+    violation_details, violation_domains = run.merge(violation_details, violation_domains)
+    run.write(violation_details, violation_domains)
+    return run.finish(violation_domains, [violation_details],
+                      {"total_cookies": total_count, "total_sites": total_sites})
+
+
+def detect_unclassified(run: MethodRun) -> int:
+    """
+    Find the consent table entries that are unclassified.
+    @param run: Run of the method, see method_run.py
+    @return: exit code, 0 for success
+    """
+    if run.cargs["--sql"] and not run.cargs["--columns"]:
+        return sql_main(run)
 
     # variables to collection violation details
     total_domains = set()
@@ -54,25 +153,37 @@ def main():
     violation_count = 0
     total_count = 0
 
-    logger.info("Extracting info from database...")
-
-    with conn:
-        cur = conn.cursor()
-        cur.execute(CONSENTDATA_QUERY)
-        for row in cur:
-            if row["cat_id"] == 4 or unclass_pattern.match(row["cat_name"]):
-                #logger.debug(f"Potential Violation: {row['consent_name']};{row['consent_domain']};{row['cat_name']}")
-                vdomain = row["site_url"]
-                violation_domains.add(vdomain)
-                violation_count += 1
-
-                if vdomain not in violation_details:
-                    violation_details[vdomain] = list()
-                violation_details[vdomain].append(get_violation_details_consent_table(row))
-            total_domains.add(row["site_url"])
-            total_count += 1
-
-    conn.close()
+    if run.cargs["--columns"]:
+        crawl = run.load_columns()
+        if crawl is None:
+            return 1
+        with metrics.stage("vectorized_scan"):
+            violation_details, total_count, total_domains = unclassified_cookies(crawl, unclass_pattern)
+        run.summaries.add_details(violation_details)
+        violation_domains = set(violation_details.keys())
+        violation_count = sum(len(v) for v in violation_details.values())
+    else:
+        logger.info("Extracting info from database...")
+
+        with run.conn, metrics.stage("consent_scan"):
+            cur = run.conn.cursor()
+            cur.execute(CONSENTDATA_QUERY)
+            for row in cur:
+                if row["cat_id"] == 4 or unclass_pattern.match(row["cat_name"]):
+                    #logger.debug(f"Potential Violation: {row['consent_name']};{row['consent_domain']};{row['cat_name']}")
+                    vdomain = row["site_url"]
+                    violation_domains.add(vdomain)
+                    violation_count += 1
+
+                    if vdomain not in violation_details:
+                        violation_details[vdomain] = list()
+                    record = get_violation_details_consent_table(row)
+                    violation_details[vdomain].append(record)
+                    run.summaries.add_record(vdomain, record)
+                total_domains.add(row["site_url"])
+                total_count += 1
+
+    metrics.add_rows("consent_scan", total_count)
 
     logger.info(f"Total number of cookies: {total_count}")
     logger.info(f"Number of unclassified cookies: {violation_count}")
@@ -80,6 +191,8 @@ def main():
     logger.info(f"Number of sites in total: {len(total_domains)}")
     logger.info(f"Number of sites with unclassified cookies: {len(violation_domains)}")
 
+    violation_details, violation_domains = run.merge(violation_details, violation_domains)
+
     v_per_cmp = [0, 0, 0]
     for url, violating_cookies in violation_details.items():
         for c in violating_cookies:
@@ -87,14 +200,21 @@ def main():
             v_per_cmp[c["cmp_type"]] += 1
     logger.info(f"Potential Violations per CMP Type: {v_per_cmp}")
 
-    if cargs["--out_path"]:
-        out_path = cargs["--out_path"]
-    else:
-        out_path = "./violation_stats/"
-    write_json(violation_details, "method4_cookies.json", out_path)
-    write_vdomains(violation_domains, "method4_domains.txt", out_path)
+    run.write(violation_details, violation_domains)
+    return run.finish(violation_domains, [violation_details],
+                      {"total_cookies": total_count, "total_sites": len(total_domains)})
+
+
+def main():
+    """
+      Detect potential violations by extracting all cookies that are unclassified.
+      @return: exit code, 0 for success
+    """
+    argv = None
+    cargs = docopt(__doc__, argv=argv)
 
-    return 0
+    return run_method(cargs, "method4_unclassified_cookies", "Running method 04: Unclassified Cookies",
+                      detect_unclassified, "method4_cookies.json")
 
 
 if __name__ == '__main__':
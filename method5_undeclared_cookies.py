@@ -9,132 +9,282 @@ Required arguments:
     <db_path>   Path to database to analyze.
 Optional arguments:
     --out_path <out_path>: Directory to store the resutls.
+    --metrics <metrics_path>: Write timings, row counts and peak memory of the run to this JSON file.
+    --top <k>: Write the k cookies (by name and canonical domain) with the most violations across sites
+               to method5_top_cookies.json, counted with a heavy-hitter sketch of bounded memory.
+    --verify_top: Count the violations of the top cookies exactly, in a second pass over the violations.
+    --incremental: Only analyze the visits added since the last incremental run, and merge them into the outputs.
+    --site <site_url>: Only analyze the visits of this site, e.g. to re-check it after a fix.
+    --sample <fraction>: Only analyze a reproducible sample of this fraction of the visits of each CMP type,
+                         and estimate the share of sites with violations in the whole crawl.
+    --seed <seed>: Seed of the sample, the same seed draws the same visits (default: 0).
+    --columns <columns_path>: Run the vectorized backend over this columnar export of the database (see crawl_columns.py).
+    --duckdb: Run the queries in DuckDB, which attaches the database read-only (requires the duckdb package).
+    --dimensions <dim_path>: Compare the cookies by the integer IDs of these dimension tables (see crawl_dimensions.py).
+    --create_indexes: Add the indexes of single-site runs to the database if they are missing, which speeds up
+                      these runs, but modifies the database file.
 Usage:
-    method5_undeclared_cookies.py <db_path> [--out_path <out_path>]
+    method5_undeclared_cookies.py <db_path> [--out_path <out_path>] [--metrics <metrics_path>] [--top <k> [--verify_top]] [--dimensions <dim_path>]
+                                  [--incremental | --site <site_url> | --sample <fraction> | --columns <columns_path> | --duckdb] [--seed <seed>] [--create_indexes]
 """
 
 from docopt import docopt
-import os
 import sqlite3
 import traceback
-import re
+
+from sys import intern
+from typing import Dict, List, Set, Tuple
 
 import logging
-from utils import (setupLogger, CONSENTDATA_QUERY, write_vdomains,
-                   JAVASCRIPTCOOKIE_QUERY, write_json, canonical_domain)
+from utils import (CONSENTDATA_QUERY, CMP_VISITS_CONDITION, CONSENT_VISITS_CONDITION, canonical_domain, metrics,
+                   ProgressReporter, count_visits, split_consent_domains)
+from method_run import MethodRun, run_method
+from crawl_dimensions import attach_dimensions
+from columnar_backend import undeclared_cookies
+from duckdb_engine import register_equivalent
 
 
 logger = logging.getLogger("vd")
 
-def main():
-    """
-    Try to detect potential violations by detecting cookies that
-    have never been declared by the consent notice.
-    @return: exit code, 0 for success
-    """
-    argv = None
-    cargs = docopt(__doc__, argv=argv)
-
-    setupLogger(".")
+# Observed cookies on sites with a working CMP, grouped by site so that each site can be checked in turn.
+OBSERVED_BY_SITE_QUERY = f"""
+SELECT DISTINCT s.site_url,
+        ccr.cmp_type as cmp_type,
+        j.visit_id,
+        j.name,
+        j.host as cookie_domain,
+        j.path,
+        j.value,
+        j.expiry as actual_expiry,
+        j.is_session,
+        j.is_http_only,
+        j.is_host_only,
+        j.is_secure,
+        j.time_stamp
+FROM javascript_cookies j
+JOIN site_visits s ON s.visit_id == j.visit_id
+JOIN consent_crawl_results ccr ON ccr.visit_id == j.visit_id
+WHERE j.record_type <> "deleted" and {CMP_VISITS_CONDITION}
+ORDER BY s.site_url, j.visit_id, j.name, j.time_stamp ASC;
+"""
 
-    logger.info("Running method 05: Undeclared Cookies")
+# DuckDB equivalent of the above, ties are broken by the first row of the observed cookie (see duckdb_engine.py).
+OBSERVED_BY_SITE_QUERY_DUCKDB = """
+SELECT * EXCLUDE (first_row) FROM (
+    SELECT s.site_url,
+            CAST(ccr.cmp_type AS INTEGER) as cmp_type,
+            CAST(j.visit_id AS BIGINT) as visit_id,
+            j.name,
+            j.host as cookie_domain,
+            j.path,
+            j.value,
+            j.expiry as actual_expiry,
+            CAST(j.is_session AS INTEGER) as is_session,
+            CAST(j.is_http_only AS INTEGER) as is_http_only,
+            CAST(j.is_host_only AS INTEGER) as is_host_only,
+            CAST(j.is_secure AS INTEGER) as is_secure,
+            j.time_stamp,
+            MIN(CAST(j.id AS BIGINT)) as first_row
+    FROM javascript_cookies j
+    JOIN site_visits s ON s.visit_id == j.visit_id
+    JOIN consent_crawl_results ccr ON ccr.visit_id == j.visit_id
+    WHERE j.record_type <> 'deleted' and CAST(ccr.cmp_type AS INTEGER) <> -1 and CAST(ccr.crawl_state AS INTEGER) == 0
+    GROUP BY ALL
+)
+ORDER BY site_url, visit_id, name, time_stamp ASC, first_row;
+"""
+register_equivalent(OBSERVED_BY_SITE_QUERY, OBSERVED_BY_SITE_QUERY_DUCKDB)
 
-    database_path = cargs["<db_path>"]
-    if not os.path.exists(database_path):
-        logger.error("Database file does not exist.")
-        return 1
+# Declared cookie identities (name ID, canonical domain ID) per site ID, from the dimension tables.
+DECLARED_IDS_QUERY = """
+SELECT DISTINCT f.site_id, f.name_id, cd.canonical_id
+FROM dims.consent_facts f
+JOIN dims.consent_domains cd ON cd.domain_id == f.domain_id
+JOIN site_visits s ON s.visit_id == f.visit_id
+JOIN consent_crawl_results ccr ON ccr.visit_id == f.visit_id
+"""
 
-    logger.info(f"Database used: {database_path}")
+# OBSERVED_BY_SITE_QUERY with the identity of each cookie as IDs of the dimension tables.
+OBSERVED_BY_SITE_IDS_QUERY = f"""
+SELECT DISTINCT s.site_url,
+        ccr.cmp_type as cmp_type,
+        j.visit_id,
+        j.name,
+        j.host as cookie_domain,
+        j.path,
+        j.value,
+        j.expiry as actual_expiry,
+        j.is_session,
+        j.is_http_only,
+        j.is_host_only,
+        j.is_secure,
+        j.time_stamp,
+        f.site_id,
+        f.name_id,
+        d.canonical_id
+FROM javascript_cookies j
+JOIN dims.cookie_facts f ON f.row_id == j.rowid
+LEFT JOIN dims.domains d ON d.id == f.domain_id
+JOIN site_visits s ON s.visit_id == j.visit_id
+JOIN consent_crawl_results ccr ON ccr.visit_id == j.visit_id
+WHERE j.record_type <> "deleted" and {CMP_VISITS_CONDITION}
+ORDER BY s.site_url, j.visit_id, j.name, j.time_stamp ASC;
+"""
 
-    # enable dictionary access by column name
-    conn = sqlite3.connect(database_path)
-    conn.row_factory = sqlite3.Row
+# Fields retained for each undeclared cookie, in the order of the output keys.
+SLIM_FIELDS = ("name", "cookie_domain", "path", "value", "cmp_type", "actual_expiry",
+               "is_session", "is_http_only", "is_host_only", "is_secure", "time_stamp")
+OUTPUT_KEYS = ("name", "domain", "path", "value", "cmp_type", "expiry",
+               "is_session", "http_only", "host_only", "secure", "same_site")
 
-    ctable_cookies = set()
 
-    # Retrieve data from consent table
+def get_declared_by_site(conn: sqlite3.Connection, site_ids: Dict[str, int]) -> Dict[int, Set[Tuple[str, str]]]:
+    """
+    Retrieve the declared cookie identities (name, canonical domain), grouped by interned site ID.
+    @param conn: Database connection
+    @param site_ids: Mapping of site URL to integer ID, extended with each new site encountered
+    @return: Set of declared identities per site ID
+    """
+    declared_by_site: Dict[int, Set[Tuple[str, str]]] = dict()
+    progress = ProgressReporter("Declared cookie scan", count_visits(conn, CONSENT_VISITS_CONDITION))
     with conn:
         cur = conn.cursor()
         cur.execute(CONSENTDATA_QUERY)
         for row in cur:
-            fpd = row["site_url"]
+            progress.update(row["visit_id"])
+            site_id = site_ids.setdefault(row["site_url"], len(site_ids))
+            if site_id not in declared_by_site:
+                declared_by_site[site_id] = set()
+            declared = declared_by_site[site_id]
 
-            if re.search("<br/>", row["consent_domain"]):
-                consent_domains = row["consent_domain"].split("<br/>")
-            elif re.search(",", row["consent_domain"]):
-                consent_domains = row["consent_domain"].split(",")
+            for domain_entry in split_consent_domains(row["consent_domain"]):
+                d = domain_entry.strip()
+                declared.add((intern(row["consent_name"]), intern(canonical_domain(d))))
+        cur.close()
+    return declared_by_site
+
+
+def get_declared_by_site_ids(conn: sqlite3.Connection) -> Dict[int, Set[Tuple[int, int]]]:
+    """
+    Variant of get_declared_by_site over the dimension tables, where the domain lists of the declarations
+    were already split and canonicalized when the tables were built.
+    @param conn: Database connection, with the dimension tables attached
+    @return: Set of declared identities (name ID, canonical domain ID) per site ID
+    """
+    declared_by_site: Dict[int, Set[Tuple[int, int]]] = dict()
+    with conn:
+        cur = conn.cursor()
+        cur.execute(DECLARED_IDS_QUERY)
+        for site_id, name_id, canonical_id in cur:
+            if site_id not in declared_by_site:
+                declared_by_site[site_id] = set()
+            declared_by_site[site_id].add((name_id, canonical_id))
+        cur.close()
+    return declared_by_site
+
+
+def prepare_dimensions(run: MethodRun) -> bool:
+    """
+    Attach the dimension tables given with --dimensions, see crawl_dimensions.py.
+    @param run: Run of the method, see method_run.py
+    @return: False if the run cannot proceed
+    """
+    if run.cargs["--dimensions"] is None:
+        return True
+    if run.cargs["--columns"] or run.cargs["--duckdb"]:
+        logger.error("The dimension tables cannot be combined with the columnar export or DuckDB.")
+        return False
+    return attach_dimensions(run.conn, run.cargs["--dimensions"], run.database_path)
+
+
+def detect_undeclared(run: MethodRun) -> int:
+    """
+    Find the cookies observed on sites with a working CMP, which are not declared by the consent notice of the site.
+    @param run: Run of the method, see method_run.py
+    @return: exit code, 0 for success
+    """
+    use_dimensions = run.cargs["--dimensions"] is not None
+    if run.cargs["--columns"]:
+        crawl = run.load_columns()
+        if crawl is None:
+            return 1
+        with metrics.stage("vectorized_scan"):
+            violation_details, total, total_sites = undeclared_cookies(crawl, split_consent_domains,
+                                                                       SLIM_FIELDS, OUTPUT_KEYS)
+        run.summaries.add_details(violation_details)
+        violation_count = sum(len(v) for v in violation_details.values())
+    else:
+        # Retrieve data from consent table
+        site_ids: Dict[str, int] = dict()
+        with metrics.stage("declared_scan"):
+            if use_dimensions:
+                declared_by_site = get_declared_by_site_ids(run.conn)
             else:
-                consent_domains = [row["consent_domain"]]
+                declared_by_site = get_declared_by_site(run.conn, site_ids)
 
-            for domain_entry in consent_domains:
-                d = domain_entry.strip()
-                #if re.search("\s+", d):
-                #    print("Whitespace found:")
-                #    print(consent_domains)
-
-                ctable_cookies.add((row["consent_name"], canonical_domain(d), fpd))
-
-    unique_cookie_identifiers = set()
-    full_cookie_details = dict()
-
-    # Retrieve data from Javascript Cookies table
-    try:
-        with conn:
-            cur = conn.cursor()
-            cur.execute(JAVASCRIPTCOOKIE_QUERY)
-            for row in cur:
-                if row["cmp_type"] == -1 or row["crawl_state"] != 0:
-                    #logger.info(f"No CMP found on domain {row['site_url']}, skipping...")
-                    continue
-                ident = (row["name"], canonical_domain(row["cookie_domain"]), row["site_url"])
-                unique_cookie_identifiers.add(ident)
-                # just add the first instance for some basic info on the cookie
-                if ident not in full_cookie_details:
-                    full_cookie_details[ident] = row
-            cur.close()
-    except (sqlite3.OperationalError, sqlite3.IntegrityError):
-        logger.error("A database error occurred:")
-        logger.error(traceback.format_exc())
-        return -1
-
-    violation_details = dict()
-    violation_domains = set()
-    violation_count = 0
-    total_domains = set()
-    total = 0
-
-    for uident in unique_cookie_identifiers:
-        vdomain = uident[2]
-        if uident not in ctable_cookies:
-            violation_domains.add(vdomain)
-            violation_count += 1
-
-            if vdomain not in violation_details:
-                violation_details[vdomain] = list()
-
-            violation_details[vdomain].append({
-                "name": full_cookie_details[uident]["name"],
-                "domain": full_cookie_details[uident]["cookie_domain"],
-                "path": full_cookie_details[uident]["path"],
-                "value": full_cookie_details[uident]["value"],
-                "cmp_type": full_cookie_details[uident]["cmp_type"],
-                "expiry": full_cookie_details[uident]["actual_expiry"],
-                "is_session": full_cookie_details[uident]["is_session"],
-                "http_only": full_cookie_details[uident]["is_http_only"],
-                "host_only": full_cookie_details[uident]["is_host_only"],
-                "secure": full_cookie_details[uident]["is_secure"],
-                "same_site": full_cookie_details[uident]["time_stamp"]
-            })
-        total_domains.add(vdomain)
-        total += 1
-
-    conn.close()
+        # Slim records of undeclared cookies, per site URL
+        undeclared: Dict[str, List[Tuple]] = dict()
+        violation_count = 0
+        total_sites = 0
+        total = 0
+
+        # Retrieve data from Javascript Cookies table, one site at a time.
+        # Only the identities seen on the current site need to be kept in memory.
+        row_count = 0
+        try:
+            progress = ProgressReporter("Observed cookie scan", count_visits(run.conn, CMP_VISITS_CONDITION))
+            with run.conn, metrics.stage("observed_scan"):
+                cur = run.conn.cursor()
+                cur.execute(OBSERVED_BY_SITE_IDS_QUERY if use_dimensions else OBSERVED_BY_SITE_QUERY)
+                current_site = None
+                declared: Set[Tuple] = set()
+                seen: Set[Tuple] = set()
+                for row in cur:
+                    row_count += 1
+                    progress.update(row["visit_id"])
+                    fpd = row["site_url"]
+                    if fpd != current_site:
+                        current_site = fpd
+                        site_id = row["site_id"] if use_dimensions else site_ids.get(fpd)
+                        declared = declared_by_site.get(site_id, set()) if site_id is not None else set()
+                        seen = set()
+                        total_sites += 1
+
+                    # just keep the first instance for some basic info on the cookie
+                    if use_dimensions:
+                        ident = (row["name_id"], row["canonical_id"])
+                    else:
+                        ident = (row["name"], canonical_domain(row["cookie_domain"]))
+                    if ident in seen:
+                        continue
+                    seen.add(ident)
+                    total += 1
+
+                    if ident not in declared:
+                        violation_count += 1
+                        if fpd not in undeclared:
+                            undeclared[fpd] = list()
+                        undeclared[fpd].append(tuple(row[f] for f in SLIM_FIELDS))
+                        run.summaries.add(fpd, row["name"], row["cookie_domain"])
+                cur.close()
+        except (sqlite3.OperationalError, sqlite3.IntegrityError):
+            logger.error("A database error occurred:")
+            logger.error(traceback.format_exc())
+            return -1
+
+        metrics.add_rows("observed_scan", row_count)
+        violation_details = {site: [dict(zip(OUTPUT_KEYS, record)) for record in records]
+                             for site, records in undeclared.items()}
+
+    violation_domains = set(violation_details.keys())
 
     logger.info(f"Total cookies collected from websites with a CMP: {total}")
     logger.info(f"Number of cookies that have not been found in consent notices: {violation_count}")
-    logger.info(f"Total sites with a supported, functioning CMP: {len(total_domains)}")
+    logger.info(f"Total sites with a supported, functioning CMP: {total_sites}")
     logger.info(f"Number of sites with undeclared cookies on said CMP: {len(violation_domains)}")
 
+    violation_details, violation_domains = run.merge(violation_details, violation_domains)
+
     v_per_cmp = [0, 0, 0]
     for url, violating_cookies in violation_details.items():
         for c in violating_cookies:
@@ -143,14 +293,21 @@ def main():
 
     logger.info(f"Potential Violations per CMP Type: {v_per_cmp}")
 
-    if cargs["--out_path"]:
-        out_path = cargs["--out_path"]
-    else:
-        out_path = "./violation_stats/"
-    write_json(violation_details, "method5_cookies.json", out_path)
-    write_vdomains(violation_domains, "method5_domains.txt", out_path)
+    run.write(violation_details, violation_domains)
+    return run.finish(violation_domains, [violation_details], {"total_cookies": total, "total_sites": total_sites})
+
+
+def main():
+    """
+    Try to detect potential violations by detecting cookies that
+    have never been declared by the consent notice.
+    @return: exit code, 0 for success
+    """
+    argv = None
+    cargs = docopt(__doc__, argv=argv)
 
-    return 0
+    return run_method(cargs, "method5_undeclared_cookies", "Running method 05: Undeclared Cookies",
+                      detect_undeclared, "method5_cookies.json", prepare=prepare_dimensions)
 
 
 if __name__ == '__main__':
@@ -8,57 +8,220 @@ Required arguments:
     <db_path>   Path to database to analyze.
 Optional arguments:
     --out_path <out_path>: Directory to store the resutls.
+    --metrics <metrics_path>: Write timings, row counts and peak memory of the run to this JSON file.
+    --top <k>: Write the k cookies (by name and canonical domain) with the most violations across sites
+               to method6_top_cookies.json, counted with a heavy-hitter sketch of bounded memory.
+    --verify_top: Count the violations of the top cookies exactly, in a second pass over the violations.
+    --sql: Find the contradicting declarations through a GROUP BY query, only retrieving conflicting entries.
+    --incremental: Only analyze the visits added since the last incremental run, and merge them into the outputs.
+    --site <site_url>: Only analyze the visits of this site, e.g. to re-check it after a fix.
+    --sample <fraction>: Only analyze a reproducible sample of this fraction of the visits of each CMP type,
+                         and estimate the share of sites with violations in the whole crawl.
+    --seed <seed>: Seed of the sample, the same seed draws the same visits (default: 0).
+    --columns <columns_path>: Run the vectorized backend over this columnar export of the database (see crawl_columns.py).
+    --duckdb: Run the queries in DuckDB, which attaches the database read-only (requires the duckdb package).
+    --memory_budget <mb>: Memory available for grouping the declarations, in megabytes. Larger crawls are grouped
+                          in partitions on disk (default: 4096).
+    --dimensions <dim_path>: Group the declarations by the integer IDs of these dimension tables (see crawl_dimensions.py).
+    --create_indexes: Add the indexes of single-site runs and of the SQL variant to the database if they are missing,
+                      which speeds up these runs, but modifies the database file.
 Usage:
-    method6_contradictory_labels.py <db_path> [--out_path <out_path>]
+    method6_contradictory_labels.py <db_path> [--out_path <out_path>] [--sql] [--metrics <metrics_path>] [--top <k> [--verify_top]] [--memory_budget <mb>]
+                                    [--dimensions <dim_path>]
+                                    [--incremental | --site <site_url> | --sample <fraction> | --columns <columns_path> | --duckdb] [--seed <seed>] [--create_indexes]
 """
 
 from docopt import docopt
-import os
 import sqlite3
 
 import logging
-from utils import (setupLogger, CONSENTDATA_QUERY, get_violation_details_consent_table,
-                   write_json, write_vdomains)
+from typing import Callable, Dict, Any, Hashable, List, Tuple
+from utils import (ORDERED_CONSENTDATA_QUERY, ORDERED_CONSENTDATA_TEMPLATE, CONSENT_BYTES_PER_ROW,
+                   get_violation_details_consent_table, write_vdomains, ensure_index, metrics)
+from method_run import MethodRun, run_method
+from crawl_dimensions import attach_dimensions
+from partitioned_grouping import HashPartitions, partitions_needed, estimate_table_rows
+from columnar_backend import contradictory_labels
+from duckdb_engine import register_equivalent, CONSENTDATA_QUERY_DUCKDB
 
 logger = logging.getLogger("vd")
 
+# Declarations of the same cookie on the same site that were assigned more than one category.
+CONFLICTING_KEYS_QUERY = """
+SELECT s.site_url, c.name, c.domain
+FROM consent_data c
+JOIN site_visits s ON s.visit_id == c.visit_id
+JOIN consent_crawl_results ccr ON ccr.visit_id == c.visit_id
+GROUP BY s.site_url, c.name, c.domain
+HAVING COUNT(DISTINCT c.cat_id) > 1
+"""
 
-def main():
+# Restricts the consent table query to the conflicting declarations only.
+# Entries are in the same order as in the full scan, such that the first label seen for each cookie is the same.
+CONFLICTING_CONSENTDATA_QUERY = ORDERED_CONSENTDATA_TEMPLATE.format(
+    columns="", joins="", where=f"WHERE (s.site_url, c.name, c.domain) IN ({CONFLICTING_KEYS_QUERY})")
+
+# DuckDB equivalent of the above, first_row holds the row ID of each entry (see duckdb_engine.py).
+CONFLICTING_CONSENTDATA_QUERY_DUCKDB = f"""
+SELECT d.* FROM ({CONSENTDATA_QUERY_DUCKDB}) d
+JOIN ({CONFLICTING_KEYS_QUERY}) k ON k.site_url == d.site_url and k.name == d.consent_name and k.domain == d.consent_domain
+ORDER BY d.first_row
+"""
+register_equivalent(CONFLICTING_CONSENTDATA_QUERY, CONFLICTING_CONSENTDATA_QUERY_DUCKDB)
+
+# Number of unique declarations and sites, used for the totals of the SQL variant.
+DECLARATION_TOTALS_QUERY = """
+SELECT COUNT(*) as total_entries, COUNT(DISTINCT site_url) as total_sites FROM (
+    SELECT DISTINCT s.site_url, c.name, c.domain
+    FROM consent_data c
+    JOIN site_visits s ON s.visit_id == c.visit_id
+    JOIN consent_crawl_results ccr ON ccr.visit_id == c.visit_id
+)
+"""
+
+# ORDERED_CONSENTDATA_QUERY with the site, name and domain of each declaration as IDs of the dimension tables.
+# The IDs are determined by the grouped columns, such that the entries and their order are the same.
+CONSENTDATA_IDS_QUERY = ORDERED_CONSENTDATA_TEMPLATE.format(
+    columns=", f.site_id, f.name_id, f.domain_id", joins="\nJOIN dims.consent_facts f ON f.row_id == c.rowid", where="")
+
+
+def declaration_key(row: sqlite3.Row) -> str:
+    """ Key of a declaration, by site, name and domain. """
+    return row["site_url"] + ";" + row['consent_name'] + ";" + row['consent_domain']
+
+
+def declaration_id_key(row: sqlite3.Row) -> Tuple[int, int, int]:
+    """ Key of a declaration by the IDs of its site, name and domain, for rows of CONSENTDATA_IDS_QUERY. """
+    return row["site_id"], row["name_id"], row["domain_id"]
+
+
+def add_declaration(cookies_dict: Dict[Hashable, Dict[str, Any]], row: sqlite3.Row,
+                    key_of: Callable[[sqlite3.Row], Hashable] = declaration_key) -> None:
     """
-      Determine potential violations by checking if a website defines two differing labels for the same cookie.
-      @return: exit code, 0 for success
+    Add a consent table entry to the dictionary, recording any label that deviates from the first one seen.
+    @param cookies_dict: Declarations, keyed by site, name and domain.
+    @param row: Row retrieved through the consent table query.
+    @param key_of: Key of the declaration of a row, declaration_id_key for rows of CONSENTDATA_IDS_QUERY.
     """
-    argv = None
-    cargs = docopt(__doc__, argv=argv)
+    key = key_of(row)
+    if key in cookies_dict:
+        if cookies_dict[key]["label"] != row["cat_id"]:
+            cookies_dict[key]["additional_labels"].append(row["cat_id"])
+    else:
+        cookies_dict[key] = get_violation_details_consent_table(row)
+        cookies_dict[key]["additional_labels"] = list()
+
+
+def get_conflicts_partitioned(conn: sqlite3.Connection, num_partitions: int, query: str = ORDERED_CONSENTDATA_QUERY,
+                              key_of: Callable[[sqlite3.Row], Hashable] = declaration_key
+                              ) -> Tuple[Dict[Hashable, Dict[str, Any]], Dict[str, int]]:
+    """
+    Out-of-core variant of the consent table scan, for crawls whose declarations do not fit into memory.
+    The entries are partitioned on disk by declaration, and the labels of each partition are compared in turn.
+    As with the SQL variant, only the conflicting declarations are kept, in the order of their first entry.
+    @param conn: Database connection
+    @param num_partitions: number of partitions
+    @param query: consent table query, CONSENTDATA_IDS_QUERY to group by the IDs of the dimension tables
+    @param key_of: key of the declaration of a row of the query, see add_declaration
+    @return: conflicting declarations keyed by site, name and domain, and the totals of all declarations
+    """
+    conflicts: List[Tuple[int, Hashable, Dict[str, Any]]] = []
+    total_entries = 0
+    total_sites = set()
+    with HashPartitions(num_partitions) as partitions:
+        logger.info("Extracting consent data entries from database...")
+        row_count = 0
+        with conn, metrics.stage("consent_scan"):
+            cur = conn.cursor()
+            cur.execute(query)
+            for row in cur:
+                row_count += 1
+                partitions.add(key_of(row), dict(row))
+            cur.close()
+        metrics.add_rows("consent_scan", row_count)
 
-    setupLogger(".")
+        with metrics.stage("conflict_check"):
+            for bucket in partitions.buckets():
+                cookies_dict: Dict[Hashable, Dict[str, Any]] = dict()
+                first_seq: Dict[Hashable, int] = dict()
+                for seq, key, row in bucket:
+                    first_seq.setdefault(key, seq)
+                    add_declaration(cookies_dict, row, key_of)
+                for key, cookie in cookies_dict.items():
+                    total_entries += 1
+                    total_sites.add(cookie["site_url"])
+                    if len(cookie["additional_labels"]) > 0:
+                        conflicts.append((first_seq[key], key, cookie))
 
-    logger.info("Running method 06: Contradictory Labels")
+    conflicts.sort(key=lambda c: c[0])
+    return {key: cookie for _, key, cookie in conflicts}, {"total_entries": total_entries, "total_sites": len(total_sites)}
 
-    database_path = cargs["<db_path>"]
-    if not os.path.exists(database_path):
-        logger.error("Database file does not exist.")
-        return 1
 
-    logger.info(f"Database used: {database_path}")
+def prepare_dimensions(run: MethodRun) -> bool:
+    """
+    Attach the dimension tables given with --dimensions, see crawl_dimensions.py.
+    @param run: Run of the method, see method_run.py
+    @return: False if the run cannot proceed
+    """
+    if run.cargs["--dimensions"] is None:
+        return True
+    if run.cargs["--sql"] or run.cargs["--columns"] or run.cargs["--duckdb"]:
+        logger.error("The dimension tables cannot be combined with the SQL variant, the columnar export or DuckDB.")
+        return False
+    return attach_dimensions(run.conn, run.cargs["--dimensions"], run.database_path)
 
-    # enable dictionary access by column name
-    conn = sqlite3.connect(database_path)
-    conn.row_factory = sqlite3.Row
 
-    cookies_dict = dict()
-    logger.info("Extracting consent data entries from database...")
-    with conn:
-        cur = conn.cursor()
-        cur.execute(CONSENTDATA_QUERY)
-        for row in cur:
-            key = row["site_url"] + ";" + row['consent_name'] + ";" + row['consent_domain']
-            if key in cookies_dict:
-                if cookies_dict[key]["label"] != row["cat_id"]:
-                    cookies_dict[key]["additional_labels"].append(row["cat_id"])
-            else:
-                cookies_dict[key] = get_violation_details_consent_table(row)
-                cookies_dict[key]["additional_labels"] = list()
+def detect_contradictions(run: MethodRun) -> int:
+    """
+    Find the cookies that a site declares with more than one label.
+    @param run: Run of the method, see method_run.py
+    @return: exit code, 0 for success
+    """
+    use_dimensions = run.cargs["--dimensions"] is not None
+    consent_query = CONSENTDATA_IDS_QUERY if use_dimensions else ORDERED_CONSENTDATA_QUERY
+    key_of = declaration_id_key if use_dimensions else declaration_key
+
+    # the full scan of a large crawl is grouped in partitions on disk, a single site or a sample always fits into memory
+    num_partitions = 1
+    if not (run.cargs["--columns"] or run.cargs["--sql"] or run.cargs["--site"] or run.cargs["--sample"]):
+        num_partitions = partitions_needed(estimate_table_rows(run.conn, "consent_data"), CONSENT_BYTES_PER_ROW,
+                                           run.cargs["--memory_budget"])
+
+    cookies_dict: Dict[Hashable, Dict[str, Any]] = dict()
+    if run.cargs["--columns"]:
+        crawl = run.load_columns()
+        if crawl is None:
+            return 1
+        with metrics.stage("vectorized_scan"):
+            cookies_dict, total_entries, total_domains = contradictory_labels(crawl)
+        totals = {"total_entries": total_entries, "total_sites": len(total_domains)}
+    elif run.cargs["--sql"]:
+        logger.info("Extracting conflicting consent data entries from database...")
+        with metrics.stage("create_index"):
+            ensure_index(run.conn, "consent_data_conflicts_idx", "consent_data",
+                         ["visit_id", "name", "domain", "cat_id"], run.cargs["--create_indexes"])
+        with run.conn, metrics.stage("conflict_query"):
+            cur = run.conn.cursor()
+            cur.execute(CONFLICTING_CONSENTDATA_QUERY)
+            for row in cur:
+                add_declaration(cookies_dict, row)
+            cur.execute(DECLARATION_TOTALS_QUERY)
+            totals = cur.fetchone()
+            cur.close()
+    elif num_partitions > 1:
+        cookies_dict, totals = get_conflicts_partitioned(run.conn, num_partitions, consent_query, key_of)
+    else:
+        logger.info("Extracting consent data entries from database...")
+        totals = None
+        row_count = 0
+        with run.conn, metrics.stage("consent_scan"):
+            cur = run.conn.cursor()
+            cur.execute(consent_query)
+            for row in cur:
+                row_count += 1
+                add_declaration(cookies_dict, row, key_of)
+            cur.close()
+        metrics.add_rows("consent_scan", row_count)
 
     # some variables to collect violation details with
     violation_details = dict()
@@ -82,18 +245,27 @@ def main():
             if vdomain not in violation_details:
                 violation_details[vdomain] = list()
             violation_details[vdomain].append(cookie)
+            run.summaries.add_record(vdomain, cookie)
         total_domains.add(vdomain)
         total_entries += 1
-    conn.close()
+
+    # only the conflicting entries were retrieved, totals come from the database or the columnar export
+    total_sites = len(total_domains)
+    if totals is not None:
+        total_entries = totals["total_entries"]
+        total_sites = totals["total_sites"]
 
     logger.info(f"Total number of consent table entries: {total_entries}")
     logger.info(f"Number of declared cookies with multiple conflicting labels: {violation_count}")
-    logger.info(f"Number of sites with working CMP and declared cookies in total: {len(total_domains)}")
+    logger.info(f"Number of sites with working CMP and declared cookies in total: {total_sites}")
     logger.info(f"Number of sites that declare conflicting labels: {len(violation_domains)}")
 
     logger.info(f"Number of conflicting labels with necessary cookies: {num_necessary_viol}")
     logger.info(f"Number of sites that declare conflicting labels with necessary cookies: {len(set_nec_sites)}")
 
+    violation_details, violation_domains = run.merge(violation_details, violation_domains)
+    set_nec_sites = run.merge_domains(set_nec_sites, "method6_necessary_domains.txt")
+
     v_per_cmp = [0, 0, 0]
     for url, violating_cookies in violation_details.items():
         for c in violating_cookies:
@@ -102,15 +274,22 @@ def main():
 
     logger.info(f"Potential Violations per CMP Type: {v_per_cmp}")
 
-    if cargs["--out_path"]:
-        out_path = cargs["--out_path"]
-    else:
-        out_path = "./violation_stats/"
-    write_json(violation_details, "method6_cookies.json", out_path)
-    write_vdomains(violation_domains, "method6_domains.txt", out_path)
-    write_vdomains(set_nec_sites, "method6_necessary_domains.txt", out_path)
+    run.write(violation_details, violation_domains)
+    write_vdomains(set_nec_sites, "method6_necessary_domains.txt", run.out_path)
+    return run.finish(violation_domains, [violation_details],
+                      {"total_entries": total_entries, "total_sites": total_sites})
+
+
+def main():
+    """
+      Determine potential violations by checking if a website defines two differing labels for the same cookie.
+      @return: exit code, 0 for success
+    """
+    argv = None
+    cargs = docopt(__doc__, argv=argv)
 
-    return 0
+    return run_method(cargs, "method6_contradictory_labels", "Running method 06: Contradictory Labels",
+                      detect_contradictions, "method6_cookies.json", prepare=prepare_dimensions)
 
 
 if __name__ == '__main__':
@@ -8,15 +8,37 @@ Required arguments:
     <db_path>   Path to database to analyze.
 Optional arguments:
     --out_path <out_path>: Directory to store the resutls.
+    --metrics <metrics_path>: Write timings, row counts and peak memory of the run to this JSON file.
+    --top <k>: Write the k cookies (by name and canonical domain) with the most violations across sites
+               to method7_top_cookies.json, counted with a heavy-hitter sketch of bounded memory.
+    --verify_top: Count the violations of the top cookies exactly, in a second pass over the violations.
+    --matched <matched_path>: Load the matched cookies written by extract_matched_cookies.py (JSON or snapshot)
+                              instead of extracting them.
+    --incremental: Only analyze the visits added since the last incremental run, and merge them into the outputs.
+    --site <site_url>: Only analyze the visits of this site, e.g. to re-check it after a fix.
+    --sample <fraction>: Only analyze a reproducible sample of this fraction of the visits of each CMP type,
+                         and estimate the share of sites with violations in the whole crawl.
+    --seed <seed>: Seed of the sample, the same seed draws the same visits (default: 0).
+    --columns <columns_path>: Run the vectorized backend over this columnar export of the database (see crawl_columns.py).
+    --memory_budget <mb>: Memory available for grouping the cookies, in megabytes. Larger crawls are grouped
+                          in partitions on disk (default: 4096).
+    --duckdb: Run the queries in DuckDB, which attaches the database read-only (requires the duckdb package).
+    --create_indexes: Add the indexes of single-site runs to the database if they are missing, which speeds up
+                      these runs, but modifies the database file.
 Usage:
-    method7_implicit_consent.py <db_path> [--out_path <out_path>]
+    method7_implicit_consent.py <db_path> [--out_path <out_path>] [--metrics <metrics_path>] [--top <k> [--verify_top]]
+                                [--matched <matched_path>] [--memory_budget <mb>]
+                                [--incremental | --site <site_url> | --sample <fraction> | --columns <columns_path> | --duckdb] [--seed <seed>] [--create_indexes]
 """
 import os
-import sqlite3
+import time
 
 from docopt import docopt
 import logging
-from utils import (setupLogger, write_json, write_vdomains, retrieve_matched_cookies_from_DB)
+from utils import metrics
+from method_run import MethodRun, run_method
+
+logger = logging.getLogger("vd")
 
 
 CONSENTCOOKIE_ALL = '''SELECT DISTINCT site_url
@@ -31,42 +53,26 @@ JOIN site_visits s on s.visit_id == j.visit_id
 JOIN consent_crawl_results cs on j.visit_id == cs.visit_id and cs.crawl_state == 0
 WHERE j.name == "CookieConsent" and j.value like "%necessary:true%"'''
 
-def main():
+def detect_implicit_consent(run: MethodRun) -> int:
     """
-    Potential violation through implicit consent.
+    Classify the cookies set without consent, on all sites and on the sites using Cookiebot.
+    @param run: Run of the method, see method_run.py
     @return: exit code, 0 for success
     """
-    argv = None
-    cargs = docopt(__doc__, argv=argv)
-
-    logger = setupLogger(".", logging.INFO)
-
-    logger.info("Running method 07: Implicit Consent")
-
-    # Verify that database exists
-    database_path = cargs["<db_path>"]
-    if not os.path.exists(database_path):
-        logger.error("Database file does not exist.")
-        return 1
-
-    logger.info(f"Database used: {database_path}")
-
     total_cookies = 0
     total_domains = set()
 
-    # enable dictionary access by column name, access database
-    conn = sqlite3.connect(database_path)
-    conn.row_factory = sqlite3.Row
-
     logger.info("Extracting info from database...")
-    cookies_dict, _ = retrieve_matched_cookies_from_DB(conn)
+    matched, cookies_dict = run.matched_cookies()
+    if matched is None and cookies_dict is None:
+        return 1
     logger.info("--------------------------------------")
     logger.info("--------------------------------------")
 
     cookieconsent_domains = set()
 
-    with conn:
-        cur = conn.cursor()
+    with run.conn, metrics.stage("consent_cookie_query"):
+        cur = run.conn.cursor()
 
         cur.execute(CONSENTCOOKIE_ALL)
         for row in cur:
@@ -92,29 +98,43 @@ def main():
     inconsistency_counts = [0, 0, 0, 0, 0, 0, 0]
     inconsistency_details = [{}, {}, {}, {}, {}, {}, {}]
 
-    for key, val in cookies_dict.items():
-        total_cookies += 1
-        total_domains.add(val["site_url"])
+    # any cookie other than "necessary" counts as a violation, as in violation_stats.py
+    check_start = time.perf_counter()
+    if matched is not None:
+        # the site sets still come from the queries above, the export does not contain deleted cookie records
+        inconsistency_details, inconsistency_counts, inconsistency_domains, total_cookies, total_domains = \
+            matched.split_by_label()
+        cookiebot_inconsistency_details, cookiebot_inconsistency_counts, cookiebot_inconsistency_domains, _, _ = \
+            matched.split_by_label(cookieconsent_domains)
+        for details in inconsistency_details[1:]:
+            run.summaries.add_details(details)
+    else:
+        for key, val in cookies_dict.items():
+            total_cookies += 1
+            total_domains.add(val["site_url"])
 
-        vdomain = val["site_url"]
+            vdomain = val["site_url"]
 
-        inconsistency_domains[val["label"]].add(vdomain)
-        inconsistency_counts[val["label"]] += 1
+            inconsistency_domains[val["label"]].add(vdomain)
+            inconsistency_counts[val["label"]] += 1
 
-        if vdomain not in inconsistency_details[val["label"]]:
-            inconsistency_details[val["label"]][vdomain] = list()
+            if vdomain not in inconsistency_details[val["label"]]:
+                inconsistency_details[val["label"]][vdomain] = list()
 
-        inconsistency_details[val["label"]][vdomain].append({**val})
+            inconsistency_details[val["label"]][vdomain].append({**val})
+            if val["label"] != 0:
+                run.summaries.add_record(vdomain, val)
 
-        if vdomain in cookieconsent_domains:
-            cookiebot_inconsistency_domains[val["label"]].add(vdomain)
-            cookiebot_inconsistency_counts[val["label"]] += 1
-            if vdomain not in cookiebot_inconsistency_details[val["label"]]:
-                cookiebot_inconsistency_details[val["label"]][vdomain] = list()
+            if vdomain in cookieconsent_domains:
+                cookiebot_inconsistency_domains[val["label"]].add(vdomain)
+                cookiebot_inconsistency_counts[val["label"]] += 1
+                if vdomain not in cookiebot_inconsistency_details[val["label"]]:
+                    cookiebot_inconsistency_details[val["label"]][vdomain] = list()
 
-            cookiebot_inconsistency_details[val["label"]][vdomain].append({**val})
+                cookiebot_inconsistency_details[val["label"]][vdomain].append({**val})
 
-    conn.close()
+    metrics.add_time("classification", check_start)
+    metrics.add_rows("classification", len(matched) if matched is not None else len(cookies_dict))
 
     logger.info(f"Number of cookies: {total_cookies}")
     logger.info(f"Total number of domains: {len(total_domains)}")
@@ -123,15 +143,13 @@ def main():
     logger.info(f"Sum of functional, analytics and advertising: {sum(inconsistency_counts[1:4])}")
     logger.info(f"Sum of functional, analytics and advertising (cookiebot): {sum(cookiebot_inconsistency_counts[1:])}")
 
-    if cargs["--out_path"]:
-        out_path = cargs["--out_path"] + "method7/"
-    else:
-        out_path = "./violation_stats/method7/"
-
-    os.makedirs(out_path, exist_ok=True)
+    os.makedirs(run.out_path, exist_ok=True)
 
     for i in range(0, len(inconsistency_domains)):
         logger.info("-------------------------------------------------------------")
+        # the summaries count the categories other than "necessary"
+        inconsistency_details[i], inconsistency_domains[i] = run.merge(
+            inconsistency_details[i], inconsistency_domains[i], inconsistency_names[i], summarize=i > 0)
 
         logger.info(f"Total number of domains that created a cookie of label: '{inconsistency_names[i]}': {len(inconsistency_domains[i])}")
         logger.info(f"Total number of cookiebot domains that created a cookie of label: '{inconsistency_names[i]}': {len(cookiebot_inconsistency_domains[i])}")
@@ -144,10 +162,23 @@ def main():
 
         logger.info(f"Cookies per CMP Type: {v_per_cmp}")
 
-        write_json(inconsistency_details[i], f"method7_cookies_{inconsistency_names[i]}.json", out_path)
-        write_vdomains(inconsistency_domains[i], f"method7_domains_{inconsistency_names[i]}.txt", out_path)
+        run.write(inconsistency_details[i], inconsistency_domains[i], inconsistency_names[i])
     logger.info("-------------------------------------------------------------")
-    return 0
+    # sites that set any cookie other than "necessary", as counted by violation_stats.py
+    return run.finish(set().union(*inconsistency_domains[1:]), inconsistency_details[1:],
+                      {"total_cookies": total_cookies, "total_sites": len(total_domains)})
+
+
+def main():
+    """
+    Potential violation through implicit consent.
+    @return: exit code, 0 for success
+    """
+    argv = None
+    cargs = docopt(__doc__, argv=argv)
+
+    return run_method(cargs, "method7_implicit_consent", "Running method 07: Implicit Consent", detect_implicit_consent,
+                      "method7_cookies_necessary.json", subdir="method7/", log_level=logging.INFO)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,613 @@
+# Copyright (C) 2021-2022 Dino Bollinger, ETH Zürich, Information Security Group
+# Released under the MIT License
+"""
+Contains the run setup that is shared between the detection methods: the incremental state, the restriction
+to a single site or to a sample of the visits, the summaries of the violations, and the merge of the outputs
+with those of earlier incremental runs.
+"""
+from statistics import NormalDist
+from typing import Dict, Set, List, Tuple, Any, Union, Optional, Mapping, Callable
+import sqlite3
+import json
+import os
+import logging
+
+from utils import (setupLogger, ensure_index, canonical_domain, write_json, write_vdomains, write_distributions,
+                   load_violations, load_matched_cookies, retrieve_matched_cookies_from_DB, metrics)
+from sketches import hash64, SpaceSaving, NumericSummary
+from columnar_backend import load_columns, MatchedColumns
+from duckdb_engine import open_database
+
+logger = logging.getLogger("vd")
+
+INCREMENTAL_STATE_FILE = "incremental_state.sqlite"
+
+INCREMENTAL_STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS watermarks (
+    method TEXT PRIMARY KEY,
+    visit_id INTEGER,
+    parameters TEXT,
+    summary TEXT,
+    output_stat TEXT
+);
+CREATE TABLE IF NOT EXISTS analyzed_sites (
+    method TEXT NOT NULL,
+    site_url TEXT NOT NULL,
+    PRIMARY KEY (method, site_url)
+) WITHOUT ROWID;
+"""
+
+# Confidence level of the intervals reported for the violation rates of a sample
+SAMPLE_CONFIDENCE = 0.95
+
+# Draws the sample: within each CMP type, the visits with the lowest hash of seed and visit_id are taken,
+# as many as the fraction of the visits of that CMP type (rounded up). The size of each stratum is kept along.
+SAMPLE_VISITS_QUERY = """
+CREATE TEMP TABLE sample_visits AS
+SELECT visit_id, site_url, cmp_type, stratum_size FROM (
+    SELECT s.visit_id, s.site_url, ccr.cmp_type,
+           ROW_NUMBER() OVER (PARTITION BY ccr.cmp_type ORDER BY vd_sample_key(?, s.visit_id), s.visit_id) as sample_rank,
+           COUNT(*) OVER (PARTITION BY ccr.cmp_type) as stratum_size
+    FROM main.site_visits s
+    JOIN consent_crawl_results ccr ON ccr.visit_id == s.visit_id
+)
+WHERE sample_rank - 1 < stratum_size * ?
+"""
+
+# Counters kept by the heavy-hitter sketch of the top violating cookies, per cookie reported, and at least
+TOP_COOKIES_CAPACITY_FACTOR = 10
+TOP_COOKIES_MIN_CAPACITY = 4096
+
+
+class IncrementalState:
+    """
+    State of the incremental analysis of one method, stored in a SQLite database in its output directory.
+    Records the highest visit_id analyzed so far (the high-watermark), the sites analyzed, the parameters
+    of the analysis and cumulative summary counts.
+    A run analyzes the sites with visits after the watermark, over all their visits up to the new watermark,
+    such that a site crawled again is analyzed as a whole once more. Its results are then merged into the
+    existing outputs, replacing those of the earlier runs for the sites analyzed again.
+    """
+
+    def __init__(self, method: str, out_path: str, output_file: str, parameters: Dict[str, Any] = None):
+        """
+        @param method: Name of the method, each method keeps its own state
+        @param out_path: Output directory of the method, also holds the state database
+        @param output_file: Main output file. If it was replaced by another run, the analysis starts over.
+        @param parameters: Parameters of the analysis, which need to stay the same across incremental runs
+        """
+        self.method = method
+        self.output_file = os.path.join(out_path, output_file)
+        self.parameters = json.loads(json.dumps(parameters or {}))
+        self.path = os.path.join(out_path, INCREMENTAL_STATE_FILE)
+        self.watermark = None
+        self.new_watermark = None
+        self.new_sites: Set[str] = set()
+        self.summary: Dict[str, int] = dict()
+
+        os.makedirs(out_path, exist_ok=True)
+        self.conn = sqlite3.connect(self.path, timeout=60)
+        with self.conn:
+            self.conn.executescript(INCREMENTAL_STATE_SCHEMA)
+
+    def _output_stat(self) -> Union[str, None]:
+        if not os.path.exists(self.output_file):
+            return None
+        st = os.stat(self.output_file)
+        return f"{st.st_size}:{st.st_mtime_ns}"
+
+    @property
+    def has_previous_run(self) -> bool:
+        """ Whether earlier runs are recorded, in which case the new results are merged into their outputs. """
+        return self.watermark is not None
+
+    def clear(self) -> None:
+        """ Forget all earlier runs of the method. """
+        with self.conn:
+            self.conn.execute("DELETE FROM watermarks WHERE method == ?", (self.method,))
+            self.conn.execute("DELETE FROM analyzed_sites WHERE method == ?", (self.method,))
+        self.watermark = None
+        self.summary = dict()
+
+    def begin(self, conn: sqlite3.Connection) -> bool:
+        """
+        Restrict the crawl database connection to the sites with new visits. The site_visits table is shadowed by a
+        temporary view of the same name, such that all queries joining site_visits only see the visits of these sites.
+        The complete table remains accessible as main.site_visits.
+        @param conn: Connection to the crawl database
+        @return: False if the parameters differ from those of the earlier runs
+        """
+        row = self.conn.execute("SELECT visit_id, parameters, summary, output_stat FROM watermarks WHERE method == ?",
+                                (self.method,)).fetchone()
+        if row is not None:
+            if row[3] != self._output_stat():
+                logger.warning(f"'{self.output_file}' changed since the last incremental run, analyzing all visits.")
+                self.clear()
+            elif json.loads(row[1]) != self.parameters:
+                logger.error(f"Parameters {self.parameters} differ from those of the earlier incremental runs: {row[1]}")
+                logger.error("Use a new output directory to analyze the crawl with different parameters.")
+                return False
+            else:
+                self.watermark = row[0]
+                self.summary = json.loads(row[2])
+
+        lower = self.watermark if self.watermark is not None else -1
+        max_visit = conn.execute("SELECT MAX(visit_id) FROM main.site_visits").fetchone()[0]
+        self.new_watermark = max_visit if max_visit is not None else lower
+
+        # visits added while the analysis is running are left for the next run
+        conn.execute("ATTACH DATABASE ? AS incremental_state", (self.path,))
+        conn.execute(f"""CREATE TEMP VIEW site_visits AS
+            SELECT * FROM main.site_visits
+            WHERE visit_id <= {int(self.new_watermark)}
+              AND site_url IN (SELECT site_url FROM main.site_visits
+                               WHERE visit_id > {int(lower)} AND visit_id <= {int(self.new_watermark)})""")
+        self.new_sites = set(r[0] for r in conn.execute("SELECT DISTINCT site_url FROM temp.site_visits"))
+        reanalyzed = conn.execute("SELECT COUNT(*) FROM incremental_state.analyzed_sites WHERE method == ? AND "
+                                  "site_url IN (SELECT site_url FROM temp.site_visits)", (self.method,)).fetchone()[0]
+        logger.info(f"Incremental run: {len(self.new_sites)} sites with visits after visit_id {self.watermark}, "
+                    f"up to visit_id {self.new_watermark}, of which {reanalyzed} are analyzed again")
+        return True
+
+    def new_visit_ids(self, conn: sqlite3.Connection) -> Set[int]:
+        """ Visit IDs of the visits analyzed by this run, to filter data that was not retrieved through site_visits. """
+        return set(r[0] for r in conn.execute("SELECT visit_id FROM temp.site_visits"))
+
+    def commit(self, counts: Dict[str, int]) -> Dict[str, int]:
+        """
+        Record the new visits as analyzed, once the merged outputs have been written.
+        @param counts: Summary counts of this run, added to those of the earlier runs
+        @return: Summary counts over all incremental runs
+        """
+        for k, v in counts.items():
+            self.summary[k] = self.summary.get(k, 0) + v
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO analyzed_sites VALUES (?, ?)",
+                                  ((self.method, site) for site in self.new_sites))
+            self.conn.execute("INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?, ?, ?)",
+                              (self.method, self.new_watermark, json.dumps(self.parameters),
+                               json.dumps(self.summary), self._output_stat()))
+        self.conn.close()
+        logger.info(f"Totals over all incremental runs: {self.summary}")
+        return self.summary
+
+
+def restrict_to_site(conn: sqlite3.Connection, site_url: str, create_indexes: bool = False) -> int:
+    """
+    Restrict the crawl database connection to the visits of a single site. Like the incremental state, the
+    site_visits table is shadowed by a temporary view, such that all queries joining site_visits only see
+    the visits of the site. With the indexes on site_url and visit_id, this only reads the rows of the site.
+    @param conn: Connection to the crawl database
+    @param site_url: Site to analyze, as stored in site_visits
+    @param create_indexes: Whether to add missing indexes to the database, see ensure_index
+    @return: number of visits of the site, 0 if the site is not part of the crawl
+    """
+    ensure_index(conn, "site_visits_site_url_idx", "site_visits", ["site_url"], create_indexes)
+    for table in ("consent_data", "javascript_cookies", "consent_crawl_results"):
+        ensure_index(conn, f"{table}_visit_id_idx", table, ["visit_id"], create_indexes)
+
+    site_literal = site_url.replace("'", "''")
+    conn.execute("DROP VIEW IF EXISTS temp.site_visits")
+    conn.execute(f"CREATE TEMP VIEW site_visits AS SELECT * FROM main.site_visits WHERE site_url == '{site_literal}'")
+    num_visits = conn.execute("SELECT COUNT(*) FROM temp.site_visits").fetchone()[0]
+    if num_visits == 0:
+        logger.error(f"Site '{site_url}' is not part of the crawl.")
+    else:
+        logger.info(f"Only analyzing the {num_visits} visits of site '{site_url}'")
+    return num_visits
+
+
+class StratifiedSample:
+    """
+    Reproducible sample of the visits of a crawl, stratified by CMP type, to preview the results of a method
+    in a fraction of the time. Like restrict_to_site, the site_visits table is shadowed by a temporary view,
+    such that the methods run unchanged on the sampled visits. From the sites found with violations,
+    the share of sites with violations in the whole crawl is then estimated, with a confidence interval.
+    """
+
+    def __init__(self, fraction: Union[str, float], seed: Union[str, int, None] = None):
+        """
+        @param fraction: fraction of the visits of each CMP type to sample, in (0, 1]
+        @param seed: seed of the sample, the same seed draws the same visits
+        """
+        self.fraction = float(fraction)
+        self.seed = int(seed) if seed is not None else 0
+        self.visit_ids: Set[int] = set()
+        # CMP type -> sites of the crawl, and sampled sites
+        self.strata: Dict[int, Tuple[int, Set[str]]] = dict()
+
+    def draw(self, conn: sqlite3.Connection) -> int:
+        """
+        Draw the sample and restrict the crawl database connection to it.
+        @param conn: Connection to the crawl database
+        @return: number of visits sampled, 0 if the fraction is invalid or the crawl is empty
+        """
+        if not 0 < self.fraction <= 1:
+            logger.error(f"The sample fraction needs to be within (0, 1], got {self.fraction}.")
+            return 0
+        conn.create_function("vd_sample_key", 2, lambda seed, visit_id: hash64(f"{seed}:{visit_id}") >> 1,
+                             deterministic=True)
+        conn.execute("DROP TABLE IF EXISTS temp.sample_visits")
+        conn.execute(SAMPLE_VISITS_QUERY, (self.seed, self.fraction))
+        conn.execute("DROP VIEW IF EXISTS temp.site_visits")
+        conn.execute("CREATE TEMP VIEW site_visits AS SELECT * FROM main.site_visits "
+                     "WHERE visit_id IN (SELECT visit_id FROM temp.sample_visits)")
+
+        sampled: Dict[int, Set[str]] = dict()
+        stratum_sites: Dict[int, int] = dict()
+        for row in conn.execute("SELECT visit_id, site_url, cmp_type FROM temp.sample_visits"):
+            self.visit_ids.add(row[0])
+            sampled.setdefault(row[2], set()).add(row[1])
+        for cmp_type, num_sites in conn.execute("SELECT ccr.cmp_type, COUNT(DISTINCT s.site_url) "
+                                                "FROM main.site_visits s JOIN consent_crawl_results ccr "
+                                                "ON ccr.visit_id == s.visit_id GROUP BY ccr.cmp_type"):
+            stratum_sites[cmp_type] = num_sites
+        self.strata = {cmp_type: (stratum_sites[cmp_type], sites) for cmp_type, sites in sampled.items()}
+
+        if not self.visit_ids:
+            logger.error("The crawl contains no visits to sample.")
+        else:
+            logger.info(f"Only analyzing a sample of {len(self.visit_ids)} visits ({self.fraction:.1%} per CMP type, "
+                        f"seed {self.seed}), strata: { {k: len(v[1]) for k, v in sorted(self.strata.items())} }")
+        return len(self.visit_ids)
+
+    def estimate(self, violation_domains: Set[str]) -> Dict[str, Any]:
+        """
+        Estimate the share of sites with violations in the whole crawl, from the sites of the sample.
+        Each CMP type is weighted by its share of the sites of the crawl, the interval is the normal approximation
+        of the stratified estimate, with the finite population correction.
+        @param violation_domains: sites of the sample that were found with violations
+        @return: estimated rate, confidence interval and the counts of each stratum
+        """
+        total_sites = sum(num_sites for num_sites, _ in self.strata.values())
+        rate = 0.0
+        variance = 0.0
+        per_stratum = dict()
+        for cmp_type, (num_sites, sites) in sorted(self.strata.items()):
+            n = len(sites)
+            violations = len(sites & violation_domains)
+            p = violations / n
+            weight = num_sites / total_sites
+            rate += weight * p
+            if n > 1:
+                variance += weight ** 2 * (1 - n / num_sites) * p * (1 - p) / (n - 1)
+            per_stratum[cmp_type] = {"sites": num_sites, "sampled": n, "violations": violations, "rate": p}
+
+        z = NormalDist().inv_cdf((1 + SAMPLE_CONFIDENCE) / 2)
+        margin = z * variance ** 0.5
+        return {"fraction": self.fraction, "seed": self.seed, "confidence": SAMPLE_CONFIDENCE,
+                "total_sites": total_sites, "sampled_sites": sum(len(s) for _, s in self.strata.values()),
+                "rate": rate, "rate_low": max(0.0, rate - margin), "rate_high": min(1.0, rate + margin),
+                "estimated_sites": round(rate * total_sites), "strata": per_stratum}
+
+    def report(self, violation_domains: Set[str], file_name: str, out_path: str) -> Dict[str, Any]:
+        """
+        Log the estimated violation rate, and write it to the output directory.
+        @param violation_domains: sites of the sample that were found with violations
+        @param file_name: name of the estimate file, e.g. "method4_estimate.json"
+        @param out_path: output directory of the method
+        @return: the estimate
+        """
+        est = self.estimate(violation_domains)
+        logger.info(f"Estimated share of sites with violations: {est['rate']:.2%} "
+                    f"({est['confidence']:.0%} CI: {est['rate_low']:.2%} - {est['rate_high']:.2%}), "
+                    f"about {est['estimated_sites']} of {est['total_sites']} sites")
+        write_json(est, file_name, out_path)
+        return est
+
+
+class ViolationSummaries:
+    """
+    Summaries of the violations of a method, updated by the detection loop as each violation is found, such that
+    the top cookies and distributions need no second pass over the violations:
+    a Space-Saving sketch of the cookies with the most violations, by name and canonical domain, which keeps a fixed
+    number of counters however many distinct cookies there are, the number of violations per site with violations,
+    and the distributions of record fields, like the expiry_ratio of method 3, in mergeable summaries.
+    """
+
+    def __init__(self, top_k: int = 0, fields: Tuple[str, ...] = ()):
+        """
+        @param top_k: number of top cookies to report, 0 to not count them
+        @param fields: numeric fields of the violation records to summarize, zero and missing values are skipped
+        """
+        self.top_k = top_k
+        self.top = SpaceSaving(max(top_k * TOP_COOKIES_CAPACITY_FACTOR, TOP_COOKIES_MIN_CAPACITY)) if top_k else None
+        self.fields = fields
+        self.site_counts: Dict[str, int] = dict()
+        self.distributions: Dict[str, NumericSummary] = {field: NumericSummary() for field in fields}
+
+    def add(self, site: str, name: Optional[str], domain: Optional[str]) -> None:
+        """ Register a violation of the cookie with the given name and domain on a site. """
+        self.site_counts[site] = self.site_counts.get(site, 0) + 1
+        if self.top is not None:
+            self.top.add((name or "", canonical_domain(domain or "")))
+
+    def add_record(self, site: str, record: Mapping[str, Any]) -> None:
+        """ Register a violation given by its record in the output, as written to the JSON file. """
+        self.add(site, record["name"], record["domain"])
+        for field in self.fields:
+            if record.get(field):
+                self.distributions[field].add(record[field])
+
+    def add_details(self, violation_details: Dict[str, List[Dict[str, Any]]]) -> None:
+        """ Register the violations of a whole batch, e.g. of the vectorized backend or of an earlier run. """
+        for site, records in violation_details.items():
+            for record in records:
+                self.add_record(site, record)
+
+    def write(self, method: str, output_path: str,
+              verify_details: Optional[List[Dict[str, List[Dict[str, Any]]]]] = None) -> None:
+        """
+        Write the distributions to <method>_distributions.json, and the top cookies to <method>_top_cookies.json.
+        @param method: prefix of the output files, e.g. "method4"
+        @param output_path: directory of the outputs
+        @param verify_details: violations per site to count the top cookies exactly in, None to report the estimates
+        """
+        # in site order, such that the summary does not depend on the order the engine found the violations in
+        per_site = NumericSummary()
+        for site in sorted(self.site_counts):
+            per_site.add(self.site_counts[site])
+        write_distributions({"violations_per_site": per_site, **self.distributions},
+                            f"{method}_distributions.json", output_path)
+        if self.top is not None:
+            write_top_cookies(self.top, self.top_k, f"{method}_top_cookies.json", output_path, verify_details)
+
+
+def write_top_cookies(sketch: SpaceSaving, k: int, filename: str, output_path: str = "./violation_stats/",
+                      verify_details: Optional[List[Dict[str, List[Dict[str, Any]]]]] = None) -> List[Dict[str, Any]]:
+    """
+    Write the cookies, by name and canonical domain, with the most violations across sites.
+    The counts of the sketch are upper bounds, off by at most the given error.
+    @param sketch: violations counted by cookie during the detection
+    @param k: number of cookies to report
+    @param filename: File to write the top cookies to.
+    @param output_path: Directory of the file.
+    @param verify_details: violations per site, e.g. one dictionary per category, to count the violations
+                           of the k candidates exactly in, in a second pass over the violations
+    @return: the top cookies, by descending count
+    """
+    top = sketch.top(k)
+    if verify_details is not None:
+        exact = {ident: 0 for ident, _, _ in top}
+        for details in verify_details:
+            for cookies in details.values():
+                for c in cookies:
+                    ident = (c["name"] or "", canonical_domain(c["domain"] or ""))
+                    if ident in exact:
+                        exact[ident] += 1
+        top = sorted(((ident, count, 0) for ident, count in exact.items()), key=lambda t: -t[1])
+
+    top_cookies = [{"name": name, "domain": domain, "count": count, "error": error}
+                   for (name, domain), count, error in top]
+    logger.info(f"Top {len(top_cookies)} cookies by number of violations "
+                f"({'exact' if verify_details is not None else 'estimated'} counts out of {len(sketch)}):")
+    for c in top_cookies[:10]:
+        logger.info(f"{c['name']};{c['domain']}: {c['count']}" + (f" (-{c['error']})" if c["error"] else ""))
+    write_json(top_cookies, filename, output_path)
+    return top_cookies
+
+
+def merge_violations(violation_details: Dict[str, List], filename: str, output_path: str = "./violation_stats/",
+                     summaries: Optional[ViolationSummaries] = None,
+                     replaced_sites: Set[str] = frozenset()) -> Dict[str, List]:
+    """
+    Merge newly found violations into those written by an earlier run.
+    @param violation_details: New violations per site.
+    @param filename: Output file of the earlier run.
+    @param summaries: Summaries of the new violations, the violations of the earlier run are added to them.
+    @param replaced_sites: Sites analyzed again, whose violations of the earlier run are dropped.
+    @return: Combined violations per site
+    """
+    merged = {site: violations for site, violations in load_violations(filename, output_path).items()
+              if site not in replaced_sites}
+    if summaries is not None:
+        summaries.add_details(merged)
+    for site, violations in violation_details.items():
+        merged.setdefault(site, []).extend(violations)
+    return merged
+
+
+def merge_vdomains(vdomains: Set, fn: str, output_path: str = "./violation_stats/",
+                   replaced_sites: Set[str] = frozenset()) -> Set:
+    """
+    Merge newly found offending domains into the list written by an earlier run.
+    @param vdomains: New offending domains.
+    @param fn: Filename of the earlier list.
+    @param replaced_sites: Sites analyzed again, which are dropped from the earlier list.
+    @return: Combined offending domains
+    """
+    path = output_path + fn
+    merged = set(vdomains)
+    if os.path.exists(path):
+        with open(path, 'r') as fd:
+            merged.update(line.strip() for line in fd if line.strip() and line.strip() not in replaced_sites)
+    return merged
+
+
+def remove_stale_output(filename: str, output_path: str = "./violation_stats/") -> None:
+    """
+    Remove an output file that the current run does not produce, such as the estimate of an earlier sampled run,
+    which would otherwise be read together with the outputs of this run.
+    @param filename: File to remove, if it exists.
+    @param output_path: Directory of the outputs.
+    """
+    stale_file = os.path.join(output_path, filename)
+    if os.path.exists(stale_file):
+        os.remove(stale_file)
+        logger.info(f"Removed the output of an earlier run: '{stale_file}'")
+
+
+class MethodRun:
+    """
+    One run of a detection method, as set up by run_method: the connection to the crawl database, restricted to
+    the visits to analyze, the output directory, and the incremental state, sample and summaries of the run.
+    The detection reads the visits through the connection, and writes its outputs with merge, write and finish,
+    which combine them with the outputs of the earlier incremental runs.
+    """
+
+    def __init__(self, cargs: Dict[str, Any], method: str, database_path: str, conn: Any, out_path: str,
+                 summaries: ViolationSummaries):
+        """
+        @param cargs: Command line arguments of the method
+        @param method: Name of the method, e.g. "method4_unclassified_cookies"
+        @param database_path: Path to the crawl database
+        @param conn: Connection to the crawl database
+        @param out_path: Output directory of the method
+        @param summaries: Summaries of the violations, updated by the detection
+        """
+        self.cargs = cargs
+        self.method = method
+        self.prefix = method.split("_")[0]
+        self.database_path = database_path
+        self.conn = conn
+        self.out_path = out_path
+        self.summaries = summaries
+        self.state: Optional[IncrementalState] = None
+        self.sample: Optional[StratifiedSample] = None
+
+    def load_columns(self) -> Optional[Dict[str, Any]]:
+        """ Columnar export given with --columns, see columnar_backend.load_columns """
+        return load_columns(self.cargs["--columns"], self.database_path)
+
+    def matched_cookies(self) -> Tuple[Optional[MatchedColumns], Optional[Dict[str, Dict[str, Any]]]]:
+        """
+        Matched cookies of the analyzed visits, from the columnar export, the file given with --matched,
+        or extracted from the crawl database.
+        @return: the matched columns of the export, or the matched cookies, both None if they could not be loaded
+        """
+        if self.cargs["--columns"] and self.cargs["--matched"]:
+            logger.error("The columnar backend extracts the matched cookies itself, --matched cannot be used with --columns.")
+            return None, None
+        if self.cargs["--columns"]:
+            crawl = self.load_columns()
+            if crawl is None:
+                return None, None
+            with metrics.stage("vectorized_extract"):
+                return MatchedColumns(crawl), None
+        if self.cargs["--matched"]:
+            # the file holds the cookies of all visits, the restriction of the connection does not apply to it
+            cookies_dict = load_matched_cookies(self.cargs["--matched"])
+            if self.state:
+                new_visits = self.state.new_visit_ids(self.conn)
+                cookies_dict = {k: v for k, v in cookies_dict.items() if v["visit_id"] in new_visits}
+            elif self.cargs["--site"]:
+                cookies_dict = {k: v for k, v in cookies_dict.items() if v["site_url"] == self.cargs["--site"]}
+            elif self.sample:
+                cookies_dict = {k: v for k, v in cookies_dict.items() if v["visit_id"] in self.sample.visit_ids}
+            return None, cookies_dict
+        cookies_dict, _ = retrieve_matched_cookies_from_DB(self.conn, memory_budget_mb=self.cargs["--memory_budget"])
+        return None, cookies_dict
+
+    def merge(self, violation_details: Dict[str, List], violation_domains: Set[str], category: str = "",
+              summarize: bool = True) -> Tuple[Dict[str, List], Set[str]]:
+        """
+        Merge the violations of this run into those of the earlier incremental runs, if there are any.
+        @param violation_details: Violations per site found by this run
+        @param violation_domains: Sites with violations found by this run
+        @param category: Category of the outputs, for methods that write one pair of outputs per category
+        @param summarize: Whether the violations of the earlier runs are added to the summaries
+        @return: Combined violations per site, and sites with violations
+        """
+        if not (self.state and self.state.has_previous_run):
+            return violation_details, violation_domains
+        suffix = f"_{category}" if category else ""
+        violation_details = merge_violations(violation_details, f"{self.prefix}_cookies{suffix}.json", self.out_path,
+                                             self.summaries if summarize else None, self.state.new_sites)
+        return violation_details, self.merge_domains(violation_domains, f"{self.prefix}_domains{suffix}.txt")
+
+    def merge_domains(self, domains: Set[str], filename: str) -> Set[str]:
+        """ Merge a list of sites into the list written by the earlier incremental runs, if there are any. """
+        if not (self.state and self.state.has_previous_run):
+            return domains
+        return merge_vdomains(domains, filename, self.out_path, self.state.new_sites)
+
+    def write(self, violation_details: Dict[str, List], violation_domains: Set[str], category: str = "") -> None:
+        """ Write the violations per site and the sites with violations, see merge for the category. """
+        suffix = f"_{category}" if category else ""
+        write_json(violation_details, f"{self.prefix}_cookies{suffix}.json", self.out_path)
+        write_vdomains(violation_domains, f"{self.prefix}_domains{suffix}.txt", self.out_path)
+
+    def finish(self, violation_domains: Set[str], verify_details: List[Dict[str, List]],
+               counts: Dict[str, int]) -> int:
+        """
+        Write the estimate of a sample and the summaries of the violations, once the outputs are written,
+        and record the analyzed visits in the incremental state.
+        @param violation_domains: Sites with violations, to estimate the share of sites with violations from
+        @param verify_details: Violations per site, to count the top cookies exactly in if --verify_top is given
+        @param counts: Summary counts of this run, e.g. the number of cookies and sites analyzed
+        @return: exit code, 0 for success
+        """
+        if self.sample:
+            self.sample.report(violation_domains, f"{self.prefix}_estimate.json", self.out_path)
+        else:
+            remove_stale_output(f"{self.prefix}_estimate.json", self.out_path)
+        self.summaries.write(self.prefix, self.out_path, verify_details if self.cargs["--verify_top"] else None)
+        if self.state:
+            self.state.commit(counts)
+        return 0
+
+
+def run_method(cargs: Dict[str, Any], method: str, title: str, detect: Callable[[MethodRun], int],
+               main_output: str, parameters: Optional[Dict[str, Any]] = None,
+               prepare: Optional[Callable[[MethodRun], bool]] = None, subdir: str = "",
+               fields: Tuple[str, ...] = (), log_level: int = logging.DEBUG) -> int:
+    """
+    Set up a run of a detection method from its command line arguments, and run the detection:
+    open the crawl database, and restrict it to the visits after the last incremental run, to the visits
+    of a single site, or to a sample of the visits, as requested.
+    @param cargs: Command line arguments of the method
+    @param method: Name of the method, e.g. "method4_unclassified_cookies"
+    @param title: Logged at the start of the run
+    @param detect: Detection of the method, returns the exit code
+    @param main_output: Main output file, see IncrementalState
+    @param parameters: Parameters of the analysis, see IncrementalState
+    @param prepare: Called before the visits are restricted, e.g. to attach tables to the connection.
+                    Returns False if the run cannot proceed.
+    @param subdir: Subdirectory of the output directory for the outputs of the method
+    @param fields: Numeric fields of the violation records to summarize, see ViolationSummaries
+    @param log_level: Level of the logger
+    @return: exit code, 0 for success
+    """
+    setupLogger(".", log_level)
+    if cargs["--metrics"]:
+        metrics.enable(method)
+
+    logger.info(title)
+
+    database_path = cargs["<db_path>"]
+    if not os.path.exists(database_path):
+        logger.error("Database file does not exist.")
+        return 1
+
+    logger.info(f"Database used: {database_path}")
+
+    # enable dictionary access by column name
+    conn = open_database(database_path, cargs.get("--duckdb"))
+    if conn is None:
+        return 1
+
+    out_path = (cargs["--out_path"] or "./violation_stats/") + subdir
+    summaries = ViolationSummaries(int(cargs["--top"]) if cargs["--top"] else 0, fields)
+    run = MethodRun(cargs, method, database_path, conn, out_path, summaries)
+
+    if cargs["--incremental"]:
+        run.state = IncrementalState(method, out_path, main_output, parameters)
+        if not run.state.begin(conn):
+            return 1
+
+    if prepare is not None and not prepare(run):
+        return 1
+
+    if cargs["--site"] and not restrict_to_site(conn, cargs["--site"], cargs["--create_indexes"]):
+        return 1
+
+    if cargs["--sample"]:
+        run.sample = StratifiedSample(cargs["--sample"], cargs["--seed"])
+        if not run.sample.draw(conn):
+            return 1
+
+    exit_code = detect(run)
+    conn.close()
+    if exit_code == 0:
+        metrics.write(cargs["--metrics"])
+    return exit_code
@@ -0,0 +1,165 @@
+# Copyright (C) 2021-2022 Dino Bollinger, ETH Zürich, Information Security Group
+# Released under the MIT License
+"""
+Out-of-core grouping by key, for crawls whose keys do not all fit into memory at once.
+Records are hash-partitioned by their key into bucket files on disk, and the buckets are then read back one at a
+time, such that only the groups of a single bucket are held in memory. All records of a key end up in the same
+bucket, in the order they were added. Each record is numbered when it is added, such that results computed bucket
+by bucket can be put back into the order of a single pass over all records, e.g. with merge_runs.
+The bucket files are written to a temporary directory (see the TMPDIR environment variable), which is removed
+when the partitions are closed.
+"""
+
+import heapq
+import math
+import os
+import pickle
+import shutil
+import sqlite3
+import tempfile
+import logging
+
+from typing import Any, Hashable, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger("vd")
+
+# Memory available for grouping, in megabytes, unless given with "--memory_budget"
+DEFAULT_MEMORY_BUDGET_MB = 4096.0
+
+# Buckets are only filled up to this fraction of the budget, as keys are not spread evenly
+BUCKET_FILL_RATIO = 0.5
+
+# Records buffered per bucket before they are written out
+WRITE_BATCH_SIZE = 512
+
+
+def estimate_table_rows(conn: sqlite3.Connection, table: str) -> int:
+    """ Number of rows of a table, estimated from the largest row ID without scanning the table. """
+    try:
+        return conn.execute(f"SELECT MAX(rowid) FROM {table}").fetchone()[0] or 0
+    except sqlite3.OperationalError:
+        # engines without row IDs, see duckdb_engine.py
+        return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+def partitions_needed(num_records: int, bytes_per_record: float, memory_budget_mb: Optional[float]) -> int:
+    """
+    Number of buckets needed such that the groups of each bucket fit into the memory budget.
+    @param num_records: estimated number of records to group
+    @param bytes_per_record: memory the grouping takes per record
+    @param memory_budget_mb: memory available, DEFAULT_MEMORY_BUDGET_MB if None
+    @return: number of buckets, 1 if all records can be grouped in memory at once
+    """
+    budget_mb = DEFAULT_MEMORY_BUDGET_MB if memory_budget_mb is None else float(memory_budget_mb)
+    estimated_mb = num_records * bytes_per_record / (1024 * 1024)
+    if estimated_mb <= budget_mb:
+        return 1
+    num_partitions = math.ceil(estimated_mb / (budget_mb * BUCKET_FILL_RATIO))
+    logger.info(f"Estimated {estimated_mb:.0f} MB for {num_records} records exceed the memory budget of "
+                f"{budget_mb:.0f} MB, grouping in {num_partitions} partitions on disk.")
+    return num_partitions
+
+
+class HashPartitions:
+    """
+    Bucket files on disk, records are assigned to a bucket by the hash of their key.
+    Use as a context manager, such that the files are removed in any case.
+    """
+
+    def __init__(self, num_partitions: int, directory: Optional[str] = None):
+        """
+        @param num_partitions: number of buckets
+        @param directory: where to create the temporary directory of the buckets, the system default if None
+        """
+        self.num_partitions = num_partitions
+        self.directory = tempfile.mkdtemp(prefix="vd_partitions_", dir=directory)
+        self._buffers: List[List[Tuple[int, Hashable, Any]]] = [[] for _ in range(num_partitions)]
+        self._files = [open(self._path(i), 'wb') for i in range(num_partitions)]
+        self._count = 0
+        self._runs = 0
+
+    def _path(self, i: int) -> str:
+        return os.path.join(self.directory, f"bucket_{i}.pickle")
+
+    def __len__(self) -> int:
+        return self._count
+
+    def add(self, key: Hashable, record: Any) -> None:
+        """
+        Append a record to the bucket of its key. The record needs to be picklable.
+        @param key: key to group by, hashable and equal for all records of a group
+        @param record: the record itself
+        """
+        i = hash(key) % self.num_partitions
+        buffer = self._buffers[i]
+        buffer.append((self._count, key, record))
+        self._count += 1
+        if len(buffer) >= WRITE_BATCH_SIZE:
+            pickle.dump(buffer, self._files[i], pickle.HIGHEST_PROTOCOL)
+            buffer.clear()
+
+    def buckets(self) -> Iterator[Iterator[Tuple[int, Hashable, Any]]]:
+        """
+        Read the buckets back one at a time, after all records were added.
+        Each bucket is removed from disk once it was read.
+        @return: for each bucket, its (sequence number, key, record) triples in the order they were added
+        """
+        for i, fd in enumerate(self._files):
+            if self._buffers[i]:
+                pickle.dump(self._buffers[i], fd, pickle.HIGHEST_PROTOCOL)
+                self._buffers[i] = []
+            fd.close()
+        for i in range(self.num_partitions):
+            yield self._read(self._path(i))
+            if os.path.exists(self._path(i)):
+                os.remove(self._path(i))
+
+    @staticmethod
+    def _read(path: str) -> Iterator[Any]:
+        with open(path, 'rb') as fd:
+            while True:
+                try:
+                    batch = pickle.load(fd)
+                except EOFError:
+                    break
+                yield from batch
+
+    def write_run(self, items: Iterable[Tuple[int, Any]]) -> str:
+        """
+        Store results of a bucket in the directory of the partitions, for merge_runs.
+        @param items: (sequence number, result) pairs, in ascending order of the sequence number
+        @return: path of the run
+        """
+        path = os.path.join(self.directory, f"run_{self._runs}.pickle")
+        self._runs += 1
+        with open(path, 'wb') as fd:
+            batch = []
+            for item in items:
+                batch.append(item)
+                if len(batch) >= WRITE_BATCH_SIZE:
+                    pickle.dump(batch, fd, pickle.HIGHEST_PROTOCOL)
+                    batch = []
+            if batch:
+                pickle.dump(batch, fd, pickle.HIGHEST_PROTOCOL)
+        return path
+
+    def merge_runs(self, paths: List[str]) -> Iterator[Any]:
+        """
+        Merge the runs written by write_run in the order of their sequence numbers, reading them lazily.
+        @param paths: paths of the runs
+        @return: the results, without their sequence numbers
+        """
+        for _, result in heapq.merge(*(self._read(p) for p in paths), key=lambda item: item[0]):
+            yield result
+
+    def close(self) -> None:
+        for fd in self._files:
+            fd.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self) -> "HashPartitions":
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb) -> bool:
+        self.close()
+        return False
@@ -0,0 +1,370 @@
+# Copyright (C) 2021-2022 Dino Bollinger, ETH Zürich, Information Security Group
+# Released under the MIT License
+"""
+Run the analysis as a dependency graph of stages, and cache the artifacts of every stage.
+The database fingerprint feeds the matched cookie extraction and methods 1 to 8, whose outputs feed violation_stats.py.
+The extraction publishes a snapshot of the matched cookies, which methods 3, 7 and 8 memory-map and share.
+Each stage is cached under a key built from the hashes of its inputs, its parameters and the source code it runs,
+such that only stages invalidated by a change are re-run. Stages whose inputs are ready run concurrently.
+Finally, the outputs of all stages are collected in the output directory.
+----------------------------------
+Required arguments:
+    <db_path>   Path to database to analyze.
+Optional arguments:
+    --out_path <out_path>: Directory to collect the results in (default: ./violation_stats/).
+    --cache_dir <cache_dir>: Directory of the stage cache (default: ./pipeline_cache/).
+    --workers <workers>: Maximum number of stages running concurrently (default: 4).
+    --stages <stages>: Comma-separated stages to run, together with their dependencies (default: all).
+    --name_pattern <name_pattern>: Method 1, regex pattern for the cookie name.
+    --domain_pattern <domain_pattern>: Method 1, regex pattern for the cookie domain.
+    --expected_label <expected_label>: Method 1, expected label for the cookie.
+    --threshold <threshold>: Method 2, minimum number of occurrences needed to apply the majority.
+    --min_ratio <min_ratio>: Method 2, minimal size of the majority opinion.
+    --min_diff <seconds>: Method 3, minimum difference between declared and actual expiry.
+    --force: Re-run the selected stages even if their artifacts are cached.
+Usage:
+    pipeline.py <db_path> [--out_path <out_path>] [--cache_dir <cache_dir>] [--workers <workers>] [--stages <stages>]
+                [--name_pattern <name_pattern> --domain_pattern <domain_pattern> --expected_label <expected_label>]
+                [--threshold <threshold>] [--min_ratio <min_ratio>] [--min_diff <seconds>] [--force]
+"""
+
+import ast
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+import logging
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+from docopt import docopt
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger("vd")
+
+REPO_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Marker written into a cache entry once the stage completed successfully.
+MANIFEST = ".manifest.json"
+
+# Stage name -> (script, arguments, dependencies, gathers the outputs of its dependencies into its directory)
+# {db} is replaced by the database path, {out} by the directory of the stage,
+# and {<stage>} by the directory of a dependency.
+STAGES: Dict[str, Tuple[str, List[str], List[str], bool]] = {
+    "extraction": ("extract_matched_cookies.py", ["{db}", "{out}matched_cookies.snap", "--snapshot"], [], False),
+    "method1": ("method1_wrong_label.py", ["{db}", "--out_path", "{out}"], [], False),
+    "method2": ("method2_majority_deviation.py", ["{db}", "--out_path", "{out}"], [], False),
+    "method3": ("method3_inconsistent_expiry.py",
+                ["{db}", "--out_path", "{out}", "--matched", "{extraction}matched_cookies.snap"], ["extraction"], False),
+    "method4": ("method4_unclassified_cookies.py", ["{db}", "--out_path", "{out}"], [], False),
+    "method5": ("method5_undeclared_cookies.py", ["{db}", "--out_path", "{out}"], [], False),
+    "method6": ("method6_contradictory_labels.py", ["{db}", "--out_path", "{out}"], [], False),
+    "method7": ("method7_implicit_consent.py",
+                ["{db}", "--out_path", "{out}", "--matched", "{extraction}matched_cookies.snap"], ["extraction"], False),
+    "method8": ("method8_ignored_choices.py",
+                ["{db}", "--out_path", "{out}", "--matched", "{extraction}matched_cookies.snap"], ["extraction"], False),
+    "stats": ("violation_stats/violation_stats.py", [],
+              ["method1", "method2", "method3", "method4", "method5", "method6", "method7", "method8"], True),
+}
+
+
+def hash_file(path: str, hasher: Optional[Any] = None) -> str:
+    """ SHA-256 of a file's content, read in chunks. """
+    h = hasher if hasher is not None else hashlib.sha256()
+    with open(path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def database_fingerprint(db_path: str) -> str:
+    """
+    Cheap fingerprint of the database, without reading the whole file.
+    Combines size and modification time with the SQLite header, which contains the file change counter,
+    and the state of the write-ahead log if there is one.
+    @param db_path: path to the SQLite database
+    @return: hex digest identifying the current state of the database
+    """
+    h = hashlib.sha256()
+    for path in (db_path, db_path + "-wal"):
+        if os.path.exists(path):
+            st = os.stat(path)
+            h.update(f"{os.path.basename(path)}:{st.st_size}:{st.st_mtime_ns};".encode())
+    with open(db_path, 'rb') as fd:
+        h.update(fd.read(100))
+    return h.hexdigest()
+
+
+def local_sources(script: str) -> List[str]:
+    """
+    The stage script and the modules of the repository it imports, directly or through other modules.
+    Imports are read from the source, including those inside functions, and resolved against the directory of the
+    importing file and the repository root, like the scripts themselves resolve them. Other modules are ignored.
+    @param script: path of the stage script, relative to the repository root
+    @return: sorted paths of the script and its local modules, relative to the repository root
+    """
+    sources: Set[str] = set()
+    pending = [script]
+    while pending:
+        source = pending.pop()
+        if source in sources:
+            continue
+        sources.add(source)
+        with open(os.path.join(REPO_ROOT, source), 'rb') as fd:
+            tree = ast.parse(fd.read(), filename=source)
+        modules: Set[str] = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                modules.update(alias.name.split(".")[0] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+                modules.add(node.module.split(".")[0])
+        for module in modules:
+            for directory in (os.path.dirname(source), ""):
+                candidate = os.path.join(directory, f"{module}.py")
+                if os.path.isfile(os.path.join(REPO_ROOT, candidate)):
+                    pending.append(candidate)
+                    break
+    return sorted(sources)
+
+
+def code_version(script: str) -> str:
+    """ Hash of the stage script and all modules of the repository it imports. """
+    h = hashlib.sha256()
+    for source in local_sources(script):
+        h.update(source.encode())
+        hash_file(os.path.join(REPO_ROOT, source), h)
+    return h.hexdigest()
+
+
+def output_hash(stage_dir: str) -> str:
+    """ Hash over the names and contents of all artifacts in a stage directory, excluding logs. """
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk(stage_dir):
+        dirs.sort()
+        for f in sorted(files):
+            if f == MANIFEST or f.endswith(".log"):
+                continue
+            path = os.path.join(root, f)
+            h.update(os.path.relpath(path, stage_dir).encode())
+            h.update(hash_file(path).encode())
+    return h.hexdigest()
+
+
+def stage_key(name: str, args: List[str], db_fingerprint: str, dep_hashes: Dict[str, str]) -> str:
+    """
+    Cache key of a stage.
+    @param name: stage name
+    @param args: argument template of the stage, including its parameters
+    @param db_fingerprint: fingerprint of the database, only part of the key if the stage reads it
+    @param dep_hashes: output hashes of the stages it depends on
+    @return: hex digest, equal for stages that would produce the same artifacts
+    """
+    script = STAGES[name][0]
+    key_data = {"stage": name, "args": args, "code": code_version(script),
+                "db": db_fingerprint if "{db}" in args else None, "inputs": dep_hashes}
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+
+def stage_parameters(cargs: Dict[str, Any]) -> Dict[str, List[str]]:
+    """ Additional arguments for each stage, taken from the pipeline options. """
+    params: Dict[str, List[str]] = {name: [] for name in STAGES}
+    if cargs["--name_pattern"]:
+        params["method1"] = [cargs["--name_pattern"], cargs["--domain_pattern"], cargs["--expected_label"]]
+    for option in ("--threshold", "--min_ratio"):
+        if cargs[option]:
+            params["method2"] += [option, cargs[option]]
+    if cargs["--min_diff"]:
+        params["method3"] += ["--min_diff", cargs["--min_diff"]]
+    return params
+
+
+def resolve_stages(selected: List[str]) -> Set[str]:
+    """ Selected stages together with all their transitive dependencies. """
+    required: Set[str] = set()
+    todo = list(selected)
+    while todo:
+        name = todo.pop()
+        if name not in required:
+            required.add(name)
+            todo.extend(STAGES[name][2])
+    return required
+
+
+def link_or_copy(src: str, dst: str) -> None:
+    """ Hard link a file if possible, to avoid duplicating large artifacts, otherwise copy it. """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def run_stage(name: str, args: List[str], db_path: str, cache_dir: str,
+              dep_entries: Dict[str, Dict[str, Any]], db_fingerprint: str, force: bool) -> Dict[str, Any]:
+    """
+    Run a single stage, or reuse its cached artifacts.
+    @param name: stage name
+    @param args: argument template of the stage, including its parameters
+    @param db_path: absolute path to the database
+    @param cache_dir: absolute path to the cache directory
+    @param dep_entries: manifests of the stages it depends on
+    @param db_fingerprint: fingerprint of the database
+    @param force: whether to ignore an existing cache entry
+    @return: manifest of the cache entry
+    """
+    script, _, deps, gather = STAGES[name]
+    key = stage_key(name, args, db_fingerprint, {d: dep_entries[d]["output_hash"] for d in deps})
+    stage_dir = os.path.join(cache_dir, name, key) + "/"
+    manifest_path = os.path.join(stage_dir, MANIFEST)
+
+    if os.path.exists(manifest_path) and not force:
+        with open(manifest_path, 'r') as fd:
+            entry = json.load(fd)
+        entry["cached"] = True
+        logger.info(f"{name}: cached ({key[:12]})")
+        return entry
+
+    # run in a temporary directory, such that interrupted runs never appear complete
+    tmp_dir = os.path.join(cache_dir, name, f"{key}.tmp{os.getpid()}") + "/"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    gathered = []
+    if gather:
+        for d in deps:
+            for f in dep_entries[d]["files"]:
+                if f.endswith(".log"):
+                    continue
+                link_or_copy(os.path.join(dep_entries[d]["path"], f), os.path.join(tmp_dir, f))
+                gathered.append(f)
+
+    placeholders = {"db": db_path, "out": tmp_dir}
+    placeholders.update({d: dep_entries[d]["path"] for d in deps})
+    script_args = [a.format(**placeholders) for a in args]
+
+    logger.info(f"{name}: running {script}")
+    start = time.perf_counter()
+    with open(os.path.join(tmp_dir, f"{name}.log"), 'w') as log_fd:
+        proc = subprocess.run([sys.executable, os.path.join(REPO_ROOT, script)] + script_args,
+                              cwd=tmp_dir, stdout=log_fd, stderr=subprocess.STDOUT)
+    seconds = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(f"Stage '{name}' failed with exit code {proc.returncode}, "
+                           f"see '{os.path.join(tmp_dir, name + '.log')}'")
+
+    # the inputs of a gathering stage are already cached with the stages that produced them
+    for f in gathered:
+        os.remove(os.path.join(tmp_dir, f))
+
+    files = []
+    for root, _, fs in os.walk(tmp_dir):
+        files.extend(os.path.relpath(os.path.join(root, f), tmp_dir) for f in fs)
+    entry = {"stage": name, "key": key, "output_hash": output_hash(tmp_dir), "files": sorted(files),
+             "seconds": seconds, "created": datetime.now().isoformat()}
+    with open(os.path.join(tmp_dir, MANIFEST), 'w') as fd:
+        json.dump(entry, fd, indent=4, sort_keys=True)
+
+    shutil.rmtree(stage_dir, ignore_errors=True)
+    os.rename(tmp_dir, stage_dir)
+    logger.info(f"{name}: finished in {seconds:.2f}s ({key[:12]})")
+    entry["cached"] = False
+    return entry
+
+
+def run_pipeline(stages: Set[str], db_path: str, params: Dict[str, List[str]], cache_dir: str,
+                 workers: int, force: bool) -> Tuple[Dict[str, Dict[str, Any]], Set[str]]:
+    """
+    Run the stages in dependency order, starting each stage as soon as all its dependencies have finished.
+    @return: manifest of each completed stage, names of the stages that failed or were skipped
+    """
+    db_fingerprint = database_fingerprint(db_path)
+    logger.info(f"Database fingerprint: {db_fingerprint[:12]}")
+
+    completed: Dict[str, Dict[str, Any]] = dict()
+    failed: Set[str] = set()
+    pending = set(stages)
+    running = dict()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            for name in sorted(pending):
+                deps = STAGES[name][2]
+                if any(d in failed for d in deps):
+                    logger.error(f"{name}: skipped, a dependency failed")
+                    failed.add(name)
+                    pending.discard(name)
+                elif all(d in completed for d in deps):
+                    dep_entries = {d: completed[d] for d in deps}
+                    args = STAGES[name][1] + params[name]
+                    running[pool.submit(run_stage, name, args, db_path, cache_dir,
+                                        dep_entries, db_fingerprint, force)] = name
+                    pending.discard(name)
+            if not running:
+                continue
+
+            done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    entry = future.result()
+                    entry["path"] = os.path.join(cache_dir, name, entry["key"]) + "/"
+                    completed[name] = entry
+                except Exception as e:
+                    logger.error(f"{name}: {e}")
+                    failed.add(name)
+    return completed, failed
+
+
+def collect_outputs(completed: Dict[str, Dict[str, Any]], out_path: str) -> None:
+    """ Link the artifacts of all completed stages into the output directory, logs into a subdirectory. """
+    for name, entry in completed.items():
+        for f in entry["files"]:
+            if f == MANIFEST:
+                continue
+            dst = os.path.join(out_path, "logs", name, f) if f.endswith(".log") else os.path.join(out_path, f)
+            link_or_copy(os.path.join(entry["path"], f), dst)
+    logger.info(f"Results collected in: '{out_path}'")
+
+
+def main():
+    """
+    Run the pipeline and collect its results.
+    @return: exit code, 0 for success
+    """
+    argv = None
+    cargs = docopt(__doc__, argv=argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    database_path = cargs["<db_path>"]
+    if not os.path.exists(database_path):
+        logger.error("Database file does not exist.")
+        return 1
+
+    selected = cargs["--stages"].split(",") if cargs["--stages"] else list(STAGES.keys())
+    unknown = set(selected) - set(STAGES.keys())
+    if unknown:
+        logger.error(f"Unknown stages: {unknown}")
+        return 1
+
+    out_path = cargs["--out_path"] if cargs["--out_path"] else "./violation_stats/"
+    cache_dir = os.path.abspath(cargs["--cache_dir"] if cargs["--cache_dir"] else "./pipeline_cache/")
+    workers = int(cargs["--workers"]) if cargs["--workers"] else 4
+
+    start = time.perf_counter()
+    completed, failed = run_pipeline(resolve_stages(selected), os.path.abspath(database_path),
+                                     stage_parameters(cargs), cache_dir, workers, cargs["--force"])
+    collect_outputs(completed, out_path)
+
+    cached = sum(1 for e in completed.values() if e["cached"])
+    logger.info(f"{len(completed)} stages completed ({cached} from cache), {len(failed)} failed, "
+                f"total time {time.perf_counter() - start:.2f}s")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    exit(main())
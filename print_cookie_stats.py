@@ -7,17 +7,48 @@ Given the cookie database, computes:
     * Number of unique cookie names
     * Number of unique cookie domains
 For both declared and observed cookies.
+The unique counts are exact by default. They can instead be computed by the database,
+or be estimated with HyperLogLog sketches, which use a fixed amount of memory.
+
+Options:
+    --mode <mode>     One of "exact", "sql" or "approx". [default: exact]
+    --error <error>   Relative standard error of the estimates in "approx" mode. [default: 0.01]
+    --metrics <metrics_path>  Write timings and peak memory of the run to this JSON file.
 
 Usage:
-    print_cookie_stats.py <db_path>
+    print_cookie_stats.py <db_path> [--mode <mode>] [--error <error>] [--metrics <metrics_path>]
 """
 import os
 import sqlite3
 import re
+import time
 
 from docopt import docopt
 import logging
-from utils import (setupLogger, write_json, write_vdomains, CONSENTDATA_QUERY, JAVASCRIPTCOOKIE_QUERY)
+from typing import Any, Dict
+from sketches import HyperLogLog
+from utils import (setupLogger, write_json, write_vdomains, CONSENTDATA_QUERY, JAVASCRIPTCOOKIE_QUERY,
+                   metrics, peak_rss_mb)
+
+logger = logging.getLogger("vd")
+
+# Distinct counts for the declared cookies, utud is registered as a function on the connection.
+CONSENT_STATS_SQL = f"""
+SELECT SUM(utud(site_url) != utud(consent_domain)) as third_party,
+       SUM(utud(site_url) == utud(consent_domain)) as first_party,
+       COUNT(DISTINCT consent_name) as names,
+       COUNT(DISTINCT utud(consent_domain)) as domains
+FROM ({CONSENTDATA_QUERY})
+"""
+
+# Distinct counts for the observed cookies. First and third party are counted per unique cookie.
+JAVASCRIPT_STATS_SQL = f"""
+SELECT (SELECT COUNT(DISTINCT name) FROM ({JAVASCRIPTCOOKIE_QUERY.replace(";", "")})) as names,
+       (SELECT COUNT(DISTINCT utud(cookie_domain)) FROM ({JAVASCRIPTCOOKIE_QUERY.replace(";", "")})) as domains,
+       SUM(utud(site_url) != utud(cookie_domain)) as third_party,
+       SUM(utud(site_url) == utud(cookie_domain)) as first_party
+FROM (SELECT DISTINCT site_url, name, cookie_domain, path FROM ({JAVASCRIPTCOOKIE_QUERY.replace(";", "")}))
+"""
 
 def utud(url: str) -> str:
     """
@@ -33,29 +64,13 @@ def utud(url: str) -> str:
     return new_url
 
 
-def main():
+def exact_stats(conn: sqlite3.Connection) -> Dict[str, Dict[str, Any]]:
     """
-    @return: exit code, 0 for success
+    Compute the statistics with exact sets of all unique names, domains and identifiers.
+    @param conn: Database connection
+    @return: first-party, third-party, unique name and unique domain counts, for declared and observed cookies
     """
-    argv = None
-    cargs = docopt(__doc__, argv=argv)
-
-    logger = setupLogger(".", logging.INFO)
-
-    logger.info("Extra statistics")
-
-    # Verify that database exists
-    database_path = cargs["<db_path>"]
-    if not os.path.exists(database_path):
-        logger.error("Database file does not exist.")
-        return 1
-
-    logger.info(f"Database used: {database_path}")
-
-    # enable dictionary access by column name, access database
-    conn = sqlite3.connect(database_path)
-    conn.row_factory = sqlite3.Row
-
+    results = dict()
     third_party_count = 0
     first_party_count = 0
     unique_domains = set()
@@ -76,12 +91,8 @@ def main():
 
         cur.close()
 
-    ratioA = first_party_count / (first_party_count + third_party_count)
-    ratioB = third_party_count / (first_party_count + third_party_count)
-    logger.info(f"Number of declared first-party cookies: {first_party_count} -- {ratioA * 100:.2f}%")
-    logger.info(f"Number of declared third-party cookies: {third_party_count} -- {ratioB * 100:.2f}%")
-    logger.info(f"Number of unique cookie names in consent table: {len(unique_names)}")
-    logger.info(f"Number of unique domains in consent table: {len(unique_domains)}")
+    results["consent"] = {"first_party": first_party_count, "third_party": third_party_count,
+                          "names": len(unique_names), "domains": len(unique_domains)}
 
     third_party_count = 0
     first_party_count = 0
@@ -108,12 +119,148 @@ def main():
 
         cur.close()
 
-    ratioA = first_party_count / (first_party_count + third_party_count)
-    ratioB = third_party_count / (first_party_count + third_party_count)
-    logger.info(f"Number of actual first-party cookies: {first_party_count} -- {ratioA * 100:.2f}%")
-    logger.info(f"Number of actual third-party cookies: {third_party_count} -- {ratioB * 100:.2f}%")
-    logger.info(f"Number of unique cookie names in javascript_cookies table: {len(unique_names)}")
-    logger.info(f"Number of unique domains in javascript_cookies table: {len(unique_domains)}")
+    results["javascript"] = {"first_party": first_party_count, "third_party": third_party_count,
+                             "names": len(unique_names), "domains": len(unique_domains)}
+    return results
+
+
+def sql_stats(conn: sqlite3.Connection) -> Dict[str, Dict[str, Any]]:
+    """
+    Compute the statistics with COUNT(DISTINCT ...) in the database, no sets are held in Python.
+    @param conn: Database connection
+    @return: first-party, third-party, unique name and unique domain counts, for declared and observed cookies
+    """
+    conn.create_function("utud", 1, utud, deterministic=True)
+    results = dict()
+    with conn:
+        cur = conn.cursor()
+        cur.execute(CONSENT_STATS_SQL)
+        results["consent"] = {k: v or 0 for k, v in dict(cur.fetchone()).items()}
+        cur.execute(JAVASCRIPT_STATS_SQL)
+        results["javascript"] = {k: v or 0 for k, v in dict(cur.fetchone()).items()}
+        cur.close()
+    return results
+
+
+def approx_stats(conn: sqlite3.Connection, error: float) -> Dict[str, Dict[str, Any]]:
+    """
+    Estimate the statistics in a single pass over each table, using HyperLogLog sketches for the unique counts.
+    First- and third-party identifiers are counted in separate sketches, as membership cannot be tested.
+    @param conn: Database connection
+    @param error: relative standard error of the sketches
+    @return: first-party, third-party, unique name and unique domain counts, for declared and observed cookies
+    """
+    results = dict()
+    third_party_count = 0
+    first_party_count = 0
+    unique_names = HyperLogLog(error)
+    unique_domains = HyperLogLog(error)
+
+    with conn:
+        cur = conn.cursor()
+
+        cur.execute(CONSENTDATA_QUERY)
+        for row in cur:
+            canon_dom = utud(row["consent_domain"])
+            if utud(row["site_url"]) != canon_dom:
+                third_party_count += 1
+            else:
+                first_party_count += 1
+
+            unique_names.add(row["consent_name"])
+            unique_domains.add(canon_dom)
+
+        cur.close()
+
+    results["consent"] = {"first_party": first_party_count, "third_party": third_party_count,
+                          "names": unique_names.count(), "domains": unique_domains.count()}
+
+    first_party_idents = HyperLogLog(error)
+    third_party_idents = HyperLogLog(error)
+    unique_names = HyperLogLog(error)
+    unique_domains = HyperLogLog(error)
+
+    with conn:
+        cur = conn.cursor()
+
+        cur.execute(JAVASCRIPTCOOKIE_QUERY)
+        for row in cur:
+            ident = row["site_url"] + ";" + row["name"] + ";" + row["cookie_domain"] + ";" + row["path"]
+            canon_dom = utud(row["cookie_domain"])
+            if utud(row["site_url"]) != canon_dom:
+                third_party_idents.add(ident)
+            else:
+                first_party_idents.add(ident)
+
+            unique_names.add(row["name"])
+            unique_domains.add(canon_dom)
+
+        cur.close()
+
+    results["javascript"] = {"first_party": first_party_idents.count(), "third_party": third_party_idents.count(),
+                             "names": unique_names.count(), "domains": unique_domains.count()}
+    return results
+
+
+def main():
+    """
+    @return: exit code, 0 for success
+    """
+    argv = None
+    cargs = docopt(__doc__, argv=argv)
+
+    logger = setupLogger(".", logging.INFO)
+    if cargs["--metrics"]:
+        metrics.enable("print_cookie_stats")
+
+    logger.info("Extra statistics")
+
+    # Verify that database exists
+    database_path = cargs["<db_path>"]
+    if not os.path.exists(database_path):
+        logger.error("Database file does not exist.")
+        return 1
+
+    mode = cargs["--mode"]
+    if mode not in ("exact", "sql", "approx"):
+        logger.error(f"Unknown mode: {mode}")
+        return 1
+
+    logger.info(f"Database used: {database_path}")
+
+    # enable dictionary access by column name, access database
+    conn = sqlite3.connect(database_path)
+    conn.row_factory = sqlite3.Row
+
+    start_time = time.perf_counter()
+    with metrics.stage(f"{mode}_stats"):
+        if mode == "sql":
+            results = sql_stats(conn)
+        elif mode == "approx":
+            results = approx_stats(conn, float(cargs["--error"]))
+        else:
+            results = exact_stats(conn)
+    elapsed = time.perf_counter() - start_time
+    conn.close()
+
+    stats = results["consent"]
+    total = stats["first_party"] + stats["third_party"]
+    logger.info(f"Number of declared first-party cookies: {stats['first_party']} -- {stats['first_party'] / total * 100:.2f}%")
+    logger.info(f"Number of declared third-party cookies: {stats['third_party']} -- {stats['third_party'] / total * 100:.2f}%")
+    logger.info(f"Number of unique cookie names in consent table: {stats['names']}")
+    logger.info(f"Number of unique domains in consent table: {stats['domains']}")
+
+    stats = results["javascript"]
+    total = stats["first_party"] + stats["third_party"]
+    logger.info(f"Number of actual first-party cookies: {stats['first_party']} -- {stats['first_party'] / total * 100:.2f}%")
+    logger.info(f"Number of actual third-party cookies: {stats['third_party']} -- {stats['third_party'] / total * 100:.2f}%")
+    logger.info(f"Number of unique cookie names in javascript_cookies table: {stats['names']}")
+    logger.info(f"Number of unique domains in javascript_cookies table: {stats['domains']}")
+
+    peak_mb = peak_rss_mb()
+    logger.info(f"Mode '{mode}' took {elapsed:.2f} seconds, peak memory usage: "
+                f"{f'{peak_mb:.1f} MB' if peak_mb is not None else 'unknown'}")
+    metrics.write(cargs["--metrics"])
     return 0
 
 if __name__ == "__main__":
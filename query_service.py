@@ -0,0 +1,274 @@
+# Copyright (C) 2021-2022 Dino Bollinger, ETH Zürich, Information Security Group
+# Released under the MIT License
+"""
+Read-only local query service over the results of an analysis run.
+Loads the matched cookies and the violations of all methods from a results directory once, indexes them
+by site, cookie and method, and answers HTTP queries with JSON. The service only listens on localhost,
+or on a Unix socket. When the artifacts in the results directory change, e.g. because a new run finished,
+they are loaded into a new snapshot, which replaces the current one once it is complete.
+Queries:
+    GET /status                                  Results directory, load time and size of the current snapshot.
+    GET /site?url=<site_url>                     Violations per method and matched cookies of a site.
+                                                 The site can be given with or without scheme.
+    GET /cookie?name=<name>[&domain=<domain>]    Violations per method for a cookie, and the number of sites setting it.
+    GET /method?name=<method>[&offset=<n>&limit=<n>]
+                                                 Violation counts of a method, and its sites with violations.
+----------------------------------
+Required arguments:
+    <results_path>  Output directory of the run, e.g. of pipeline.py.
+Optional arguments:
+    --port <port>: Port on localhost to listen on (default: 8642).
+    --socket <socket_path>: Listen on this Unix socket instead of a port.
+    --poll <seconds>: Interval to check the results directory for new artifacts (default: 5).
+Usage:
+    query_service.py <results_path> [--port <port> | --socket <socket_path>] [--poll <seconds>]
+"""
+
+import json
+import os
+import signal
+import socketserver
+import sys
+import threading
+import time
+import logging
+
+from datetime import datetime
+from docopt import docopt
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Set, Tuple
+from urllib.parse import urlsplit, parse_qs
+
+from batch_analysis import METHOD_OUTPUTS
+from utils import load_matched_cookies
+
+logger = logging.getLogger("vd")
+
+# Matched cookies as written by pipeline.py, or by extract_matched_cookies.py without "--snapshot"
+MATCHED_FILES = ["matched_cookies.snap", "matched_cookies.json"]
+
+
+def artifact_signature(results_path: str) -> Tuple:
+    """ Size and modification time of all artifacts loaded into a snapshot, changes when a run writes new ones. """
+    signature = []
+    for fn in MATCHED_FILES + [f for outputs in METHOD_OUTPUTS.values() for f in outputs]:
+        path = os.path.join(results_path, fn)
+        if os.path.exists(path):
+            st = os.stat(path)
+            signature.append((fn, st.st_size, st.st_mtime_ns))
+    return tuple(signature)
+
+
+def strip_scheme(site_url: str) -> str:
+    """ Site without the scheme and trailing slash, such that sites can be queried by host. """
+    return site_url.split("://", 1)[-1].rstrip("/")
+
+
+class Snapshot:
+    """
+    Indexed, immutable view of the results of one run. Built completely before it is served,
+    so concurrent queries never see a partially loaded run.
+    """
+
+    def __init__(self, results_path: str):
+        """
+        @param results_path: directory with the outputs of the run
+        """
+        start = time.perf_counter()
+        self.results_path = results_path
+        self.signature = artifact_signature(results_path)
+        self.loaded = datetime.now().isoformat()
+
+        # site -> method -> violations; name -> domain -> method -> sites; method -> sites
+        self.by_site: Dict[str, Dict[str, List[Dict[str, Any]]]] = dict()
+        self.by_cookie: Dict[str, Dict[str, Dict[str, Set[str]]]] = dict()
+        self.by_method: Dict[str, List[str]] = dict()
+        self.method_counts: Dict[str, int] = dict()
+        for method, outputs in METHOD_OUTPUTS.items():
+            count = 0
+            sites = set()
+            for fn in outputs:
+                path = os.path.join(results_path, fn)
+                if not os.path.exists(path):
+                    continue
+                with open(path, 'r') as fd:
+                    details = json.load(fd)
+                for site, records in details.items():
+                    count += len(records)
+                    sites.add(site)
+                    self.by_site.setdefault(site, dict()).setdefault(method, []).extend(records)
+                    for r in records:
+                        self.by_cookie.setdefault(r["name"], dict()).setdefault(r["domain"], dict()) \
+                            .setdefault(method, set()).add(site)
+            self.method_counts[method] = count
+            self.by_method[method] = sorted(sites)
+
+        # matched cookies of each site, and the number of sites setting each cookie name
+        self.matched_by_site: Dict[str, List[Dict[str, Any]]] = dict()
+        self.matched_sites_by_name: Dict[str, Set[str]] = dict()
+        matched_paths = [os.path.join(results_path, fn) for fn in MATCHED_FILES
+                         if os.path.exists(os.path.join(results_path, fn))]
+        if matched_paths:
+            for entry in load_matched_cookies(matched_paths[0]).values():
+                self.matched_by_site.setdefault(entry["site_url"], []).append(entry)
+                self.matched_sites_by_name.setdefault(entry["name"], set()).add(entry["site_url"])
+
+        self.hosts: Dict[str, str] = {strip_scheme(s): s for s in list(self.by_site) + list(self.matched_by_site)}
+        self.load_seconds = time.perf_counter() - start
+
+    def resolve_site(self, site: str) -> Optional[str]:
+        """ Site as stored in the outputs, accepting sites without scheme. """
+        if site in self.by_site or site in self.matched_by_site:
+            return site
+        return self.hosts.get(strip_scheme(site))
+
+    def status(self) -> Dict[str, Any]:
+        return {"results_path": self.results_path, "loaded": self.loaded, "load_seconds": self.load_seconds,
+                "sites_with_violations": len(self.by_site), "sites_with_matched_cookies": len(self.matched_by_site),
+                "violations_per_method": self.method_counts}
+
+    def site(self, url: str) -> Optional[Dict[str, Any]]:
+        site = self.resolve_site(url)
+        if site is None:
+            return None
+        return {"site_url": site, "violations": self.by_site.get(site, dict()),
+                "matched_cookies": self.matched_by_site.get(site, [])}
+
+    def cookie(self, name: str, domain: Optional[str]) -> Dict[str, Any]:
+        violations: Dict[str, List[Dict[str, Any]]] = dict()
+        for c_domain, methods in self.by_cookie.get(name, dict()).items():
+            if domain is not None and c_domain != domain:
+                continue
+            for method, sites in methods.items():
+                violations.setdefault(method, []).append({"domain": c_domain, "sites": sorted(sites)})
+        return {"name": name, "domain": domain, "violations": violations,
+                "sites_setting_cookie": len(self.matched_sites_by_name.get(name, ()))}
+
+    def method(self, name: str, offset: int, limit: int) -> Optional[Dict[str, Any]]:
+        if name not in self.by_method:
+            return None
+        sites = self.by_method[name]
+        return {"method": name, "violations": self.method_counts[name], "sites": len(sites),
+                "offset": offset, "site_urls": sites[offset:offset + limit]}
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """ Answers queries from the snapshot current at the start of the request. """
+
+    def do_GET(self):
+        start = time.perf_counter()
+        snapshot: Snapshot = self.server.snapshot
+        url = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        try:
+            if url.path == "/status":
+                result = snapshot.status()
+            elif url.path == "/site" and "url" in query:
+                result = snapshot.site(query["url"])
+            elif url.path == "/cookie" and "name" in query:
+                result = snapshot.cookie(query["name"], query.get("domain"))
+            elif url.path == "/method" and "name" in query:
+                result = snapshot.method(query["name"], int(query.get("offset", 0)), int(query.get("limit", 100)))
+            else:
+                self.send_json(400, {"error": f"Unknown query: {self.path}"})
+                return
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        if result is None:
+            self.send_json(404, {"error": f"Not found: {self.path}"})
+        else:
+            self.send_json(200, result)
+        logger.debug(f"{self.path} answered in {(time.perf_counter() - start) * 1000:.2f}ms")
+
+    def send_json(self, code: int, body: Dict[str, Any]) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self) -> str:
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ HTTP server on a Unix socket, handling each request in its own thread. """
+    daemon_threads = True
+
+
+def watch_results(server: Any, results_path: str, poll: float) -> None:
+    """
+    Replace the snapshot of the server when the artifacts change. A new snapshot is only loaded once
+    the artifacts are unchanged over two polls, such that a run that is still writing is not loaded.
+    """
+    pending = None
+    while True:
+        time.sleep(poll)
+        signature = artifact_signature(results_path)
+        if signature == server.snapshot.signature:
+            pending = None
+        elif signature != pending:
+            pending = signature
+        else:
+            try:
+                snapshot = Snapshot(results_path)
+            except (OSError, ValueError, KeyError) as e:
+                logger.error(f"Failed to reload '{results_path}': {e}")
+                continue
+            server.snapshot = snapshot
+            pending = None
+            logger.info(f"Reloaded '{results_path}' in {snapshot.load_seconds:.2f}s")
+
+
+def main():
+    """
+    Load the results and serve queries until interrupted.
+    @return: exit code, 0 for success
+    """
+    argv = None
+    cargs = docopt(__doc__, argv=argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    results_path = cargs["<results_path>"]
+    if not os.path.isdir(results_path):
+        logger.error("Results directory does not exist.")
+        return 1
+    poll = float(cargs["--poll"]) if cargs["--poll"] else 5.0
+
+    snapshot = Snapshot(results_path)
+    logger.info(f"Loaded '{results_path}' in {snapshot.load_seconds:.2f}s: {snapshot.method_counts}")
+
+    if cargs["--socket"]:
+        if os.path.exists(cargs["--socket"]):
+            os.remove(cargs["--socket"])
+        server = UnixHTTPServer(cargs["--socket"], QueryHandler)
+        logger.info(f"Listening on '{cargs['--socket']}'")
+    else:
+        port = int(cargs["--port"]) if cargs["--port"] else 8642
+        server = ThreadingHTTPServer(("127.0.0.1", port), QueryHandler)
+        logger.info(f"Listening on http://127.0.0.1:{port}/")
+    server.snapshot = snapshot
+
+    threading.Thread(target=watch_results, args=(server, results_path, poll), daemon=True).start()
+    # stop like on an interrupt, such that the socket is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if cargs["--socket"]:
+            os.remove(cargs["--socket"])
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
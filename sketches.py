@@ -0,0 +1,325 @@
+# Copyright (C) 2021-2022 Dino Bollinger, ETH Zürich, Information Security Group
+# Released under the MIT License
+"""
+Probabilistic summaries of large cookie collections, used where exact sets would not fit into memory.
+The summaries of numeric distributions can be merged and stored as JSON, e.g. to combine the results of several crawls.
+"""
+import bisect
+import heapq
+import math
+import random
+from hashlib import blake2b
+from typing import Any, Dict, Hashable, List, Sequence, Tuple
+
+
+def hash64(item: str) -> int:
+    """ Stable 64-bit hash of a string, independent of the interpreter's hash seed. """
+    return int.from_bytes(blake2b(item.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HyperLogLog:
+    """
+    HyperLogLog sketch for estimating the number of distinct strings.
+    Memory use is 2^p bytes, independent of the number of distinct items.
+    """
+
+    def __init__(self, error: float = 0.01):
+        """
+        @param error: Target relative standard error of the estimate, determines the number of registers.
+        """
+        # standard error is 1.04 / sqrt(m), with m = 2^p registers
+        self.p = min(18, max(4, math.ceil(math.log2((1.04 / error) ** 2))))
+        self.m = 1 << self.p
+        self.registers = bytearray(self.m)
+        if self.m >= 128:
+            self.alpha = 0.7213 / (1 + 1.079 / self.m)
+        else:
+            self.alpha = {16: 0.673, 32: 0.697, 64: 0.709}[self.m]
+
+    def add(self, item: str) -> None:
+        """ Add a string to the sketch. """
+        x = hash64(item)
+        idx = x >> (64 - self.p)
+        w = x & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - w.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def merge(self, other: "HyperLogLog") -> None:
+        """ Combine with a sketch of the same precision, such that the result estimates the size of the union. """
+        assert self.p == other.p, "Can only merge sketches of the same precision."
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def count(self) -> int:
+        """ Estimate the number of distinct items added so far. """
+        estimate = self.alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.m and zeros > 0:
+            # small range correction through linear counting
+            estimate = self.m * math.log(self.m / zeros)
+        return int(round(estimate))
+
+    def __len__(self) -> int:
+        return self.count()
+
+
+class SpaceSaving:
+    """
+    Space-Saving sketch for the most frequent items of a stream (Metwally et al., 2005).
+    Keeps a fixed number of counters: an item without a counter takes over the smallest one, and inherits its
+    count as error. Each count overestimates the true count of its item by at most its error, which is bounded by
+    the number of items added divided by the capacity. Any item more frequent than that bound holds a counter.
+    """
+
+    def __init__(self, capacity: int):
+        """
+        @param capacity: Number of counters, determines memory use and the error bound.
+        """
+        self.capacity = max(1, capacity)
+        self.total = 0
+        # item -> [count, error]
+        self.counters: Dict[Hashable, List[int]] = dict()
+        # (count, item) of the counters, with outdated entries removed lazily
+        self._heap: List[Tuple[int, Hashable]] = []
+
+    def add(self, item: Hashable, count: int = 1) -> None:
+        """ Add an occurrence of an item to the sketch. """
+        self.total += count
+        counter = self.counters.get(item)
+        if counter is None:
+            if len(self.counters) < self.capacity:
+                counter = self.counters[item] = [0, 0]
+            else:
+                min_count, min_item = self._pop_min()
+                del self.counters[min_item]
+                counter = self.counters[item] = [min_count, min_count]
+        counter[0] += count
+        heapq.heappush(self._heap, (counter[0], item))
+        if len(self._heap) > 4 * self.capacity:
+            # drop the outdated entries
+            self._heap = [(c[0], i) for i, c in self.counters.items()]
+            heapq.heapify(self._heap)
+
+    def _pop_min(self) -> Tuple[int, Hashable]:
+        while True:
+            count, item = heapq.heappop(self._heap)
+            counter = self.counters.get(item)
+            if counter is not None and counter[0] == count:
+                return count, item
+
+    def top(self, k: int) -> List[Tuple[Hashable, int, int]]:
+        """
+        The k items with the highest counts.
+        @param k: number of items
+        @return: (item, count, error) triples, by descending count
+        """
+        return [(item, c[0], c[1]) for item, c in heapq.nlargest(k, self.counters.items(), key=lambda x: x[1][0])]
+
+    def __len__(self) -> int:
+        return self.total
+
+
+class Welford:
+    """
+    Running count, mean and variance of a stream of numbers (Welford's algorithm).
+    Merging uses the parallel variant by Chan et al., such that merged moments equal those of the combined stream.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, x: float) -> None:
+        """ Add a number to the moments. """
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+        self.min = min(self.min, x)
+        self.max = max(self.max, x)
+
+    def merge(self, other: "Welford") -> None:
+        """ Combine with the moments of another stream. """
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def variance(self) -> float:
+        """ Sample variance, as statistics.variance computes it. """
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def stdev(self) -> float:
+        """ Sample standard deviation, as statistics.stdev computes it. """
+        return math.sqrt(self.variance())
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"count": self.count, "mean": self.mean, "m2": self.m2,
+                "min": self.min if self.count else None, "max": self.max if self.count else None}
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "Welford":
+        w = cls()
+        w.count, w.mean, w.m2 = d["count"], d["mean"], d["m2"]
+        if w.count:
+            w.min, w.max = d["min"], d["max"]
+        return w
+
+
+class KLL:
+    """
+    KLL sketch for the quantiles of a stream of numbers (Karnin, Lang and Liberty, 2016).
+    Items are kept in a hierarchy of compactors, where an item at level h stands for 2^h items of the stream.
+    A full compactor is sorted, and every other item is promoted to the next level. The rank error is
+    about 1.7 / k of the stream length, and memory grows only with the logarithm of the stream length.
+    As long as nothing was compacted, the sketch holds all items and its results are exact.
+    """
+
+    def __init__(self, k: int = 200, c: float = 2 / 3):
+        """
+        @param k: Capacity of the top compactor, determines memory use and accuracy.
+        @param c: Factor by which the capacity shrinks per level below the top.
+        """
+        self.k = k
+        self.c = c
+        self.n = 0
+        self.compactors: List[List[float]] = []
+        self.max_size = 0
+        # compactions pick the odd or even items by a coin flip, seeded for reproducible outputs
+        self._rng = random.Random(0)
+        self._grow()
+
+    def _grow(self) -> None:
+        self.compactors.append([])
+        self.max_size = sum(self._capacity(h) for h in range(len(self.compactors)))
+
+    def _capacity(self, h: int) -> int:
+        depth = len(self.compactors) - h - 1
+        return int(math.ceil(self.c ** depth * self.k)) + 1
+
+    def _size(self) -> int:
+        return sum(len(c) for c in self.compactors)
+
+    def _compress(self) -> None:
+        for h, compactor in enumerate(self.compactors):
+            if len(compactor) >= self._capacity(h):
+                if h + 1 >= len(self.compactors):
+                    self._grow()
+                compactor.sort()
+                # an odd item out stays at its level
+                rest = [compactor.pop()] if len(compactor) % 2 else []
+                self.compactors[h + 1].extend(compactor[self._rng.randint(0, 1)::2])
+                self.compactors[h] = rest
+                return
+
+    def add(self, x: float) -> None:
+        """ Add a number to the sketch. """
+        self.n += 1
+        self.compactors[0].append(x)
+        if self._size() >= self.max_size:
+            self._compress()
+
+    def merge(self, other: "KLL") -> None:
+        """ Combine with another sketch, such that the result summarizes both streams. """
+        while len(self.compactors) < len(other.compactors):
+            self._grow()
+        for h, compactor in enumerate(other.compactors):
+            self.compactors[h].extend(compactor)
+        self.n += other.n
+        while self._size() >= self.max_size:
+            self._compress()
+
+    def _weighted(self) -> List[Tuple[float, int]]:
+        return sorted((x, 1 << h) for h, compactor in enumerate(self.compactors) for x in compactor)
+
+    def quantile(self, q: float) -> float:
+        """
+        Approximate q-quantile: the smallest item of the sketch whose rank is at least q times the stream length.
+        @param q: quantile, within [0, 1]
+        """
+        items = self._weighted()
+        if not items:
+            return math.nan
+        total = sum(w for _, w in items)
+        target = q * total
+        cumulative = 0
+        for x, w in items:
+            cumulative += w
+            if cumulative >= target:
+                return x
+        return items[-1][0]
+
+    def median(self) -> float:
+        """ Approximate median, the mean of the two middle items if the sketch holds an even number of items. """
+        items = self._weighted()
+        if all(w == 1 for _, w in items) and items and len(items) % 2 == 0:
+            return (items[len(items) // 2 - 1][0] + items[len(items) // 2][0]) / 2
+        return self.quantile(0.5)
+
+    def histogram(self, bins: Sequence[float]) -> List[int]:
+        """
+        Approximate number of items per bin, with the bins of numpy.histogram: each bin includes its lower edge,
+        the last bin also its upper edge, and items outside of all bins are not counted.
+        @param bins: monotonically increasing bin edges
+        @return: count per bin
+        """
+        counts = [0] * (len(bins) - 1)
+        for x, w in self._weighted():
+            if x < bins[0] or x > bins[-1]:
+                continue
+            i = min(bisect.bisect_right(bins, x) - 1, len(counts) - 1)
+            counts[i] += w
+        return counts
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"k": self.k, "c": self.c, "n": self.n, "compactors": self.compactors}
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "KLL":
+        sketch = cls(d["k"], d["c"])
+        sketch.n = d["n"]
+        sketch.compactors = []
+        for compactor in d["compactors"]:
+            sketch._grow()
+            sketch.compactors[-1] = list(compactor)
+        return sketch
+
+
+class NumericSummary:
+    """ Moments and quantiles of a stream of numbers, mergeable and stored as JSON. """
+
+    def __init__(self, k: int = 200):
+        """
+        @param k: Accuracy parameter of the quantile sketch, see KLL.
+        """
+        self.moments = Welford()
+        self.quantiles = KLL(k)
+
+    def add(self, x: float) -> None:
+        self.moments.add(x)
+        self.quantiles.add(x)
+
+    def merge(self, other: "NumericSummary") -> None:
+        self.moments.merge(other.moments)
+        self.quantiles.merge(other.quantiles)
+
+    def __len__(self) -> int:
+        return self.moments.count
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"moments": self.moments.to_dict(), "quantiles": self.quantiles.to_dict()}
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "NumericSummary":
+        summary = cls()
+        summary.moments = Welford.from_dict(d["moments"])
+        summary.quantiles = KLL.from_dict(d["quantiles"])
+        return summary
@@ -4,16 +4,37 @@
 Contains functions that are shared between the analysis scripts.
 """
 from statistics import mean, stdev
-from typing import Dict, Set, List, Tuple, Any, Union
+from typing import Dict, Set, List, Tuple, Any, Union, Iterator, Optional, Mapping
 import traceback
 import sqlite3
 import json
 import os
 import logging
-from datetime import datetime
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+from functools import lru_cache
 import re
+import sys
+import time
+
+from array import array
+from matched_snapshot import MatchedSnapshot, SnapshotWriter, is_snapshot
+from partitioned_grouping import HashPartitions, partitions_needed, estimate_table_rows
+from sketches import NumericSummary
+
+# Peak memory is read with resource on Unix, which does not exist on Windows. There, the optional
+# psutil package is used if it is installed, and the peak memory is not reported otherwise.
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import psutil
+except ImportError:
+    psutil = None
 
 # Query to match cookie declarations with observed cookies, and retrieve crawl state results.
+# Ties are ordered by the declaration, such that the same declaration is kept independent of the query plan.
 MATCHED_COOKIEDATA_QUERY = """
 SELECT DISTINCT j.visit_id,
         s.site_url,
@@ -41,7 +62,8 @@ JOIN javascript_cookies j ON c.visit_id == j.visit_id and c.name == j.name
 JOIN site_visits s ON s.visit_id == c.visit_id
 JOIN consent_crawl_results ccr ON ccr.visit_id == c.visit_id
 WHERE j.record_type <> "deleted"
-ORDER BY j.visit_id, j.name, time_stamp ASC;
+ORDER BY j.visit_id, j.name, time_stamp ASC,
+         c.domain, c.cat_id, c.cat_name, c.purpose, c.expiry, c.type_name, c.type_id, j.rowid;
 """
 
 # Extracts data from the cookie declaration table only, combined with crawl state results.
@@ -63,6 +85,39 @@ JOIN site_visits s ON s.visit_id == c.visit_id
 JOIN consent_crawl_results ccr ON ccr.visit_id == c.visit_id
 """
 
+# CONSENTDATA_QUERY for analyses that depend on the order of the entries, e.g. on the first label seen for a cookie.
+# Duplicates are removed as with DISTINCT, but the entries are explicitly ordered by their first row in the table,
+# such that the order does not depend on the query plan, which changes e.g. with the indexes of the database.
+# {columns}, {joins} and {where} extend the query, e.g. with conditions on the entries.
+ORDERED_CONSENTDATA_TEMPLATE = """
+SELECT c.visit_id,
+        s.site_url,
+        ccr.cmp_type as cmp_type,
+        ccr.crawl_state,
+        c.name as consent_name,
+        c.domain as consent_domain,
+        c.purpose,
+        c.cat_id,
+        c.cat_name,
+        c.type_name,
+        c.type_id,
+        c.expiry as consent_expiry{columns}
+FROM consent_data c
+JOIN site_visits s ON s.visit_id == c.visit_id
+JOIN consent_crawl_results ccr ON ccr.visit_id == c.visit_id{joins}
+{where}
+GROUP BY c.visit_id, s.site_url, ccr.cmp_type, ccr.crawl_state, c.name, c.domain, c.purpose,
+         c.cat_id, c.cat_name, c.type_name, c.type_id, c.expiry{columns}
+ORDER BY MIN(c.rowid)
+"""
+ORDERED_CONSENTDATA_QUERY = ORDERED_CONSENTDATA_TEMPLATE.format(columns="", joins="", where="")
+
+# Visits with a detected CMP and a successful consent crawl, the only ones some scans read.
+CMP_VISITS_CONDITION = "ccr.cmp_type <> -1 and ccr.crawl_state == 0"
+
+# Visits with declarations in the consent table, the only ones the scans over consent_data read.
+CONSENT_VISITS_CONDITION = "s.visit_id IN (SELECT visit_id FROM consent_data)"
+
 # Extracts data from the observed cookie table, match with crawl state results.
 JAVASCRIPTCOOKIE_QUERY = """
 SELECT DISTINCT j.visit_id,
@@ -90,6 +145,189 @@ ORDER BY j.visit_id, j.name, time_stamp ASC;
 logger = logging.getLogger("vd")
 time_format = "%Y-%m-%dT%H:%M:%S.%fZ"
 
+# Memory taken by the matched cookie extraction per observed cookie row, to decide whether it needs to be partitioned
+MATCHED_BYTES_PER_ROW = 1000
+
+# Memory taken per consent table row by the entries grouped in methods 2 and 6
+CONSENT_BYTES_PER_ROW = 900
+
+# Distinct strings deduplicated in the snapshot of a partitioned extraction, bounds the memory of the writer
+SNAPSHOT_MAX_STRINGS = 1000000
+
+def peak_rss_mb() -> Optional[float]:
+    """
+    Peak resident memory of this process so far, in megabytes.
+    ru_maxrss is given in kilobytes on Linux and in bytes on macOS. On Windows, psutil reports the peak working set.
+    @return: peak memory, None if it cannot be determined on this platform
+    """
+    if resource is not None:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss / (1024 * 1024) if sys.platform == "darwin" else max_rss / 1024
+    if psutil is not None:
+        peak_wset = getattr(psutil.Process().memory_info(), "peak_wset", None)
+        if peak_wset is not None:
+            return peak_wset / (1024 * 1024)
+    return None
+
+
+class _Stage:
+    """ Context manager that adds its duration to a stage of the metrics. """
+
+    def __init__(self, stats: Dict[str, Any]):
+        self.stats = stats
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats["seconds"] += time.perf_counter() - self.start
+        self.stats["calls"] += 1
+        self.stats["peak_rss_mb"] = peak_rss_mb()
+        return False
+
+
+class Metrics:
+    """
+    Collects timings, row counts and peak memory for the stages of a run, and writes them as JSON.
+    Disabled by default, in which case stages are a shared no-op context and all updates return immediately.
+    Hot loops should check `enabled` once, and only then time individual steps with `add_time`.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.script = None
+        self.start = 0.0
+        self.stages: Dict[str, Dict[str, Any]] = dict()
+        self.counters: Dict[str, int] = dict()
+        self._null_stage = nullcontext()
+
+    def enable(self, script: str) -> None:
+        """ Start collecting metrics for the given script. """
+        self.enabled = True
+        self.script = script
+        self.start = time.perf_counter()
+
+    def _get_stage(self, name: str) -> Dict[str, Any]:
+        if name not in self.stages:
+            # peak memory is only sampled at the end of timed stages, not for steps timed with add_time
+            self.stages[name] = {"seconds": 0.0, "calls": 0, "rows": 0, "peak_rss_mb": None}
+        return self.stages[name]
+
+    def stage(self, name: str):
+        """ Context manager timing a stage. Repeated stages of the same name are accumulated. """
+        if not self.enabled:
+            return self._null_stage
+        return _Stage(self._get_stage(name))
+
+    def add_time(self, name: str, start: float) -> None:
+        """ Add the time since `start` (from time.perf_counter) to the stage. """
+        if self.enabled:
+            stats = self._get_stage(name)
+            stats["seconds"] += time.perf_counter() - start
+            stats["calls"] += 1
+
+    def add_rows(self, name: str, rows: int) -> None:
+        """ Record the number of rows processed by a stage, used to compute its throughput. """
+        if self.enabled:
+            self._get_stage(name)["rows"] += rows
+
+    def count(self, name: str, value: int = 1) -> None:
+        """ Increment a named counter. """
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def write(self, metrics_path: str) -> None:
+        """
+        Write the collected metrics to a JSON file, if enabled.
+        @param metrics_path: file to write the metrics to
+        """
+        if not self.enabled or not metrics_path:
+            return
+        for stats in self.stages.values():
+            stats["rows_per_second"] = stats["rows"] / stats["seconds"] if stats["rows"] and stats["seconds"] > 0 else None
+        report = {"script": self.script,
+                  "timestamp": datetime.now().isoformat(),
+                  "total_seconds": time.perf_counter() - self.start,
+                  "peak_rss_mb": peak_rss_mb(),
+                  "stages": self.stages,
+                  "counters": self.counters}
+        with open(metrics_path, 'w') as fd:
+            json.dump(report, fd, indent=4, sort_keys=True)
+        logger.info(f"Metrics output to: '{metrics_path}'")
+
+
+# Shared instance, enabled by the scripts through their --metrics flag.
+metrics = Metrics()
+
+
+def count_visits(conn: sqlite3.Connection, condition: Optional[str] = None) -> int:
+    """
+    Number of site visits covered by a scan, a cheap count used as the target for progress reports.
+    @param conn: Connection to the crawl database
+    @param condition: Condition of the scanned query on the visits, over site_visits s and consent_crawl_results ccr,
+                      such as CMP_VISITS_CONDITION or CONSENT_VISITS_CONDITION.
+                      All visits with a consent crawl result are counted if None.
+    @return: number of distinct visits
+    """
+    where = f"WHERE {condition}" if condition else ""
+    return conn.execute("SELECT COUNT(DISTINCT s.visit_id) FROM site_visits s "
+                        f"JOIN consent_crawl_results ccr ON ccr.visit_id == s.visit_id {where}").fetchone()[0]
+
+
+class ProgressReporter:
+    """
+    Periodically logs the progress of a long scan over database rows that are grouped by visit_id:
+    visits processed out of the total, rows per second and the estimated remaining time.
+    The clock is only checked every `check_every` rows, and a report is written at most every `interval` seconds.
+    """
+
+    def __init__(self, label: str, total_visits: int, interval: float = 10.0, check_every: int = 5000):
+        """
+        @param label: Name of the scan, prefixed to each report
+        @param total_visits: Number of visits the scan is expected to cover
+        @param interval: Minimum number of seconds between two reports
+        @param check_every: Number of rows between two checks of the clock
+        """
+        self.label = label
+        self.total_visits = total_visits
+        self.interval = interval
+        self.check_every = check_every
+        self.rows = 0
+        self.visits = 0
+        self.last_visit = None
+        self.next_check = check_every
+        self.start = time.perf_counter()
+        self.last_report = self.start
+
+    def update(self, visit_id: int) -> None:
+        """ Register one processed row, belonging to the given visit. """
+        self.rows += 1
+        if visit_id != self.last_visit:
+            self.last_visit = visit_id
+            self.visits += 1
+        if self.rows >= self.next_check:
+            self.next_check = self.rows + self.check_every
+            now = time.perf_counter()
+            if now - self.last_report >= self.interval:
+                self.last_report = now
+                self.report(now)
+
+    def report(self, now: float) -> None:
+        """ Log the current progress. """
+        elapsed = now - self.start
+        visits = min(self.visits, self.total_visits)
+        rate = self.rows / elapsed if elapsed > 0 else 0
+        if visits > 0 and self.total_visits > 0:
+            eta = str(timedelta(seconds=int(elapsed / visits * (self.total_visits - visits))))
+            percent = visits / self.total_visits * 100
+        else:
+            eta, percent = "unknown", 0.0
+        logger.info(f"{self.label}: {visits}/{self.total_visits} visits ({percent:.1f}%), "
+                    f"{self.rows} rows, {rate:.0f} rows/s, ETA {eta}")
+
+
+# Name of the state database of incremental runs, kept in the output directory of the methods.
 def setupLogger(logdir:str, logLevel=logging.DEBUG):
     """
     Set up the logger instance. INFO output to stderr, DEBUG output to log file.
@@ -120,9 +358,11 @@ def compute_expiry_time_in_seconds(start_ts: str, end_ts: str, session: int) ->
         return int(timedelta.total_seconds())
 
 
+@lru_cache(maxsize=1 << 16)
 def canonical_domain(dom: str) -> str:
     """
     Transform a provided URL into a uniform domain representation for string comparison.
+    Results are cached, as the same few domains recur throughout the crawl.
     """
     canon_dom = re.sub("^http(s)?://", "", dom)
     canon_dom = re.sub("^www", "", canon_dom)
@@ -130,157 +370,238 @@ def canonical_domain(dom: str) -> str:
     return canon_dom
 
 
-def retrieve_matched_cookies_from_DB(conn: sqlite3.Connection):
+def split_consent_domains(consent_domain: str) -> List[str]:
     """
-    Retrieves cookies that were found in both the javascript cookies table, and the consent table.
-    @param conn: Database connection
-    @return: Extracted records in JSON format, cookie update counts, cookies that were labelled twice on a single website
+    CMPs may list multiple domains for a single declaration, separated by linebreaks or commas.
+    @param consent_domain: domain string from the consent table
+    @return: list of individual domain entries
     """
-    json_data: Dict[str, Dict[str, Any]] = dict()
-    updates_per_cookie_entry: Dict[Tuple[str, int], int] = dict()
+    if re.search("<br/>", consent_domain):
+        return consent_domain.split("<br/>")
+    elif re.search(",", consent_domain):
+        return consent_domain.split(",")
+    else:
+        return [consent_domain]
 
-    # cookies that will be filtered due to having multiple categories assigned
-    blacklist = set()
 
-    # while collecting the data, also determine how many training entries were collected for each label
-    # [necessary, functional, analytic, advertising]
-    counts_per_unique_cookie = [0, 0, 0, 0, 0, 0, 0]
-    counts_per_cookie_update = [0, 0, 0, 0, 0, 0, 0]
-    mismatch_count = 0
-    update_count = 0
+def consent_domain_matches(cookie_domain: str, consent_domain: str) -> bool:
+    """
+    Verify that the observed cookie's domain matches the declared domain.
+    Consent Management Platforms may specify multiple possible domains, split by linebreaks.
+    If the correct host occurs in the set, the domains match.
+    @param cookie_domain: host of the observed cookie
+    @param consent_domain: domain string from the consent table
+    @return: True if one of the declared domains occurs in the cookie's domain
+    """
+    canon_adom = canonical_domain(cookie_domain)
+    for domain_entry in consent_domain.split("<br/>"):
+        canon_cdom = canonical_domain(domain_entry)
+        if re.search(re.escape(canon_cdom), canon_adom, re.IGNORECASE):
+            return True
+    return False
+
 
-    # counts the number of times a data entry was rejected due to multiple categories
-    blacklisted_encounters = 0
+def ensure_index(conn: sqlite3.Connection, index_name: str, table: str, columns: List[str], create: bool) -> None:
+    """
+    Create an index on the given table if it does not exist yet. Creation is a one-time cost per database, but
+    modifies the crawl database, and is therefore only done when asked for with "--create_indexes".
+    Queries work without the index, only slower.
+    @param conn: Database connection
+    @param index_name: Name of the index to create
+    @param table: Table to index
+    @param columns: Columns to include in the index, in order
+    @param create: Whether the index may be added to the database, otherwise only reports whether it is missing
+    """
+    if not create:
+        try:
+            exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type == 'index' AND name == ?",
+                                  (index_name,)).fetchone()
+        except sqlite3.OperationalError:
+            # e.g. DuckDB, which does not use the indexes of the database
+            return
+        if exists is None:
+            logger.info(f"Index '{index_name}' on table '{table}' does not exist, the query may be slow. "
+                        f"Run with --create_indexes to add it to the database.")
+        return
     try:
         with conn:
-            cur = conn.cursor()
-            cur.execute(MATCHED_COOKIEDATA_QUERY)
-            for row in cur:
-
-                cat_id = int(row["cat_id"])
-
-                if cat_id == 4:
-                    cat_id = 4
-                elif cat_id == 99:
-                    cat_id = 5
-                elif cat_id == -1:
-                    cat_id = 6
-
-                # In rare cases, the expiration date can be set to the year 10000 and upwards.
-                # This forces a different ISO time format than the one we normally expect.
-                # Since these cases are exceedingly rare (2 instances out of 300000), we will ignore them.
-                if row["actual_expiry"].startswith("+0"):
-                    continue
-
-                # Verify that the observed cookie's domain matches the declared domain.
-                # This requires string processing more complex than what's available in SQL.
-                canon_adom: str = canonical_domain(row["cookie_domain"])
-
-                # Consent Management Platforms may specify multiple possible domains, split by linebreaks.
-                # If the correct host occurs in the set, accept the training entry, else reject.
-                consent_domains = row["consent_domain"].split("<br/>")
-                domains_match: bool = False
-                for domain_entry in consent_domains:
-                    canon_cdom = canonical_domain(domain_entry)
-                    if re.search(re.escape(canon_cdom), canon_adom, re.IGNORECASE):
-                        domains_match = True
-                        break
-
-                if not domains_match:
-                    mismatch_count += 1
-                    continue
-
-                json_cookie_key = row["name"] + ";" + row["cookie_domain"] + ";" + row["path"] + ";" + row["site_url"]
-                if json_cookie_key in blacklist:
-                    blacklisted_encounters += 1
-                    continue
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table} ({', '.join(columns)});")
+    except sqlite3.OperationalError:
+        # e.g. read-only database, queries still work without the index
+        logger.warning(f"Could not create index '{index_name}' on table '{table}'.")
+        logger.debug(traceback.format_exc())
 
-                try:
-                    if json_cookie_key not in json_data:
-                        json_data[json_cookie_key] = {
-                            "visit_id": row["visit_id"],
-                            "name": row["name"],
-                            "domain": row["cookie_domain"],
-                            "consent_domain": row["consent_domain"],
-                            "path": row["path"],
-                            "site_url": row["site_url"],
-                            "label": cat_id,
-                            "cat_name": row["cat_name"],
-                            "cmp_type": row["cmp_type"],
-                            "consent_expiry": row["consent_expiry"],
-                            "timestamp": row["time_stamp"],
-                            #"purpose": row["purpose"],
-                            "variable_data": []
-                        }
-                        counts_per_unique_cookie[cat_id] += 1
-                        updates_per_cookie_entry[(json_cookie_key, cat_id)] = 1
-                    else:
-                        # Verify that the values match
-                        assert json_data[json_cookie_key]["name"] == row[
-                            "name"], f"Stored name: '{json_data[json_cookie_key]['name']}' does not match new name: '{row['name']}'"
-                        assert json_data[json_cookie_key]["domain"] == row[
-                            "cookie_domain"], f"Stored domain: '{json_data[json_cookie_key]['domain']}' does not match new domain: '{row['cookie_domain']}'"
-                        assert json_data[json_cookie_key]["path"] == row[
-                            "path"], f"Stored path: '{json_data[json_cookie_key]['path']}' does not match new path: '{row['path']}'"
-                        assert json_data[json_cookie_key]["site_url"] == row[
-                            "site_url"], f"Stored FPO: '{json_data[json_cookie_key]['site_url']}' does not match new FPO: '{row['site_url']}'"
-                        assert json_data[json_cookie_key][
-                                   "label"] == cat_id, f"Stored label: '{json_data[json_cookie_key]['label']}' does not match new label: '{cat_id}'"
-                        assert json_data[json_cookie_key]["cmp_type"] == row[
-                            "cmp_type"], f"Stored CMP: '{json_data[json_cookie_key]['cmp_origin']}' does not match new CMP: '{row['cmp_type']}'"
-                        updates_per_cookie_entry[(json_cookie_key, cat_id)] += 1
-                except AssertionError as e:
-                    # If one of the above assertions fails, we have a problem in the dataset, and need to prune the offending entries
-                    logger.debug(e)
-                    logger.debug(f"Existing Data: {json_data[json_cookie_key]}")
-                    logger.debug(f"Offending Cookie: {dict(row)}")
-                    counts_per_unique_cookie[int(json_data[json_cookie_key]["label"])] -= 1
-                    blacklist.add(json_cookie_key)
-#                    blacklist_entries_with_details.append( {
-#                        'name': json_data[json_cookie_key]["name"],
-#                        "1st_name": str(json_data[json_cookie_key]["cat_name"]),
-#                        "1st_label": int(json_data[json_cookie_key]["label"]),
-#                        "2nd_name": str(row["cat_name"]),
-#                        "2nd_label": int(row["cat_id"]),
-#                        "site_url": json_data[json_cookie_key]["site_url"],
-#                        "details": json_data[json_cookie_key]
-#                    })
-                    blacklisted_encounters += 2  # both current and removed previous cookie
-                    del json_data[json_cookie_key]
-                    continue
-
-                counts_per_cookie_update[cat_id] += 1
-
-                json_data[json_cookie_key]["variable_data"].append({
-                    "value": row["value"],
-                    "expiry": compute_expiry_time_in_seconds(row["time_stamp"], row["actual_expiry"], int(row["is_session"])),
-                    "session": bool(row["is_session"]),
-                    "http_only": bool(row["is_http_only"]),
-                    "host_only": bool(row["is_host_only"]),
-                    "secure": bool(row["is_secure"]),
-                    "same_site": row["same_site"]
-                })
-
-                update_count += 1
-            cur.close()
-    except (sqlite3.OperationalError, sqlite3.IntegrityError):
-        logger.error("A database error occurred:")
-        logger.error(traceback.format_exc())
-        raise
-    else:
-        logger.info(f"Extracted {update_count} cookie updates.")
-        logger.info(f"Encountered {mismatch_count} domain mismatches.")
-        logger.info(f"Unique training data entries in dictionary: {len(json_data)}")
-        logger.info(f"Number of unique cookies blacklisted due to inconsistencies {len(blacklist)}")
-        logger.info(f"Number of training data updates rejected due to blacklist: {blacklisted_encounters}")
-        logger.info(counts_per_unique_cookie)
-        logger.info(counts_per_cookie_update)
-
-        all_temp: List[int] = []
-        stats_temp: List[List[int]] = [[], [], [], [], [], [], []]
-        for (k, l), c in updates_per_cookie_entry.items():
-            stats_temp[l].append(c)
-            all_temp.append(c)
+
+class MatchedCookieExtraction:
+    """
+    State of the matched cookie extraction: the cookies extracted so far, keyed by name, domain, path and site,
+    and the statistics logged at the end. Rows of the same cookie need to be added in the order of the query.
+    """
+
+    def __init__(self):
+        self.json_data: Dict[str, Dict[str, Any]] = dict()
+        self.updates_per_cookie_entry: Dict[Tuple[str, int], int] = dict()
+
+        # cookies that will be filtered due to having multiple categories assigned
+        self.blacklist = set()
+
+        # while collecting the data, also determine how many training entries were collected for each label
+        # [necessary, functional, analytic, advertising]
+        self.counts_per_unique_cookie = [0, 0, 0, 0, 0, 0, 0]
+        self.counts_per_cookie_update = [0, 0, 0, 0, 0, 0, 0]
+        self.mismatch_count = 0
+        self.update_count = 0
+
+        # counts the number of times a data entry was rejected due to multiple categories
+        self.blacklisted_encounters = 0
+        self.num_blacklisted = 0
+        self.row_count = 0
+
+        # number of updates of each cookie per label, moved out of updates_per_cookie_entry by finish_group
+        self.update_stats: List[array] = [array("l") for _ in range(7)]
+        self.timed = metrics.enabled
+
+    def add(self, row: Any) -> None:
+        """
+        Process a row of MATCHED_COOKIEDATA_QUERY.
+        @param row: database row, or a dictionary of its columns
+        """
+        json_data, blacklist, timed = self.json_data, self.blacklist, self.timed
+        self.row_count += 1
+
+        cat_id = int(row["cat_id"])
+
+        if cat_id == 4:
+            cat_id = 4
+        elif cat_id == 99:
+            cat_id = 5
+        elif cat_id == -1:
+            cat_id = 6
+
+        # In rare cases, the expiration date can be set to the year 10000 and upwards.
+        # This forces a different ISO time format than the one we normally expect.
+        # Since these cases are exceedingly rare (2 instances out of 300000), we will ignore them.
+        if row["actual_expiry"].startswith("+0"):
+            return
+
+        # Verify that the observed cookie's domain matches the declared domain.
+        # This requires string processing more complex than what's available in SQL.
+        if timed:
+            t_start = time.perf_counter()
+        domains_match = consent_domain_matches(row["cookie_domain"], row["consent_domain"])
+        if timed:
+            metrics.add_time("domain_matching", t_start)
+
+        if not domains_match:
+            self.mismatch_count += 1
+            return
+
+        json_cookie_key = matched_cookie_key(row)
+        if json_cookie_key in blacklist:
+            self.blacklisted_encounters += 1
+            return
+
+        try:
+            if json_cookie_key not in json_data:
+                json_data[json_cookie_key] = {
+                    "visit_id": row["visit_id"],
+                    "name": row["name"],
+                    "domain": row["cookie_domain"],
+                    "consent_domain": row["consent_domain"],
+                    "path": row["path"],
+                    "site_url": row["site_url"],
+                    "label": cat_id,
+                    "cat_name": row["cat_name"],
+                    "cmp_type": row["cmp_type"],
+                    "consent_expiry": row["consent_expiry"],
+                    "timestamp": row["time_stamp"],
+                    #"purpose": row["purpose"],
+                    "variable_data": []
+                }
+                self.counts_per_unique_cookie[cat_id] += 1
+                self.updates_per_cookie_entry[(json_cookie_key, cat_id)] = 1
+            else:
+                # Verify that the values match
+                assert json_data[json_cookie_key]["name"] == row[
+                    "name"], f"Stored name: '{json_data[json_cookie_key]['name']}' does not match new name: '{row['name']}'"
+                assert json_data[json_cookie_key]["domain"] == row[
+                    "cookie_domain"], f"Stored domain: '{json_data[json_cookie_key]['domain']}' does not match new domain: '{row['cookie_domain']}'"
+                assert json_data[json_cookie_key]["path"] == row[
+                    "path"], f"Stored path: '{json_data[json_cookie_key]['path']}' does not match new path: '{row['path']}'"
+                assert json_data[json_cookie_key]["site_url"] == row[
+                    "site_url"], f"Stored FPO: '{json_data[json_cookie_key]['site_url']}' does not match new FPO: '{row['site_url']}'"
+                assert json_data[json_cookie_key][
+                           "label"] == cat_id, f"Stored label: '{json_data[json_cookie_key]['label']}' does not match new label: '{cat_id}'"
+                assert json_data[json_cookie_key]["cmp_type"] == row[
+                    "cmp_type"], f"Stored CMP: '{json_data[json_cookie_key]['cmp_origin']}' does not match new CMP: '{row['cmp_type']}'"
+                self.updates_per_cookie_entry[(json_cookie_key, cat_id)] += 1
+        except AssertionError as e:
+            # If one of the above assertions fails, we have a problem in the dataset, and need to prune the offending entries
+            logger.debug(e)
+            logger.debug(f"Existing Data: {json_data[json_cookie_key]}")
+            logger.debug(f"Offending Cookie: {dict(row)}")
+            self.counts_per_unique_cookie[int(json_data[json_cookie_key]["label"])] -= 1
+            blacklist.add(json_cookie_key)
+#            blacklist_entries_with_details.append( {
+#                'name': json_data[json_cookie_key]["name"],
+#                "1st_name": str(json_data[json_cookie_key]["cat_name"]),
+#                "1st_label": int(json_data[json_cookie_key]["label"]),
+#                "2nd_name": str(row["cat_name"]),
+#                "2nd_label": int(row["cat_id"]),
+#                "site_url": json_data[json_cookie_key]["site_url"],
+#                "details": json_data[json_cookie_key]
+#            })
+            self.blacklisted_encounters += 2  # both current and removed previous cookie
+            del json_data[json_cookie_key]
+            return
+
+        self.counts_per_cookie_update[cat_id] += 1
+
+        if timed:
+            t_start = time.perf_counter()
+        expiry = compute_expiry_time_in_seconds(row["time_stamp"], row["actual_expiry"], int(row["is_session"]))
+        if timed:
+            metrics.add_time("expiry_computation", t_start)
+
+        json_data[json_cookie_key]["variable_data"].append({
+            "value": row["value"],
+            "expiry": expiry,
+            "session": bool(row["is_session"]),
+            "http_only": bool(row["is_http_only"]),
+            "host_only": bool(row["is_host_only"]),
+            "secure": bool(row["is_secure"]),
+            "same_site": row["same_site"]
+        })
+
+        self.update_count += 1
+
+    def finish_group(self) -> None:
+        """
+        Start over with an empty dictionary, once all rows of the cookies extracted so far were added.
+        Only the number of updates of each cookie is kept for the statistics.
+        """
+        for (k, l), c in self.updates_per_cookie_entry.items():
+            self.update_stats[l].append(c)
+        self.num_blacklisted += len(self.blacklist)
+        self.updates_per_cookie_entry = dict()
+        self.json_data = dict()
+        self.blacklist = set()
+
+    def log_summary(self, num_cookies: int) -> None:
+        """ Log the statistics of the extraction, after finish_group. """
+        metrics.add_rows("matched_cookies_extraction", self.row_count)
+        metrics.count("cookie_updates", self.update_count)
+        metrics.count("domain_mismatches", self.mismatch_count)
+        logger.info(f"Extracted {self.update_count} cookie updates.")
+        logger.info(f"Encountered {self.mismatch_count} domain mismatches.")
+        logger.info(f"Unique training data entries in dictionary: {num_cookies}")
+        logger.info(f"Number of unique cookies blacklisted due to inconsistencies {self.num_blacklisted}")
+        logger.info(f"Number of training data updates rejected due to blacklist: {self.blacklisted_encounters}")
+        logger.info(self.counts_per_unique_cookie)
+        logger.info(self.counts_per_cookie_update)
+
+        all_temp: List[int] = [c for stats in self.update_stats for c in stats]
+        stats_temp = self.update_stats
 
         for i in range(len(stats_temp)):
             if len(stats_temp[i]) > 1:
@@ -290,8 +611,110 @@ def retrieve_matched_cookies_from_DB(conn: sqlite3.Connection):
             logger.info(f"Total average of updates: {mean(all_temp)}")
             logger.info(f"Standard Deviation of updates: {stdev(all_temp)}")
 
-    return json_data, counts_per_unique_cookie
 
+def matched_cookie_key(row: Any) -> str:
+    """ Key of a row of MATCHED_COOKIEDATA_QUERY in the matched cookie dictionary. """
+    return row["name"] + ";" + row["cookie_domain"] + ";" + row["path"] + ";" + row["site_url"]
+
+
+def extract_partitioned(extraction: MatchedCookieExtraction, rows: Iterator[Any],
+                        progress: "ProgressReporter", num_partitions: int) -> MatchedSnapshot:
+    """
+    Out-of-core variant of the matched cookie extraction, for crawls whose cookies do not fit into memory.
+    The rows are partitioned by cookie on disk and extracted one partition at a time. The cookies of all partitions
+    are then merged back into the order of the in-memory extraction, and written into a snapshot.
+    @param extraction: extraction state, only used for the statistics
+    @param rows: rows of MATCHED_COOKIEDATA_QUERY
+    @param progress: progress report of the scan
+    @param num_partitions: number of partitions
+    @return: mapping over the snapshot, with the same keys and values as the in-memory dictionary
+    """
+    with HashPartitions(num_partitions) as partitions:
+        for row in rows:
+            progress.update(row["visit_id"])
+            partitions.add(matched_cookie_key(row), dict(row))
+
+        runs = []
+        for bucket in partitions.buckets():
+            # sequence number of the row that added each cookie, for the order across partitions
+            first_row: Dict[str, int] = dict()
+            for seq, key, row in bucket:
+                extraction.add(row)
+                if key not in first_row and key in extraction.json_data:
+                    first_row[key] = seq
+            runs.append(partitions.write_run((first_row[k], (k, v)) for k, v in extraction.json_data.items()))
+            extraction.finish_group()
+
+        snapshot_path = os.path.join(partitions.directory, "matched_cookies.snap")
+        writer = SnapshotWriter(snapshot_path, max_strings=SNAPSHOT_MAX_STRINGS)
+        for key, val in partitions.merge_runs(runs):
+            writer.add(key, val)
+        writer.close()
+        # the snapshot stays mapped into memory after its directory is removed
+        return MatchedSnapshot(snapshot_path)
+
+
+def retrieve_matched_cookies_from_DB(conn: sqlite3.Connection, site_url: Optional[str] = None,
+                                     memory_budget_mb: Optional[float] = None, create_indexes: bool = False):
+    """
+    Retrieves cookies that were found in both the javascript cookies table, and the consent table.
+    If the cookies are estimated to exceed the memory budget, they are extracted partition by partition
+    on disk, and returned as a MatchedSnapshot instead of a dictionary (see extract_partitioned).
+    @param conn: Database connection
+    @param site_url: Only retrieve the cookies of this site, see restrict_to_site
+    @param memory_budget_mb: Memory available for the extraction, see partitioned_grouping.py
+    @param create_indexes: Whether to add the indexes of a single-site extraction to the database, see ensure_index
+    @return: Extracted records in JSON format, cookie update counts, cookies that were labelled twice on a single website
+    """
+    if site_url is not None:
+        restrict_to_site(conn, site_url, create_indexes)
+        num_partitions = 1
+    else:
+        num_partitions = partitions_needed(estimate_table_rows(conn, "javascript_cookies"),
+                                           MATCHED_BYTES_PER_ROW, memory_budget_mb)
+
+    extraction = MatchedCookieExtraction()
+    try:
+        progress = ProgressReporter("Matched cookie extraction", count_visits(conn, CONSENT_VISITS_CONDITION))
+        with conn, metrics.stage("matched_cookies_extraction"):
+            cur = conn.cursor()
+            cur.execute(MATCHED_COOKIEDATA_QUERY)
+            if num_partitions > 1:
+                json_data = extract_partitioned(extraction, cur, progress, num_partitions)
+            else:
+                for row in cur:
+                    progress.update(row["visit_id"])
+                    extraction.add(row)
+                json_data = extraction.json_data
+                extraction.finish_group()
+            cur.close()
+    except (sqlite3.OperationalError, sqlite3.IntegrityError):
+        logger.error("A database error occurred:")
+        logger.error(traceback.format_exc())
+        raise
+    else:
+        extraction.log_summary(len(json_data))
+
+    return json_data, extraction.counts_per_unique_cookie
+
+
+def load_matched_cookies(matched_path: str) -> Mapping[str, Dict[str, Any]]:
+    """
+    Load matched cookie records previously written by extract_matched_cookies.py,
+    in place of running retrieve_matched_cookies_from_DB again.
+    A snapshot is memory-mapped rather than loaded, and its records are decoded while iterating over them.
+    @param matched_path: JSON file or snapshot containing the extracted records
+    @return: Extracted records in the same format as retrieve_matched_cookies_from_DB
+    """
+    with metrics.stage("matched_cookies_load"):
+        if is_snapshot(matched_path):
+            json_data = MatchedSnapshot(matched_path)
+        else:
+            with open(matched_path, 'r') as fd:
+                json_data = json.load(fd)
+    metrics.add_rows("matched_cookies_load", len(json_data))
+    logger.info(f"Loaded {len(json_data)} matched cookies from '{matched_path}'")
+    return json_data
 
 
 def get_violation_details_consent_table(row: Dict) -> Dict:
@@ -309,6 +732,115 @@ def get_violation_details_consent_table(row: Dict) -> Dict:
              "expiry": row["consent_expiry"]}
 
 
+def write_distributions(summaries: Dict[str, NumericSummary], filename: str, output_path: str = "./violation_stats/") -> None:
+    """
+    Store the summaries of the distributions of a method, such that violation_stats.py can compute medians
+    and histograms without the violations, and summaries of several crawls or shards can be merged.
+    @param summaries: summary per distribution name, e.g. "violations_per_site"
+    @param filename: File to write them to.
+    @param output_path: Directory of the file.
+    """
+    write_json({name: summary.to_dict() for name, summary in summaries.items()}, filename, output_path)
+
+
+def load_distributions(*paths: str) -> Dict[str, NumericSummary]:
+    """
+    Load the summaries written by write_distributions, merging those of the same name across files.
+    @param paths: files to load, e.g. of the shards or crawls to combine
+    @return: summary per distribution name
+    """
+    summaries: Dict[str, NumericSummary] = dict()
+    for path in paths:
+        with open(path, 'r') as fd:
+            for name, d in json.load(fd).items():
+                summary = NumericSummary.from_dict(d)
+                if name in summaries:
+                    summaries[name].merge(summary)
+                else:
+                    summaries[name] = summary
+    return summaries
+
+
+def load_violations(filename: str, output_path: str = "./violation_stats/") -> Dict[str, List]:
+    """
+    Read the violations written by an earlier run, if any.
+    @param filename: Output file of the earlier run.
+    @return: violations per site, empty if the file does not exist
+    """
+    json_outfile = os.path.join(output_path, filename)
+    if not os.path.exists(json_outfile):
+        return dict()
+    with open(json_outfile, 'r') as fd:
+        return json.load(fd)
+
+
+def iter_violations(filename: str, output_path: str = "./violation_stats/",
+                    chunk_size: int = 1 << 20) -> Iterator[Tuple[str, List]]:
+    """
+    Stream the violations of an output file site by site, without loading the whole file.
+    Outputs are written with sorted keys, so the sites are produced in sorted order.
+    @param filename: Output file written by write_json.
+    @param chunk_size: Number of characters read at once.
+    @return: iterator over (site, violations), empty if the file does not exist
+    """
+    json_outfile = os.path.join(output_path, filename)
+    if not os.path.exists(json_outfile):
+        return
+    decoder = json.JSONDecoder()
+    with open(json_outfile, 'r') as fd:
+        buf = ""
+        pos = 0
+
+        def read_more() -> bool:
+            """ Drop the parsed part of the buffer and read more, doubling the chunk for large entries. """
+            nonlocal buf, pos
+            chunk = fd.read(max(chunk_size, len(buf) - pos))
+            buf = buf[pos:] + chunk
+            pos = 0
+            return len(chunk) > 0
+
+        def peek() -> str:
+            """ Next non-whitespace character, empty at the end of the file. """
+            nonlocal pos
+            while True:
+                while pos < len(buf) and buf[pos].isspace():
+                    pos += 1
+                if pos < len(buf):
+                    return buf[pos]
+                if not read_more():
+                    return ""
+
+        def expect(delimiters: str) -> str:
+            """ Consume one of the delimiters. """
+            nonlocal pos
+            c = peek()
+            if not c or c not in delimiters:
+                raise ValueError(f"Expected one of '{delimiters}' in '{json_outfile}'")
+            pos += 1
+            return c
+
+        def value() -> Any:
+            """ Decode the next JSON value, which may span several chunks. """
+            nonlocal pos
+            peek()
+            while True:
+                try:
+                    val, pos = decoder.raw_decode(buf, pos)
+                    return val
+                except json.JSONDecodeError:
+                    if not read_more():
+                        raise
+
+        expect("{")
+        if peek() == "}":
+            return
+        while True:
+            site = value()
+            expect(":")
+            yield site, value()
+            if expect(",}") == "}":
+                return
+
 
 def write_json(violation_details: Union[List,Dict], filename: str, output_path: str = "./violation_stats/") -> None:
     """
@@ -319,7 +851,7 @@ def write_json(violation_details: Union[List,Dict], filename: str, output_path:
     os.makedirs(output_path, exist_ok=True)
     json_outfile = os.path.join(output_path, filename)
 
-    with open(json_outfile, 'w') as fd:
+    with open(json_outfile, 'w') as fd, metrics.stage("write_output"):
         json.dump(violation_details, fd, indent=4, sort_keys=True)
     logger.info(f"Violations output to: '{json_outfile}'")
 
@@ -333,7 +865,7 @@ def write_vdomains(vdomains: Set, fn: str, output_path: str = "./violation_stats
     os.makedirs(output_path, exist_ok=True)
     path =  output_path + fn
     logger.info(f"Writing domains to {path}")
-    with open(path, 'w') as fd:
+    with open(path, 'w') as fd, metrics.stage("write_output"):
         for d in sorted(vdomains):
             fd.write(d + "\n")
     logger.info(f"Violations output to: '{path}'")
@@ -4,20 +4,41 @@
 Aggregate violation detections statistics. Used to produce the statistics used for the report and the paper.
 Requires all 8 method scripts to be executed first, which will produce their output in this directory.
 This script then produces several human-readable statistics that can then be extracted.
+----------------------------------
+Optional arguments:
+    --sketches: Only report the statistics of the distribution summaries the methods write alongside their violations,
+                the sites with violations, medians, means, standard deviations and histograms, without reading the
+                violations themselves. The results are approximate, but the summaries of all given files and
+                directories are merged, such that the shards or crawls of a study can be reported together.
+    <dist_path>: Distribution summary written by a method, or directory searched for them, the current directory if none.
+    --sample: The methods were run on a sample of the visits. Reports their estimated violation rates, and computes
+              the statistics relative to the sampled sites rather than the whole crawl.
+Usage:
+    violation_stats.py [--sample]
+    violation_stats.py --sketches [<dist_path>...]
 """
 
+from docopt import docopt
 import json
 import numpy as np
 import logging
+import os
+import re
 import sys
 
 from statistics import mean, median, stdev
 
+# summaries of the distributions written by the methods are read with the sketches of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sketches import NumericSummary
+
 # I want to keep this script parameter-free, so here's how you reliably get the total number of domains:
 # Open database in sqlitebrowser, open table "consent_crawl_results", query "crawl_state == 0"
 # This will give all domains for which the consent crawl succeeded, which is the set of domains for which we can perform the analysis.
 # Then replace the count in the following line:
 total_domain_count = 29398
+# Same for the domains that use Cookiebot, i.e. with "cmp_type == 0", used for method 8.
+cookiebot_domain_count = 9446
 known_cats = [(-1,"Unknown"), (0,"Necessary"), (1, "Functionality"), (2, "Analytics"), (3, "Advertising"), (4, "Uncategorised"), (5, "Social Media")]
 
 
@@ -30,6 +51,82 @@ def read_json(name) -> dict:
     with open(name, 'r') as fr:
         return json.load(fr)
 
+count_bins = [*range(0,101), 150, 200, np.inf]
+expiry_ratio_bins = [1, 1.5, 1.6, 2, 2.5, 5, 10, 100, 1000, 10000, 10e5, 10e6, 10e7, 10e8, 10e9, np.inf]
+distributions_pattern = re.compile(r"method(\d)_distributions\.json$")
+
+def find_distributions(paths) -> dict:
+    # distribution summaries written by the methods (see write_distributions in utils.py), per method number
+    found = dict()
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in sorted(files):
+                    match = distributions_pattern.match(name)
+                    if match:
+                        found.setdefault(int(match.group(1)), []).append(os.path.join(root, name))
+        else:
+            match = distributions_pattern.search(os.path.basename(path))
+            if not match:
+                logger.warning(f"Not a distribution summary of a method, skipped: {path}")
+                continue
+            found.setdefault(int(match.group(1)), []).append(path)
+    return found
+
+def merge_distributions(names) -> dict:
+    # summaries of the same name merged across the files
+    merged = dict()
+    for name in names:
+        for k, d in read_json(name).items():
+            summary = NumericSummary.from_dict(d)
+            if k in merged:
+                merged[k].merge(summary)
+            else:
+                merged[k] = summary
+    return merged
+
+def sketch_histogram(summary, bins, title):
+    counts = np.array(summary.quantiles.histogram(bins))
+    logger.info("Bins for Histogram:")
+    logger.info(np.array(bins, dtype=float))
+    logger.info(title)
+    logger.info(counts)
+    return counts
+
+def sketch_statistics(paths):
+    found = find_distributions(paths)
+    if not found:
+        logger.error(f"No distribution summaries found in: {', '.join(paths)}")
+        return 1
+    for i in sorted(found):
+        dist = merge_distributions(found[i])
+        logger.info("-------------------------------")
+        logger.info(f"Method {i} Distribution Summaries, merged from {len(found[i])} file(s)")
+        logger.info("-------------------------------")
+        summary = dist.get("violations_per_site")
+        if summary is None or len(summary) == 0:
+            logger.info("No sites with violations.")
+            continue
+        sites = len(summary)
+        logger.info(f"Sites with violations: {sites} -- {sites / total_domain_count * 100:.3f}%")
+        logger.info(f"Mean violation cookies per site: {summary.moments.mean:.1f}")
+        logger.info(f"Median violation cookies per site: {summary.quantiles.median():.1f}")
+        logger.info(f"Standard Deviation of violation cookies per site: {summary.moments.stdev():.1f}")
+        if i in (4, 5):
+            counts = sketch_histogram(summary, count_bins, "Violating cookie count per site histogram")
+            for at_least in (5, 10, 25):
+                logger.info(f"Number of sites with at least {at_least} violating cookies: {sum(counts[at_least - 1:])} -- "
+                            f"{sum(counts[at_least - 1:]) / total_domain_count * 100:.3f}%")
+        if "expiry_ratio" in dist:
+            sketch_histogram(dist["expiry_ratio"], expiry_ratio_bins, "Expiration Ratio Histogram")
+    return 0
+
+cargs = docopt(__doc__)
+
+# the summaries alone, without loading any of the violations below
+if cargs["--sketches"]:
+    sys.exit(sketch_statistics(cargs["<dist_path>"] or ["."]))
+
 m1c:dict = read_json("method1_cookies.json")
 m2c:dict = read_json("method2_cookies.json")
 m3c:dict = read_json("method3_cookies.json")
@@ -74,6 +171,38 @@ for m in m8c_all:
 for m in m8c_temp:
     m8c_dummy[m] = 0
 
+## Sampled runs
+# When the methods were run with "--sample <fraction>", they also output the estimated share of sites with violations.
+# The statistics below then refer to the sampled sites, rather than the whole crawl. The estimates are only read
+# when this script is told that the methods were sampled, such that a leftover estimate never changes a full run.
+estimate_files = ["method1_estimate.json", "method2_estimate.json", "method3_estimate.json", "method4_estimate.json",
+                  "method5_estimate.json", "method6_estimate.json",
+                  "method7/method7_estimate.json", "method8/method8_estimate.json"]
+estimates = dict()
+if cargs["--sample"]:
+    estimates = {name: read_json(name) for name in estimate_files if os.path.exists(name)}
+    if not estimates:
+        logger.warning("No estimates of sampled runs were found, the statistics refer to the whole crawl.")
+elif any(os.path.exists(name) for name in estimate_files):
+    logger.warning("Ignoring the estimates of sampled runs, the statistics refer to the whole crawl.")
+
+m7_domain_count = total_domain_count
+m8_domain_count = total_domain_count
+if estimates:
+    logger.info("-------------------------------")
+    logger.info("Estimated Violation Rates of the Sample")
+    logger.info("-------------------------------")
+    for name, est in estimates.items():
+        logger.info(f"{name}: {est['rate'] * 100:.3f}% -- {est['confidence'] * 100:.0f}% CI: "
+                    f"{est['rate_low'] * 100:.3f}% to {est['rate_high'] * 100:.3f}%, "
+                    f"about {est['estimated_sites']} of {est['total_sites']} sites, from {est['sampled_sites']} sampled")
+
+    total_domain_count = estimates.get("method1_estimate.json", next(iter(estimates.values())))["sampled_sites"]
+    m7_domain_count = estimates.get("method7/method7_estimate.json", {}).get("sampled_sites", total_domain_count)
+    m8_domain_count = estimates.get("method8/method8_estimate.json", {}).get("sampled_sites", total_domain_count)
+    if "method8/method8_estimate.json" in estimates:
+        cookiebot_domain_count = estimates["method8/method8_estimate.json"]["strata"].get("0", {}).get("sampled", 0)
+
 def general_statistics(mall, title):
     domains_count = [0,0,0,0,0,0, 0, 0]
     avdomains = set()
@@ -225,7 +354,7 @@ logger.info(f"Sites with Persistent as Session: {len(persistent_as_session.keys(
 logger.info(f"Sites with Session as Persistent: {len(session_as_persistent.keys())} -- {len(session_as_persistent.keys()) / total_domain_count * 100 :.3f}%")
 
 logger.info("Expiration Ratio Histogram")
-logger.info(np.histogram(all_expiry_ratios, bins=[1, 1.5, 1.6, 2, 2.5, 5, 10, 100, 1000, 10000, 10e5, 10e6, 10e7, 10e8, 10e9, np.inf]))
+logger.info(np.histogram(all_expiry_ratios, bins=expiry_ratio_bins))
 
 compute_median_mean_stdev(m3c)
 
@@ -233,8 +362,6 @@ logger.info("-------------------------------")
 logger.info("Method 4-specific Statistics: Unclassified Cookies")
 logger.info("-------------------------------")
 
-count_bins = [*range(0,101), 150, 200, np.inf]
-
 
 m4_sites_with_count = []
 for site_url, cookies in m4c.items():
@@ -393,16 +520,16 @@ logger.info("-------------------------------")
 logger.info("Method 7-specific Statistics: Implicit Consent")
 logger.info("-------------------------------")
 
-m78_check(m7c_f, m7c_an, m7c_ad, m7c_uncat, m7c_soc, total_domain_count)
+m78_check(m7c_f, m7c_an, m7c_ad, m7c_uncat, m7c_soc, m7_domain_count)
 
 
 logger.info("-------------------------------")
 logger.info("Method 8-specific Statistics: Ignored Consent Choices")
 logger.info("-------------------------------")
 
-m78_check(m8c_f, m8c_an, m8c_ad, m8c_uncat, None, total_domain_count)
+m78_check(m8c_f, m8c_an, m8c_ad, m8c_uncat, None, m8_domain_count)
 
 logger.info("-------------------------------")
 logger.info("Method 8-specific Statistics: Ignored Consent Choices ( Only Cookiebot) ")
 logger.info("-------------------------------")
-m78_check(m8c_f, m8c_an, m8c_ad, m8c_uncat, None, 9446)
+m78_check(m8c_f, m8c_an, m8c_ad, m8c_uncat, None, cookiebot_domain_count)